@@ -0,0 +1,238 @@
+'''Per-user accounting of llm, tool and speech calls: tokens, cost, latency, key and cache hits.
+Calls are buffered in memory and written in batches to the Usage table by a background thread (no sqlite I/O on the event loop),
+the UsageDaily rollup is updated with every batch.
+The user and the mode come from context variables that the bot sets for every update'''
+import time
+import atexit
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from contextvars import ContextVar
+from collections import Counter
+from ..config.logger import logger
+from ..config.config import load_config
+
+
+config = load_config()
+
+current_user: ContextVar[int | None] = ContextVar('current_user', default=None)
+current_mode: ContextVar[str] = ContextVar('current_mode', default='')
+
+# USD per 1M tokens (input, output), update when the price lists change
+model_prices = {
+    'openai/gpt-oss-120b': (0.15, 0.75),
+    'openai/gpt-oss-20b': (0.10, 0.50),
+    'groq/compound': (0.15, 0.75),
+    'groq/compound-mini': (0.10, 0.50),
+    'gemini-2.5-pro': (1.25, 10.0),
+    'gemini-2.5-flash': (0.30, 2.50),
+    'gemini-2.5-flash-lite': (0.10, 0.40)
+}
+
+flush_size = 50  # calls in the buffer
+flush_interval = 10  # seconds
+usage_retention_days = 30  # raw Usage rows; UsageDaily is kept
+
+buffer: list[tuple] = []
+buffer_lock = threading.Lock()
+flush_event = threading.Event()  # wakes the writer before flush_interval when the buffer is full
+last_prune = ''  # the day Usage was pruned last
+daily_totals: dict[tuple[int, str], Counter] = {}  # (user id, day) -> requests, tokens, cost. Loaded from UsageDaily on the first quota check
+
+
+def utc_day() -> str:
+    return datetime.now(timezone.utc).strftime('%Y.%m.%d')
+
+
+def usage_launch():
+    '''Creates the usage tables if they do not exist'''
+    connection = sqlite3.connect(config.database.path)
+    cursor = connection.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Usage (
+        time REAL,
+        day TEXT,
+        user_id INT,
+        mode TEXT,
+        kind TEXT,
+        provider TEXT,
+        model TEXT,
+        key TEXT,
+        tokens_in INT,
+        tokens_out INT,
+        cached_tokens INT,
+        cost REAL,
+        latency REAL,
+        cache_hit INT,
+        ok INT
+        )
+        ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS usage_time ON Usage (time)')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS UsageDaily (
+        day TEXT,
+        user_id INT,
+        mode TEXT,
+        kind TEXT,
+        provider TEXT,
+        model TEXT,
+        calls INT,
+        tokens_in INT,
+        tokens_out INT,
+        cached_tokens INT,
+        cost REAL,
+        latency REAL,
+        cache_hits INT,
+        errors INT,
+        PRIMARY KEY (day, user_id, mode, kind, provider, model)
+        )
+        ''')
+
+    connection.commit()
+    connection.close()
+
+
+def set_usage_context(user_id: int | None, mode: str):
+    '''Every call made while handling the update (also in tasks and threads started from it) is accounted to this user and mode'''
+    current_user.set(user_id)
+    current_mode.set(mode)
+
+
+def call_cost(model: str, tokens_in: int, tokens_out: int, cached_tokens: int = 0) -> float:
+    price_in, price_out = model_prices.get(model, (0, 0))
+    return ((tokens_in - cached_tokens / 2) * price_in + tokens_out * price_out) / 1e6  # cached input tokens are billed at about half price
+
+
+def is_request(kind: str, cache_hit: bool) -> bool:
+    '''Calls that count against the request quota'''
+    return kind in ('llm', 'speech') and not cache_hit
+
+
+def record_call(kind: str, provider: str, model: str, key: str | None = None, tokens_in: int = 0, tokens_out: int = 0,
+                cached_tokens: int = 0, latency: float | None = None, cache_hit: bool = False, ok: bool = True):
+    '''kind: llm, tool, speech. key is stored masked'''
+    user_id = current_user.get()
+    day = utc_day()
+    cost = call_cost(model, tokens_in, tokens_out, cached_tokens)
+    row = (time.time(), day, user_id, current_mode.get(), kind, provider, model, f'...{key[-4:]}' if key else '',
+           tokens_in, tokens_out, cached_tokens, cost, latency, int(cache_hit), int(ok))
+
+    with buffer_lock:
+        buffer.append(row)
+        totals = daily_totals.get((user_id, day))
+        if totals is not None:
+            totals['requests'] += is_request(kind, cache_hit)
+            totals['tokens'] += tokens_in + tokens_out
+            totals['cost'] += cost
+        flush = len(buffer) >= flush_size
+
+    if flush:
+        flush_event.set()
+
+
+def flush_usage():
+    '''Writes the buffered calls and adds them to the daily rollup'''
+    global last_prune
+    with buffer_lock:
+        rows = buffer[:]
+        buffer.clear()
+    if not rows:
+        return
+
+    rollup: dict[tuple, Counter] = {}
+    for (_, day, user_id, mode, kind, provider, model, _, tokens_in, tokens_out, cached_tokens, cost, latency, cache_hit, ok) in rows:
+        counter = rollup.setdefault((day, user_id, mode, kind, provider, model), Counter())
+        counter.update(calls=1, tokens_in=tokens_in, tokens_out=tokens_out, cached_tokens=cached_tokens, cost=cost,
+                       latency=latency or 0, cache_hits=cache_hit, errors=1 - ok)
+
+    try:
+        connection = sqlite3.connect(config.database.path, timeout=10)
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO Usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        cursor.executemany('''
+            INSERT INTO UsageDaily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, user_id, mode, kind, provider, model) DO UPDATE SET
+            calls = calls + excluded.calls, tokens_in = tokens_in + excluded.tokens_in, tokens_out = tokens_out + excluded.tokens_out,
+            cached_tokens = cached_tokens + excluded.cached_tokens, cost = cost + excluded.cost, latency = latency + excluded.latency,
+            cache_hits = cache_hits + excluded.cache_hits, errors = errors + excluded.errors
+            ''', [key + tuple(counter[name] for name in ['calls', 'tokens_in', 'tokens_out', 'cached_tokens', 'cost', 'latency', 'cache_hits', 'errors'])
+                  for key, counter in rollup.items()])
+
+        today = utc_day()
+        if last_prune != today:
+            cursor.execute('DELETE FROM Usage WHERE time < ?', (time.time() - usage_retention_days * 86400, ))
+            last_prune = today
+        connection.commit()
+        connection.close()
+    except Exception as e:
+        logger.error(f'Usage flush error: {e}', exc_info=True)
+
+
+def usage_writer():
+    '''Background thread: writes the buffer every flush_interval seconds or as soon as it is full'''
+    while True:
+        flush_event.wait(flush_interval)
+        flush_event.clear()
+        flush_usage()
+
+
+def user_daily_usage(user_id: int) -> Counter:
+    '''Today's requests, tokens and cost of the user'''
+    day = utc_day()
+    with buffer_lock:
+        totals = daily_totals.get((user_id, day))
+    if totals is not None:
+        return totals
+
+    flush_usage()  # the buffered calls must be in UsageDaily before it is read
+    connection = sqlite3.connect(config.database.path, timeout=10)
+    rows = connection.execute('SELECT kind, cache_hits, calls, tokens_in + tokens_out, cost FROM UsageDaily WHERE day = ? AND user_id = ?', (day, user_id)).fetchall()
+    connection.close()
+
+    totals = Counter()
+    for kind, cache_hits, calls, tokens, cost in rows:
+        totals['requests'] += calls - cache_hits if is_request(kind, False) else 0
+        totals['tokens'] += tokens
+        totals['cost'] += cost
+
+    with buffer_lock:
+        for key in [key for key in daily_totals if key[1] != day]:  # yesterday's totals are not needed anymore
+            del daily_totals[key]
+        daily_totals[(user_id, day)] = totals
+    return totals
+
+
+def quota_exceeded(user_id: int, daily_tokens: int = 0, daily_requests: int = 0, daily_cost: float = 0) -> str | None:
+    '''Which daily quota the user has used up (0 = no limit), None if none'''
+    totals = user_daily_usage(user_id)
+    if daily_tokens and totals['tokens'] >= daily_tokens:
+        return f'tokens ({totals["tokens"]}/{daily_tokens})'
+    if daily_requests and totals['requests'] >= daily_requests:
+        return f'requests ({totals["requests"]}/{daily_requests})'
+    if daily_cost and totals['cost'] >= daily_cost:
+        return f'cost (${totals["cost"]:.3f}/${daily_cost})'
+    return None
+
+
+def usage_report(days: int = 1, top: int = 10) -> dict:
+    '''Totals by mode and the heaviest users over the last days (UTC)'''
+    flush_usage()
+    first_day = datetime.fromtimestamp(time.time() - (days - 1) * 86400, timezone.utc).strftime('%Y.%m.%d')
+    connection = sqlite3.connect(config.database.path, timeout=10)
+    modes = connection.execute('''SELECT mode, SUM(calls), SUM(tokens_in), SUM(tokens_out), ROUND(SUM(cost), 4), SUM(cache_hits), SUM(errors)
+                                  FROM UsageDaily WHERE day >= ? GROUP BY mode''', (first_day, )).fetchall()
+    users = connection.execute('''SELECT user_id, SUM(calls), SUM(tokens_in + tokens_out), ROUND(SUM(cost), 4), ROUND(SUM(latency) / SUM(calls), 2)
+                                  FROM UsageDaily WHERE day >= ? GROUP BY user_id ORDER BY SUM(cost) DESC, SUM(tokens_in + tokens_out) DESC LIMIT ?''', (first_day, top)).fetchall()
+    connection.close()
+    return {
+        'modes': {mode or 'none': {'calls': calls, 'tokens_in': tokens_in, 'tokens_out': tokens_out, 'cost': cost, 'cache_hits': cache_hits, 'errors': errors}
+                  for mode, calls, tokens_in, tokens_out, cost, cache_hits, errors in modes},
+        'users': {user_id: {'calls': calls, 'tokens': tokens, 'cost': cost, 'avg_latency': latency} for user_id, calls, tokens, cost, latency in users}
+    }
+
+
+usage_launch()
+threading.Thread(target=usage_writer, name='usage_writer', daemon=True).start()
+atexit.register(flush_usage)
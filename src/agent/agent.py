@@ -1,6 +1,14 @@
+import os
+import re
 import asyncio
+import inspect
 from typing import Literal
-from .llm.llm import llm_api
+from .llm.llm import async_llm_api, async_llm_api_tools, async_llm_stream
+from .router import local_select_tool
+from .cache import cache_key, cache_get, cache_set
+from .accounting import record_call
+from .single_flight import single_flight, single_flight_stats
+from .limits import get_limiter, limit, Hold
 from .tools.imdb import imdb_api
 from .tools.youtube import youtube_sum
 from .tools.latex import latex_expression_to_png
@@ -15,149 +23,368 @@ You can use all markdown features. If you write an expression in $$, it will tur
 To run the code, you must write it in ```python<code>``` and ask the user to click the button below the message to execute the. Only the first block of code will be executed. Available matplotlib. Write python code ONLY if this necessary. If you write a LaTeX document (in ```latex<document>```) you should also ask the user to compile it and he will get a pdf.'''
 
 
+# Limits for external services. max_concurrency is the capacity (tools take "cost" units of it), rate_limit is requests per second
+providers = {
+    'wolfram': {'max_concurrency': 6, 'rate_limit': 5},
+    'duckduckgo': {'max_concurrency': 3, 'rate_limit': 1},  # DuckDuckGo quickly answers with 429
+    'tavily': {'max_concurrency': 5, 'rate_limit': 5},
+    'codecogs': {'max_concurrency': 4, 'rate_limit': 5},
+    'imdb': {'max_concurrency': 3, 'rate_limit': 2},
+    'youtube': {'max_concurrency': 4, 'rate_limit': 2},
+    'e2b': {'max_concurrency': 2, 'rate_limit': None}
+}
+
+
+# Answers that are wrong a minute later are never cached (the "no_cache" pattern of the tool)
+time_query_pattern = re.compile(r'\b(time|date|today|tonight|now|current|clock|o\'clock|day of (the )?week|what day|timezone|utc|gmt)\b'
+                                r'|сейчас|время|врем[ея]ни|дата|дату|сегодня|котор\w* час|какое число|какой день', re.IGNORECASE)
+
 # TODO: funct that works with files
 functions = { 
     'wolfram_short_answer': {
         'function': wolfram_short_answer,
         'description': 'For complex calculations, solving difficult equations and up-to-date information (e.g., weather, exchange rates, today date, time and etc). Do not use for solving physics problems and etc',
-        'output_file': False
+        'providers': ['wolfram'],
+        'max_concurrency': 5,
+        'cost': 1,
+        'timeout': 30,
+        'output_file': False,
+        'cache_ttl': 10 * 60,  # weather and rates change quickly
+        'no_cache': time_query_pattern
     },
     'wolfram_full_answer': { 
         'function': wolfram_full_answer,
         'description': 'Full Wolfram Alpha answer with pictures and a lot of information',
-        'output_file': True
+        'providers': ['wolfram'],
+        'max_concurrency': 3,
+        'cost': 2,
+        'timeout': 60,
+        'output_file': True,
+        'cache_ttl': 10 * 60,
+        'no_cache': time_query_pattern
     },
     'google_short_answer': {
         'function': google_short_answer,
         'description': 'Use if you need to get revelant information from the internet. It\'s important to ask the question well (e. g "Who won on 2024 Olympic" -> "Which country won the most medals 2024 olympics")',
-        'output_file': False
-    }, # TODO: google_full_answer
+        'providers': ['duckduckgo', 'tavily'],
+        'max_concurrency': 5,
+        'cost': 1,
+        'timeout': 30,
+        'output_file': False,
+        'cache_ttl': 60 * 60
+    },
+    'google_full_answer': {
+        'function': google_full_answer,
+        'description': 'Reads several web pages on the query and writes a detailed answer from them. Slower than google_short_answer, use when a short answer is not enough (e.g. detailed explanations, comparisons, song lyrics)',
+        'providers': ['duckduckgo', 'tavily'],
+        'max_concurrency': 2,
+        'cost': 2,
+        'timeout': 60,
+        'output_file': False,
+        'cache_ttl': 60 * 60
+    },
     'google_image': {
         'function': google_image,
         'description': 'Pictures that pop up when you search. Use when the user asks to find a picture',
-        'output_file': True
+        'providers': ['duckduckgo'],
+        'max_concurrency': 3,
+        'cost': 1,
+        'timeout': 40,
+        'output_file': True,
+        'cache_ttl': 24 * 60 * 60
     },
     'youtube_sum': {   # TODO: ask que
         'function': youtube_sum,
         'description': 'Summarizes YouTube videos. Enter link in input',
-        'output_file': False
+        'providers': ['youtube'],
+        'max_concurrency': 3,
+        'cost': 2,
+        'timeout': 90,
+        'output_file': False,
+        'cache_ttl': 7 * 24 * 60 * 60,
+        'case_sensitive': True
     },
     'latex_expression_to_png': {
         'function': latex_expression_to_png,
         'description': 'Converts LaTeX expressions (what\'s in $$) to png. Enter only LaTeX expression in input. When user says compile this expression then use this tool. If the user asks to compile LaTeX code, then you don\'t need to use this tool.',
-        'output_file': True
+        'providers': ['codecogs'],
+        'max_concurrency': 4,
+        'cost': 1,
+        'timeout': 20,
+        'output_file': True,
+        'cache_ttl': 30 * 24 * 60 * 60,
+        'case_sensitive': True
     },
     'imdb_api': {
         'function': imdb_api,
         'description': 'Get information about movies and series. Recomended when user asks about movies. Enter movie name in input',
-        'output_file': True
+        'providers': ['imdb'],
+        'max_concurrency': 3,
+        'cost': 1,
+        'timeout': 30,
+        'output_file': True,
+        'cache_ttl': 3 * 24 * 60 * 60
     }
 }   # TODO: run python and latex code with this
 
-prompt_for_chatbot_assistant = 'You are the chatbot\'s assistant, in charge of choosing the right tool for each request. Available functions:\n\n'
-
-for items in functions.items():
-    prompt_for_chatbot_assistant += f'{items[0]}: {items[1]["description"]}\n'
+tool_use_prompt = """\n\nYou can call functions (tools). You can call multiple functions (unless the model herself is unable to answer), and you can call the same function multiple times, so don't be afraid to split questions into the same function. Don't forget to convert the queries (write them in English), and also avoid obscene queries in functions. You should not call functions during a normal conversation (or if the model can answer itself) - then just answer.
+USE TOOLS ONLY IF NECESSARY. If you see that, as in previous messages, function calls are ineffective (for example, you write the whole task in wolfram_short_answer and it doesn't understand you), then you don't need to continue calling functions. If you don't call anything, then that's okay."""
 
-prompt_for_chatbot_assistant += f"""\nAnswer in the following format:
-
-Thought: You should always think about what to do. What the user wants to see, what is the best tool to use and what inputs to use? Think only in English
-
-<function_name>: <function_input>
 
+def tools_schema() -> list[dict]:
+    '''Native function-calling schema for the functions registry. Each tool takes one string input'''
+    return [
+        {
+            'name': name,
+            'description': function['description'],
+            'parameters': {
+                'type': 'object',
+                'properties': {'input': {'type': 'string', 'description': 'Input for the function'}},
+                'required': ['input']
+            }
+        } for name, function in functions.items()
+    ]
 
-You can call multiple functions (unless the model herself is unable to answer), each time spelling out the names of the function and the query for it. You can call the same function multiple times, so don't be afraid to split questions into the same function. Don't forget to convert the queries, and also avoid obscene queries in functions. Use tools only when they are needed. You should not call functions during a normal conversation (or if the model can answer itself).
-USE TOOLS ONLY IF NECESSARY. If you see that, as in previous messages, function calls are ineffective (for example, you write the whole task in wolfram_short_answer and it doesn't understand you), then you don't need to continue calling functions. If you don't call anything, then that's okay.
 
-You'll be given a message history."""
+def with_tool_use_prompt(messages: list | str) -> list[dict]:
+    '''Copy of the messages with the system prompt and the tool use instructions at the beginning'''
+    if type(messages) == str:
+        messages = [{'role': 'user', 'content': messages}]
 
+    messages = [dict(message) for message in messages]
+    if messages[0]['role'] == 'system':
+        messages[0]['content'] += tool_use_prompt
+    else:
+        messages.insert(0, {'role': 'system', 'content': system_prompt + tool_use_prompt})
+    return messages
 
 
 # TODO: files to context, auto-translate
-def llm_select_tool(messages: list | str, files: list = [], provider: Literal['groq', 'google'] = 'groq') -> list:
-    # TODO: multiple arguments for a function
-    if type(messages) == list:
-        user_message = 'History:'+'\n'.join(f'{i["role"]}: {i["content"]}' for i in messages[:-1])
-        user_message += f'\nUser ask: {messages[-1]["content"]}'
-    else:
-        user_message = messages
+async def select_tools(messages: list | str, files: list = [], provider: Literal['groq', 'google'] = 'groq') -> tuple[str, list]:
+    '''One llm call with native function calling. Returns (answer, []) if no tools are needed, otherwise (answer_or_empty, tools)'''
+    if not files and type(messages) == list:  # obvious turns are decided locally
+        confident, tools = local_select_tool(messages[-1]['content'])
+        if confident and tools:
+            return '', tools
+        elif confident:
+            return await async_llm_api(messages=[dict(message) for message in messages], provider=provider), []
+
+    text, tool_calls = await async_llm_api_tools(messages=with_tool_use_prompt(messages), tools=tools_schema(), files=files, provider=provider)
 
-    message_history = [
-        {'role': 'system',
-         'content': prompt_for_chatbot_assistant},
-        {
-        'role': 'user',
-        'content': user_message
-        }
-    ]
-    llm_answer = llm_api(messages=message_history, files=files, provider=provider) + '\n'
-    answers = llm_answer.split('\n')
     tools = []
-    for answer in answers:
-        try:
-            func_name = answer.split(':')[0]
-            func_input = ':'.join(answer.split(':')[1:])
-        except Exception as e:
-            continue
-        
-        func_name = func_name.strip().lower()
+    for tool_call in tool_calls:
+        func_name = tool_call['func_name'].strip().lower()
         if func_name in functions:
-            tools.append({'func_name': func_name, 'func_input': func_input.strip()})
+            tools.append({'func_name': func_name, 'func_input': tool_call['func_input'].strip()})
+
+    logger.info(f'tools: {tools}, answer: {text}')
+    return text, tools
+
+
+def llm_answer_or_select_tool(messages: list | str, files: list = [], provider: Literal['groq', 'google'] = 'groq') -> tuple[str, list]:
+    return asyncio.run(select_tools(messages=messages, files=files, provider=provider))
 
-    logger.info(f'tools: {tools}, user_message: {user_message}')
+
+def llm_select_tool(messages: list | str, files: list = [], provider: Literal['groq', 'google'] = 'groq') -> list:
+    text, tools = llm_answer_or_select_tool(messages=messages, files=files, provider=provider)
     return tools
 
 
 
-async def execute_tool(func_name, func_input: str):
-    if asyncio.iscoroutinefunction(func_name):
-        return await func_name(func_input)
+turn_budget = 90  # seconds for all tools in one turn
+
+
+async def run_tool(function, func_input: str, timeout: float | None = None, hold: Hold | None = None):
+    '''Runs the function. The remaining time is passed to the function if it accepts "timeout".
+    hold - the limiter slots are kept until the thread of a sync function has really finished'''
+    kwargs = {'timeout': timeout} if timeout and 'timeout' in inspect.signature(function).parameters else {}
+    if asyncio.iscoroutinefunction(function):
+        coroutine = function(func_input, **kwargs)
     else:
-        return await asyncio.to_thread(func_name, func_input)
+        loop = asyncio.get_running_loop()
+        thread_done = loop.create_future()
+
+        def call():
+            try:
+                return function(func_input, **kwargs)
+            finally:
+                try:
+                    loop.call_soon_threadsafe(lambda: thread_done.done() or thread_done.set_result(None))
+                except RuntimeError:  # the loop is closed
+                    pass
+
+        if hold is not None:
+            hold.until(thread_done)
+        coroutine = asyncio.to_thread(call)  # the thread can't be killed, but nobody waits for it
+
+    return await asyncio.wait_for(coroutine, timeout=timeout)
+
+
+def provider_limiter(provider: str):
+    return get_limiter(provider, providers[provider]['max_concurrency'], providers[provider]['rate_limit'])
+
+
+async def limited_tool_call(func_name: str, func_input: str, timeout: float):
+    '''Waits in the queues of the tool and its providers, then runs the tool with the rest of the timeout'''
+    function = functions[func_name]
+    tool_limiters = [(get_limiter(func_name, function.get('max_concurrency', 4)), 1)]
+    tool_limiters += [(provider_limiter(provider), function.get('cost', 1)) for provider in function.get('providers', [])]
+
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    async with limit(func_name, tool_limiters) as hold:
+        return await run_tool(function['function'], func_input, max(timeout - (loop.time() - start_time), 0.1), hold)
+
+
+def tool_cache_key(func_name: str, func_input: str) -> str:
+    func_input = ' '.join(func_input.split())
+    if not functions[func_name].get('case_sensitive', False):
+        func_input = func_input.lower()
+    return cache_key(func_name, func_input)
+
+
+def split_tool_result(func_result) -> tuple[str, list]:
+    '''Tool result -> (text, files). Tools with output_file return (text, files)'''
+    if isinstance(func_result, (tuple, list)):
+        return func_result[0], list(func_result[1] or [])
+    return func_result, []
+
+
+async def execute_tool(func_name: str, func_input: str, timeout: float | None = None):
+    '''Runs the tool from the functions registry. Identical calls that are already running are joined instead of being sent again,
+    except for tools with output files: every handler deletes its files after sending them'''
+    if functions[func_name]['output_file']:
+        return await cached_tool_call(func_name, func_input, timeout)
+    return await single_flight('tool:' + tool_cache_key(func_name, func_input), cached_tool_call, func_name, func_input, timeout)
+
+
+async def cached_tool_call(func_name: str, func_input: str, timeout: float | None = None):
+    '''Runs the tool within min(timeout of the tool, timeout). Results are cached for the "cache_ttl" of the tool
+    unless the input matches its "no_cache" pattern. The call is accounted to the user'''
+    start = asyncio.get_running_loop().time()
+    ok, cache_hit = False, False
+    try:
+        func_result, cache_hit = await cached_tool_result(func_name, func_input, timeout)
+        ok = not str(split_tool_result(func_result)[0]).startswith('Error')
+        return func_result
+    finally:
+        record_call('tool', 'tool', func_name, latency=asyncio.get_running_loop().time() - start, cache_hit=cache_hit, ok=ok)
+
+
+async def cached_tool_result(func_name: str, func_input: str, timeout: float | None = None) -> tuple[object, bool]:
+    '''(tool result, whether it came from the cache)'''
+    function = functions[func_name]
+    timeout = min(function.get('timeout', turn_budget), timeout or turn_budget)
+    ttl = function.get('cache_ttl')
+    if not ttl or ('no_cache' in function and function['no_cache'].search(func_input)):
+        return await asyncio.wait_for(limited_tool_call(func_name, func_input, timeout), timeout=timeout), False
+
+    key = tool_cache_key(func_name, func_input)
+    found, value, files = await asyncio.to_thread(cache_get, 'tool', key)
+    if found:
+        logger.info(f'cache hit: {func_name}({func_input})')
+        return ((value['text'], value['links'] + files) if function['output_file'] else value['text']), True
+
+    func_result = await asyncio.wait_for(limited_tool_call(func_name, func_input, timeout), timeout=timeout)
+    text, files = split_tool_result(func_result)
+    if text is not None and not str(text).startswith('Error'):
+        local_files = [file for file in files if file and os.path.exists(file)]
+        links = [file for file in files if file and file not in local_files]  # e.g. image links from wolfram
+        try:
+            await asyncio.to_thread(cache_set, 'tool', key, {'text': text, 'links': links}, ttl, local_files)
+        except Exception as e:
+            logger.error(f'cache error {func_name}({func_input}): {e}', exc_info=True)
 
+    return func_result, False
+
+
+async def llm_use_tool(tools: list[dict], deadline: float | None = None) -> tuple[str, list]:
+    '''Runs tools concurrently until the deadline (loop.time()). Tools that did not finish in time are cancelled and noted in the result'''
+    loop = asyncio.get_running_loop()
+    if deadline is None:
+        deadline = loop.time() + turn_budget
+    remaining = max(deadline - loop.time(), 0.1)
+
+    unique_tools = {}  # the same call in one batch is executed once
+    for tool in tools:
+        key = tool_cache_key(tool['func_name'], tool['func_input'])
+        if key in unique_tools:
+            single_flight_stats['batch_saved'] += 1
+        else:
+            unique_tools[key] = tool
+    tools = list(unique_tools.values())
 
-async def llm_use_tool(tools: list[dict]) -> tuple[str, list]:
-    
     tasks = [
-        execute_tool(functions[tool['func_name']]['function'], tool['func_input']) for tool in tools
+        asyncio.create_task(execute_tool(tool['func_name'], tool['func_input'], timeout=remaining)) for tool in tools
     ]
-
-    results = await asyncio.gather(*tasks)
+    done, pending = await asyncio.wait(tasks, timeout=remaining)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
 
     str_results = []
     images = []
-    for i, func_result in enumerate(results):
-        if type(func_result) in [str, None]:
-            str_results.append(f"{tools[i]['func_name']}({tools[i]['func_input']}): {func_result}")
-        else:
-            str_results.append(f"{tools[i]['func_name']}({tools[i]['func_input']}): {func_result[0]}")
-            images.extend(func_result[1])
+    timed_out = []
+    for tool, task in zip(tools, tasks):
+        call = f"{tool['func_name']}({tool['func_input']})"
+        if task in pending or isinstance(task.exception(), asyncio.TimeoutError):
+            timed_out.append(call)
+            continue
+        if task.exception():
+            logger.error(f'{call}: {task.exception()}', exc_info=task.exception())
+            str_results.append(f'{call}: Error {task.exception()}')
+            continue
+
+        text, files = split_tool_result(task.result())
+        str_results.append(f'{call}: {text}')
+        images.extend(files)
+
+    if timed_out:
+        str_results.append(f'These tools did not answer in time, there is no result from them (tell the user if it matters): {", ".join(timed_out)}')
 
     result = '\n'.join(str_results)
-    logger.info(f'{result}, {images}')
+    logger.info(f'{result}, {images}, timed out: {timed_out}')
 
     return result, images
 
-# TODO: FILES
-def llm_full_answer(messages: list, files: list = [], provider: Literal['groq', 'google'] = 'groq') -> str:
+def with_tool_result(messages: list, tool_result: str = '') -> list[dict]:
+    '''Copy of the messages with the tool result (if any) at the end'''
+    messages = [dict(message) for message in messages]
+    if tool_result:
+        messages.append({'role': 'system', 'content': 'tool result:\n' + tool_result})
+    return messages
+
 
-    tools = llm_select_tool(messages=messages)
-    tool_result, images = asyncio.run(llm_use_tool(tools=tools))
+async def answer(messages: list, files: list = [], provider: Literal['groq', 'google'] = 'groq', tool_result: str = '') -> str:
+    '''Final answer. The tool result (if any) is added to the end of the messages'''
+    return await async_llm_api(messages=with_tool_result(messages, tool_result), files=files, provider=provider)
 
 
+def answer_stream(messages: list, files: list = [], provider: Literal['groq', 'google'] = 'groq', tool_result: str = ''):
+    '''Same as answer, but yields the text in pieces as it is generated'''
+    return async_llm_stream(messages=with_tool_result(messages, tool_result), files=files, provider=provider)
+
+
+# TODO: FILES
+async def full_answer(messages: list | str, files: list = [], provider: Literal['groq', 'google'] = 'groq', deadline: float | None = None) -> tuple[str, list]:
+    '''select_tools -> llm_use_tool -> answer. Returns (answer, output files)'''
     if type(messages) == str:
-        user_message = messages
-        messages = [{'role': 'system', 'content': system_prompt},
-                    {'role': 'user', 'content': user_message}]
-    else:
-        messages.insert(0, {'role': 'system', 'content': system_prompt})
+        messages = [{'role': 'user', 'content': messages}]
+    if messages[0]['role'] != 'system':
+        messages = [{'role': 'system', 'content': system_prompt}] + messages
+
+    text, tools = await select_tools(messages=messages, files=files, provider=provider)
+    if not tools:
+        return text, []
 
-    if bool(tool_result) + bool(images):
-        messages.append({'role': 'assistant', 'content': 'tool result:\n' + tool_result})
-        
-    answer = llm_api(messages=messages, files=files, provider=provider)
+    tool_result, images = await llm_use_tool(tools=tools, deadline=deadline)
+    text = await answer(messages=messages, files=files, provider=provider, tool_result=tool_result)
 
-    logger.info(f'answer: {answer}, tool: {tool_result}, images: {images}')
+    logger.info(f'answer: {text}, tool: {tool_result}, images: {images}')
+    return text, images
 
-    return answer
 
+def llm_full_answer(messages: list | str, files: list = [], provider: Literal['groq', 'google'] = 'groq') -> str:
+    text, images = asyncio.run(full_answer(messages=messages, files=files, provider=provider))
+    return text
@@ -0,0 +1,133 @@
+'''Persistent key-value cache with TTL (sqlite). Used for tool results and llm responses'''
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+from hashlib import sha256
+from collections import Counter, defaultdict
+from ..config.logger import logger
+from ..config.config import load_config
+
+
+config = load_config()
+
+cache_counters: defaultdict[str, Counter] = defaultdict(Counter)  # namespace -> hits, misses, sets, evictions
+
+
+def cache_key(*args) -> str:
+    return sha256(json.dumps(args, ensure_ascii=False, sort_keys=True).encode()).hexdigest()[:32]
+
+
+def cache_launch():
+    '''Creates the cache table and the directory for cached files if they do not exist'''
+    os.makedirs(config.database.cache_files_dir, exist_ok=True)
+    connection = sqlite3.connect(config.database.cache_path)
+    cursor = connection.cursor()
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Cache (
+        namespace TEXT,
+        key TEXT,
+        value TEXT,
+        files TEXT,
+        created REAL,
+        expires REAL,
+        PRIMARY KEY (namespace, key)
+        )
+        ''')
+
+    connection.commit()
+    connection.close()
+
+
+def remove_cached_files(files: list[str]):
+    for file in files:
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+
+def cache_get(namespace: str, key: str) -> tuple[bool, object, list[str]]:
+    '''Returns (found, value, files). Files are uniquely named copies of the cached files in the working directory'''
+    connection = sqlite3.connect(config.database.cache_path, timeout=10)
+    cursor = connection.cursor()
+    row = cursor.execute('SELECT value, files, expires FROM Cache WHERE namespace = ? AND key = ?', (namespace, key)).fetchone()
+
+    if row is not None and row[2] < time.time():
+        cursor.execute('DELETE FROM Cache WHERE namespace = ? AND key = ?', (namespace, key))
+        connection.commit()
+        remove_cached_files(json.loads(row[1]))
+        row = None
+    connection.close()
+
+    cached_files = json.loads(row[1]) if row else []
+    if row is None or not all(os.path.exists(file) for file in cached_files):
+        cache_counters[namespace]['misses'] += 1
+        return False, None, []
+
+    files = []
+    for file in cached_files:  # the caller deletes the files after use, so every hit gets its own copy
+        file_name = f'{uuid.uuid4().hex[:12]}_{os.path.basename(file).split("_", 1)[-1]}'
+        shutil.copyfile(file, file_name)
+        files.append(file_name)
+
+    cache_counters[namespace]['hits'] += 1
+    return True, json.loads(row[0]), files
+
+
+def evict(cursor: sqlite3.Cursor, namespace: str, max_entries: int) -> int:
+    '''Deletes expired entries of the namespace, then the oldest ones above max_entries. Returns the number of deleted entries'''
+    rows = cursor.execute('SELECT key, files FROM Cache WHERE namespace = ? AND expires < ?', (namespace, time.time())).fetchall()
+    rows += cursor.execute('SELECT key, files FROM Cache WHERE namespace = ? AND expires >= ? ORDER BY created DESC LIMIT -1 OFFSET ?',
+                           (namespace, time.time(), max_entries)).fetchall()
+    for key, files in rows:
+        cursor.execute('DELETE FROM Cache WHERE namespace = ? AND key = ?', (namespace, key))
+        remove_cached_files(json.loads(files))
+    return len(rows)
+
+
+def cache_set(namespace: str, key: str, value, ttl: int, files: list[str] = [], max_entries: int | None = None):
+    '''Saves the value (json serializable) and copies of the files for ttl seconds. With max_entries the oldest entries of the namespace are evicted'''
+    cached_files = []
+    for i, file in enumerate(files):
+        cached_file = os.path.join(config.database.cache_files_dir, f'{key}{i}_{os.path.basename(file)}')
+        shutil.copyfile(file, cached_file)
+        cached_files.append(cached_file)
+
+    now = time.time()
+    connection = sqlite3.connect(config.database.cache_path, timeout=10)
+    cursor = connection.cursor()
+    cursor.execute('INSERT OR REPLACE INTO Cache (namespace, key, value, files, created, expires) VALUES (?, ?, ?, ?, ?, ?)',
+                   (namespace, key, json.dumps(value, ensure_ascii=False), json.dumps(cached_files), now, now + ttl))
+    evicted = evict(cursor, namespace, max_entries) if max_entries else 0
+    connection.commit()
+    connection.close()
+    cache_counters[namespace]['sets'] += 1
+    cache_counters[namespace]['evictions'] += evicted
+
+
+def cache_stats() -> dict[str, dict]:
+    '''Hits, misses, hit rate, evictions and number of stored entries for each namespace'''
+    connection = sqlite3.connect(config.database.cache_path, timeout=10)
+    entries = dict(connection.execute('SELECT namespace, COUNT(*) FROM Cache GROUP BY namespace').fetchall())
+    connection.close()
+
+    stats = {}
+    for namespace in set(entries) | set(cache_counters):
+        counter = cache_counters[namespace]
+        requests = counter['hits'] + counter['misses']
+        stats[namespace] = {
+            'hits': counter['hits'],
+            'misses': counter['misses'],
+            'hit_rate': round(counter['hits'] / requests, 3) if requests else 0,
+            'evictions': counter['evictions'],
+            'entries': entries.get(namespace, 0)
+        }
+    logger.info(stats)
+    return stats
+
+
+cache_launch()
@@ -0,0 +1,90 @@
+'''Token-budgeted context builder: the history that goes to the llm never exceeds the budget of the model'''
+import re
+import math
+from ..config.logger import logger
+
+
+# Token budgets for the whole prompt (history + new message). Much less than the context windows - it is about latency and cost
+context_budgets = {
+    'gemini-2.5-flash': 24000,
+    'gemini-2.5-pro': 32000,
+    'gemini-2.5-flash-lite': 16000,
+    'openai/gpt-oss-120b': 16000,
+    'openai/gpt-oss-20b': 12000,
+    'groq/compound': 8000,
+    'groq/compound-mini': 8000
+}
+default_budget = 16000
+# Caps for every message except the newest one. They don't depend on the position of the message,
+# so an old message is always cut the same way and the prompt prefix stays the same between turns (provider prompt caching)
+tool_output_max_tokens = 1500
+message_max_tokens = 2000
+
+token_pattern = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+
+def count_tokens(text: str) -> int:
+    '''Local token estimate: ~4 characters per token for latin words, ~2.5 for others (e.g. cyrillic), 1 per punctuation mark'''
+    tokens = 0
+    for token in token_pattern.findall(str(text)):
+        if token.isascii():
+            tokens += math.ceil(len(token) / 4)
+        else:
+            tokens += math.ceil(len(token) / 2.5)
+    return tokens
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    '''Keeps the beginning and the end of the text'''
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+
+    chars = int(len(text) * max_tokens / tokens * 0.95)  # the estimate is not exact, leave some room
+    head, tail = text[:chars * 2 // 3], text[len(text) - chars // 3:]
+    return f'{head}\n[... {tokens - max_tokens} tokens omitted ...]\n{tail}'
+
+
+def is_tool_output(message: dict) -> bool:
+    return message['role'] == 'system' and message['content'].startswith('tool result')
+
+
+def build_context(messages: list[dict], model: str, budget: int | None = None) -> list[dict]:
+    '''Fills the budget from the newest message to the oldest. The leading system prompt and the last message are always kept (truncated if needed).
+    Older messages are dropped whole when they don't fit. Messages may have a cached "tokens" count. Returns [{'role': ..., 'content': ...}, ...]'''
+    budget = budget or context_budgets.get(model, default_budget)
+    if not messages:
+        return []
+
+    pinned = messages[0] if messages[0]['role'] == 'system' and len(messages) > 1 else None
+    history = messages[1:] if pinned else messages
+    if pinned:
+        budget -= count_tokens(pinned['content'])
+
+    context = []
+    used = 0
+    for i, message in enumerate(reversed(history)):
+        content = message['content']
+        tokens = message.get('tokens') or count_tokens(content)
+
+        if i == 0:
+            max_tokens = max(budget, 200)
+        else:
+            max_tokens = tool_output_max_tokens if is_tool_output(message) else message_max_tokens
+
+        if tokens > max_tokens:
+            content = truncate_text(content, max_tokens)
+            tokens = count_tokens(content)
+
+        if i > 0 and used + tokens > budget:  # no room left for the older messages
+            break
+
+        context.append({'role': message['role'], 'content': content})
+        used += tokens
+
+    context.reverse()
+    if pinned:
+        context.insert(0, {'role': pinned['role'], 'content': pinned['content']})
+
+    logger.info(f'model: {model}, messages: {len(context)}/{len(messages)}, tokens: {used}/{budget}')
+    return context
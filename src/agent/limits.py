@@ -0,0 +1,134 @@
+'''Concurrency and rate limits for tools and providers with FIFO (fair) queues'''
+import asyncio
+from time import monotonic
+from collections import deque, defaultdict, Counter
+from contextlib import asynccontextmanager
+from ..config.logger import logger
+
+
+class Limiter:
+    '''Weighted FIFO semaphore with an optional rate limit (starts per second).
+    Waiters are served strictly in order, so heavy calls are not starved by light ones'''
+
+    def __init__(self, name: str, capacity: int, rate_limit: float | None = None):
+        self.name = name
+        self.capacity = capacity
+        self.available = capacity
+        self.rate_limit = rate_limit
+        self.next_start = 0.0
+        self.queue = deque()
+
+    def wake(self):
+        while self.queue and self.queue[0][0] <= self.available:
+            weight, future = self.queue.popleft()
+            if future.done():
+                continue
+            self.available -= weight
+            future.set_result(None)
+
+    def release(self, weight: int):
+        self.available += min(weight, self.capacity)
+        self.wake()
+
+    async def acquire(self, weight: int = 1):
+        weight = min(weight, self.capacity)
+        if self.queue or self.available < weight:
+            future = asyncio.get_running_loop().create_future()
+            entry = (weight, future)
+            self.queue.append(entry)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():  # the slot was given while being cancelled
+                    self.release(weight)
+                else:
+                    if entry in self.queue:  # wake() may have already dropped the cancelled entry
+                        self.queue.remove(entry)
+                    self.wake()
+                raise
+        else:
+            self.available -= weight
+
+        if self.rate_limit:
+            loop = asyncio.get_running_loop()
+            start = max(loop.time(), self.next_start)
+            self.next_start = start + 1 / self.rate_limit
+            try:
+                await asyncio.sleep(start - loop.time())
+            except asyncio.CancelledError:
+                self.release(weight)
+                raise
+
+
+class Hold:
+    '''Yielded by limit(). until(future) keeps the slots after the with block until the future is done
+    (e.g. a worker thread that keeps calling the provider after its caller timed out)'''
+
+    def __init__(self):
+        self.future = None
+
+    def until(self, future: asyncio.Future):
+        self.future = future
+
+
+limiters: dict[str, Limiter] = {}
+queue_stats = defaultdict(Counter)  # name -> calls, waiting, max_waiting, wait_time (seconds)
+
+
+def get_limiter(name: str, capacity: int, rate_limit: float | None = None) -> Limiter:
+    if name not in limiters:
+        limiters[name] = Limiter(name, capacity, rate_limit)
+    return limiters[name]
+
+
+@asynccontextmanager
+async def limit(name: str, limiters_to_acquire: list[tuple[Limiter, int]]):
+    '''Acquires all (limiter, weight) pairs (always in the same order, so there are no deadlocks) and records queue depth and wait time for name'''
+    limiters_to_acquire = sorted(limiters_to_acquire, key=lambda item: item[0].name)
+    stats = queue_stats[name]
+    stats['calls'] += 1
+    stats['waiting'] += 1
+    stats['max_waiting'] = max(stats['max_waiting'], stats['waiting'])
+    start_time = monotonic()
+
+    acquired = []
+    try:
+        for limiter, weight in limiters_to_acquire:
+            await limiter.acquire(weight)
+            acquired.append((limiter, weight))
+    except BaseException:
+        for limiter, weight in acquired:
+            limiter.release(weight)
+        raise
+    finally:
+        stats['waiting'] -= 1
+        stats['wait_time'] += monotonic() - start_time
+
+    wait_time = monotonic() - start_time
+    if wait_time > 1:
+        logger.warning(f'{name} waited {wait_time:.2f} s in the queue')
+
+    def release(_=None):
+        for limiter, weight in acquired:
+            limiter.release(weight)
+
+    hold = Hold()
+    try:
+        yield hold
+    finally:
+        if hold.future is not None and not hold.future.done():
+            hold.future.add_done_callback(release)
+        else:
+            release()
+
+
+def limits_stats() -> dict[str, dict]:
+    '''Queue depth and wait time for each tool'''
+    return {
+        name: {
+            'calls': stats['calls'],
+            'waiting': stats['waiting'],
+            'max_waiting': stats['max_waiting'],
+            'avg_wait': round(stats['wait_time'] / stats['calls'], 3) if stats['calls'] else 0
+        } for name, stats in queue_stats.items()
+    }
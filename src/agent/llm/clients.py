@@ -0,0 +1,48 @@
+'''Shared llm clients: one keep-alive connection pool per provider for the whole process and one client per key on top of it.
+The SDKs are imported and the clients are created on first use'''
+import asyncio
+import weakref
+from functools import lru_cache
+from ..limits import get_limiter
+from ...config.config import load_config
+
+
+config = load_config()
+groq_api_keys = config.api.groq_key
+groq_headers = {"Groq-Model-Version": "latest"}
+
+http_limits = {'max_connections': 32, 'max_keepalive_connections': 16, 'keepalive_expiry': 60}
+http_timeout = {'timeout': 120, 'connect': 10}
+
+# Requests in flight per provider (the rest wait in the FIFO queue)
+llm_providers = {
+    'groq': {'max_concurrency': 16, 'rate_limit': None},
+    'google': {'max_concurrency': 8, 'rate_limit': None}
+}
+
+# Async connections belong to the event loop they were opened in, so the pool is per loop (the bot has one)
+async_groq_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+@lru_cache(maxsize=None)
+def get_groq_client() -> list:
+    '''Sync Groq clients (chat and whisper, one per key) sharing one connection pool. Several keys help with rate limiting'''
+    import httpx
+    from groq import Groq
+    http_client = httpx.Client(limits=httpx.Limits(**http_limits), timeout=httpx.Timeout(**http_timeout))
+    return [Groq(api_key=key, default_headers=groq_headers, http_client=http_client) for key in groq_api_keys]
+
+
+def get_async_groq_client() -> list:
+    '''Async Groq clients (one per key) of the running event loop with a shared keep-alive pool'''
+    loop = asyncio.get_running_loop()
+    if loop not in async_groq_clients:
+        import httpx
+        from groq import AsyncGroq
+        async_http_client = httpx.AsyncClient(limits=httpx.Limits(**http_limits), timeout=httpx.Timeout(**http_timeout))
+        async_groq_clients[loop] = [AsyncGroq(api_key=key, default_headers=groq_headers, http_client=async_http_client) for key in groq_api_keys]
+    return async_groq_clients[loop]
+
+
+def llm_limiter(provider: str):
+    return get_limiter(f'{provider}_llm', llm_providers[provider]['max_concurrency'], llm_providers[provider]['rate_limit'])
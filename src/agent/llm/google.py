@@ -1,58 +1,416 @@
 import os
-import PIL.Image
-from typing import Literal
-from google import genai, generativeai
-from ..tools.file_utils import files_to_text
+import json
+import asyncio
+import hashlib
+import threading
+from time import monotonic
+from typing import Literal, TYPE_CHECKING
+from datetime import timedelta
+from functools import lru_cache
+from collections import OrderedDict, Counter
+from .usage import record_usage
+from .clients import llm_limiter
+from ..limits import limit
+from ..context import count_tokens, context_budgets, default_budget
+from ..tools.file_utils import files_to_text, prepare_image
+from ..passages import select_passages, passage_budgets
 from ...config.config import load_config
 from ...config.logger import logger
 
 
+if TYPE_CHECKING:
+    from google.generativeai import GenerativeModel, caching
+
+
 config = load_config()
 
-os.environ["GOOGLE_API_KEY"] = config.api.gemini_key
-os.environ['GRPC_DNS_RESOLVER'] = 'native'
-generativeai.configure(api_key=os.environ['GOOGLE_API_KEY'])
+google_models = ["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"]
+
+
+@lru_cache(maxsize=None)
+def gemini_sdk():
+    '''google.generativeai is heavy (about a second), so it is imported and configured on the first request'''
+    os.environ["GOOGLE_API_KEY"] = config.api.gemini_key
+    os.environ['GRPC_DNS_RESOLVER'] = 'native'
+    from google import generativeai
+    import google.generativeai.caching
+    generativeai.configure(api_key=os.environ['GOOGLE_API_KEY'])
+    return generativeai
+
+
+@lru_cache(maxsize=None)
+def get_genai_client():
+    from google import genai
+    gemini_sdk()
+    return genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+
+# Explicit context caching: the shared prefix of every request (system instruction + tool declarations) is stored on the google side
+# and billed/processed as cached tokens. The history is not cached explicitly (it is different for every user, implicit caching covers it).
+# A cache is created in the background the first time a long enough prefix is seen, requests don't wait for it
+context_cache_min_tokens = {'gemini-2.5-flash': 1024, 'gemini-2.5-flash-lite': 1024, 'gemini-2.5-pro': 4096}
+context_cache_ttl = timedelta(minutes=60)
+context_cache_max_entries = 16
+context_caches: OrderedDict[str, tuple['caching.CachedContent', float]] = OrderedDict()  # prefix key -> (cache, expires (monotonic))
+context_caches_pending: set[str] = set()  # prefixes whose cache is being created
+context_cache_failures: dict[tuple[str, str], tuple[int, float]] = {}  # (prefix key, api key) -> (failures in a row, retry after (monotonic))
+context_cache_backoff = (5 * 60, 6 * 60 * 60)  # the first and the longest pause after a failed create (e.g. free tier keys can't cache)
+context_caches_lock = threading.Lock()
+
+# Per-user chat sessions: the chat of a user is kept between messages and only the new turn is added to it.
+# The session is rebuilt from the history when it was evicted, the model or the system prompt changed,
+# the history doesn't end with the last turn of the session (e.g. after /clear) or it outgrew the context budget of the model
+session_max_entries = 256
+session_idle_ttl = 20 * 60
+session_stats = Counter()  # hits, misses, rebuilt, expired, evicted
+
 
-google_models = {
-    "gemini-2.5-flash": generativeai.GenerativeModel("gemini-2.5-flash"),
-    "gemini-2.5-pro": generativeai.GenerativeModel("gemini-2.5-pro"),
-    "gemini-2.5-flash-lite": generativeai.GenerativeModel("gemini-2.5-flash-lite")
-}
-google_model_flash = generativeai.GenerativeModel("gemini-2.5-flash")
+class ChatSession:
+    def __init__(self, chat, model: str, system_instruction: str | None, tokens: int, expires: float):
+        self.chat = chat
+        self.model = model
+        self.system_instruction = system_instruction
+        self.tokens = tokens  # of the whole chat history
+        self.expires = expires  # monotonic; never later than the context cache the chat is built on
+        self.last_turn = None  # turn_key of the last user message and answer
+        self.pending = None  # (user message, has files) of the turn in flight
+        self.busy = False
 
-client = genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
 
+chat_sessions: OrderedDict[int, ChatSession] = OrderedDict()  # session id (user id) -> session, least recently used first
+sessions_lock = threading.RLock()  # prepare_chat runs in worker threads, end_turn on the event loop
 
-def genai_api(messages: list[dict] | str, files: list | str = [], model: Literal["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"] = "gemini-2.5-flash") -> str:
+
+def format_history(messages: list[dict] | str) -> tuple[str, list[dict], str | None]:
+    '''Splits messages into the last user message, the history in the gemini format and the system instruction (leading system message)'''
     if type(messages) == str:
-        user_message = messages
-        formatted_history = []
-
-    else:  # google is a bit special and to keep everything in the same style I do the transformation here.
-        user_message = messages[-1]['content']
-        history = messages[:-1]
-
-        formatted_history = []
-        for message in history:
-            role = 'user' if message['role'] in ['user', 'system'] else 'model' 
-            content = message['content']
-            formatted_history.append({"role": role, "parts": content})
-
-    google_model = google_models.get(model, google_model_flash)
-    chat = google_model.start_chat(history=formatted_history)
-    
-    image_files = []
+        return messages, [], None
+
+    system_instruction = None
+    if len(messages) > 1 and messages[0]['role'] == 'system':
+        system_instruction = messages[0]['content']
+        messages = messages[1:]
+
+    # google is a bit special and to keep everything in the same style I do the transformation here.
+    user_message = messages[-1]['content']
+    formatted_history = []
+    for message in messages[:-1]:
+        role = 'user' if message['role'] in ['user', 'system'] else 'model'
+        formatted_history.append({"role": role, "parts": message['content']})
+
+    return user_message, formatted_history, system_instruction
+
+
+@lru_cache(maxsize=32)
+def get_model(model: str, system_instruction: str | None = None) -> 'GenerativeModel':
+    '''The same system prompt is always sent as system_instruction of the same model object, so the request prefix is stable'''
+    return gemini_sdk().GenerativeModel(model if model in google_models else "gemini-2.5-flash", system_instruction=system_instruction)
+
+
+def prefix_key(model: str, system_instruction: str | None, tools: list | None) -> str:
+    return hashlib.sha256(json.dumps([model, system_instruction, tools], ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+
+def find_context_cache(key: str) -> 'caching.CachedContent | None':
+    with context_caches_lock:
+        entry = context_caches.get(key)
+        if entry is None:
+            return None
+        cache, expires = entry
+        if expires <= monotonic():
+            del context_caches[key]
+            return None
+        context_caches.move_to_end(key)
+        return cache
+
+
+def create_context_cache(key: str, model: str, system_instruction: str | None, tools: list | None):
+    '''Runs in a background thread'''
+    try:
+        cache = gemini_sdk().caching.CachedContent.create(
+            model=f'models/{model}',
+            system_instruction=system_instruction,
+            tools=tools,
+            ttl=context_cache_ttl
+        )
+    except Exception as e:
+        with context_caches_lock:
+            failures = context_cache_failures.get((key, config.api.gemini_key), (0, 0))[0] + 1
+            pause = min(context_cache_backoff[0] * 2 ** (failures - 1), context_cache_backoff[1])
+            context_cache_failures[(key, config.api.gemini_key)] = (failures, monotonic() + pause)
+        logger.error(f'Context cache error ({failures} in a row, next try in {pause} s): {e}', exc_info=True)
+        return
+    finally:
+        with context_caches_lock:
+            context_caches_pending.discard(key)
+
+    evicted = []
+    with context_caches_lock:
+        context_cache_failures.pop((key, config.api.gemini_key), None)
+        context_caches[key] = (cache, monotonic() + context_cache_ttl.total_seconds() - 60)  # a minute of margin so the cache doesn't expire mid-request
+        while len(context_caches) > context_cache_max_entries:
+            evicted.append(context_caches.popitem(last=False)[1][0])
+    for old_cache in evicted:
+        try:
+            old_cache.delete()
+        except Exception as e:
+            logger.warning(f'Context cache delete error: {e}')
+
+    logger.info(f'Context cache created: {cache.name}, model: {model}')
+
+
+def cached_model(model: str, system_instruction: str | None, tools: list | None, history: list[dict]) -> tuple['GenerativeModel | None', list[dict]]:
+    '''GenerativeModel over the cached shared prefix (system instruction + tools) and the history to send.
+    Starts creating the cache in the background when the prefix is long enough (not again until the backoff after a failure is over).
+    Returns (None, history) when there is no cache (yet)'''
+    min_tokens = context_cache_min_tokens.get(model)
+    if min_tokens is None:
+        return None, history
+
+    key = prefix_key(model, system_instruction, tools)
+    cache = find_context_cache(key)
+    if cache is None:
+        if count_tokens(system_instruction or '') + count_tokens(json.dumps(tools or [])) >= min_tokens:
+            with context_caches_lock:
+                failed = context_cache_failures.get((key, config.api.gemini_key))
+                start = key not in context_caches_pending and (failed is None or failed[1] <= monotonic())
+                if start:
+                    context_caches_pending.add(key)
+            if start:
+                threading.Thread(target=create_context_cache, args=(key, model, system_instruction, tools), daemon=True).start()
+        return None, history
+    return gemini_sdk().GenerativeModel.from_cached_content(cached_content=cache), history
+
+
+def turn_key(history: list[dict]) -> str | None:
+    '''Identifies the last turn (user message + answer) of the gemini history'''
+    if len(history) < 2 or history[-2]['role'] != 'user' or history[-1]['role'] != 'model':
+        return None
+    return hashlib.sha256(json.dumps(history[-2:], ensure_ascii=False).encode()).hexdigest()
+
+
+def context_cache_expiry(google_model) -> float:
+    '''When the context cache the model is built on expires (inf for a model without one)'''
+    name = getattr(google_model, 'cached_content', None)
+    with context_caches_lock:
+        for cache, expires in context_caches.values():
+            if name and cache.name == name:
+                return expires
+    return float('inf')
+
+
+def evict_sessions():
+    '''Called with sessions_lock held'''
+    now = monotonic()
+    for session_id in [session_id for session_id, session in chat_sessions.items() if session.expires <= now and not session.busy]:
+        del chat_sessions[session_id]
+        session_stats['expired'] += 1
+    while len(chat_sessions) > session_max_entries:
+        chat_sessions.popitem(last=False)
+        session_stats['evicted'] += 1
+
+
+def open_session(session_id: int, model: str, system_instruction: str | None, history: list[dict], user_message: str, has_files: bool) -> ChatSession | None:
+    '''The live session of the user if the history continues it. The session is marked busy with the pending turn'''
+    with sessions_lock:
+        evict_sessions()
+        session = chat_sessions.get(session_id)
+        if session is None:
+            session_stats['misses'] += 1
+            return None
+
+        budget = context_budgets.get(model, default_budget)
+        if session.busy or session.model != model or session.system_instruction != system_instruction \
+                or session.last_turn is None or session.last_turn != turn_key(history) or session.tokens + count_tokens(user_message) > budget:
+            if not session.busy:
+                del chat_sessions[session_id]
+            session_stats['rebuilt'] += 1
+            return None
+
+        chat_sessions.move_to_end(session_id)
+        session_stats['hits'] += 1
+        session.busy, session.pending = True, (user_message, has_files)
+        return session
+
+
+def add_session(session_id: int, session: ChatSession, user_message: str, has_files: bool) -> bool:
+    '''Saves the new session (busy with the pending turn) unless another request of the user created one meanwhile'''
+    with sessions_lock:
+        if session_id in chat_sessions:
+            return False
+        session.busy, session.pending = True, (user_message, has_files)
+        chat_sessions[session_id] = session
+        return True
+
+
+def end_turn(session_id: int | None, chat, answer: str | None):
+    '''Called after the request: the turn becomes the last turn of the session. A failed turn (answer None) or a turn with files
+    (the chat would carry them, the saved history would not) drops the session'''
+    with sessions_lock:
+        session = chat_sessions.get(session_id)
+        if session is None or session.chat is not chat:
+            return
+        user_message, has_files = session.pending
+        session.busy = False
+        if answer is None or has_files:
+            del chat_sessions[session_id]
+            return
+        session.last_turn = turn_key([{'role': 'user', 'parts': user_message}, {'role': 'model', 'parts': answer}])
+        session.tokens += count_tokens(user_message) + count_tokens(answer)
+        session.expires = min(monotonic() + session_idle_ttl, context_cache_expiry(chat.model))
+
+
+def session_report() -> dict:
+    with sessions_lock:
+        return {**session_stats, 'sessions': len(chat_sessions)}
+
+
+def to_gemini_schema(schema: dict) -> dict:
+    '''OpenAI-style JSON schema -> gemini schema (types in upper case)'''
+    result = {}
+    for key, value in schema.items():
+        if key == 'type':
+            result[key] = value.upper()
+        elif key == 'properties':
+            result[key] = {name: to_gemini_schema(prop) for name, prop in value.items()}
+        else:
+            result[key] = value
+    return result
+
+
+def prepare_chat(messages: list[dict] | str, files: list | str = [], model: str = "gemini-2.5-flash", tools: list | None = None, session_id: int | None = None):
+    '''Returns the chat with the history, the content of the new message (text + images) and the tools to send with the request
+    (None when they are already in the context cache). With session_id the chat of the user's session is reused if the history continues it
+    (end_turn must be called after the request)'''
+    user_message, formatted_history, system_instruction = format_history(messages)
+
+    session = open_session(session_id, model, system_instruction, formatted_history, user_message, bool(files)) if session_id is not None else None
+    if session is not None:
+        chat, request_tools = session.chat, tools
+    else:
+        full_history = formatted_history
+        try:
+            google_model, formatted_history = cached_model(model, system_instruction, tools, formatted_history)
+        except Exception as e:
+            logger.error(f'Context cache error: {e}', exc_info=True)
+            google_model = None
+
+        if google_model is None:
+            google_model = get_model(model, system_instruction)
+            request_tools = tools
+        else:
+            request_tools = None
+        chat = google_model.start_chat(history=formatted_history)
+
+        if session_id is not None:
+            tokens = count_tokens(system_instruction or '') + sum(count_tokens(message['parts']) for message in full_history)
+            add_session(session_id, ChatSession(chat, model, system_instruction, tokens, monotonic() + session_idle_ttl), user_message, bool(files))
+
+    image_files, documents = [], []
     for file_path in files:
         if file_path.endswith(('.png', '.jpg', '.jpeg', '.webp')):
-            image_files.append(PIL.Image.open(file_path))
+            image_files.append(prepare_image(file_path))
         else:
-            user_message += files_to_text(file_path)
+            documents.append(file_path)
+    if documents:
+        user_message += select_passages(files_to_text(documents), user_message, passage_budgets['document'])
 
-    if image_files:
-        response = chat.send_message([user_message] + image_files)
-    else:
-        response = chat.send_message(user_message)
+    return chat, [user_message] + image_files if image_files else user_message, request_tools
 
-    logger.info(f"Query: {user_message}, Response: {response.text}")
+
+def function_declarations(tools: list[dict]) -> list[dict]:
+    return [{'function_declarations': [
+        {'name': tool['name'], 'description': tool['description'], 'parameters': to_gemini_schema(tool['parameters'])} for tool in tools
+    ]}]
+
+
+def parse_function_calls(response) -> tuple[str, list[dict]]:
+    '''Gemini response -> (text, [{'func_name': str, 'func_input': str}, ...])'''
+    answer, tool_calls = '', []
+    for part in response.candidates[0].content.parts:
+        if part.function_call.name:
+            arguments = dict(part.function_call.args)
+            tool_calls.append({'func_name': part.function_call.name, 'func_input': str(arguments.get('input', ''))})
+        elif part.text:
+            answer += part.text
+    return answer, tool_calls
+
+
+def genai_api(messages: list[dict] | str, files: list | str = [], model: Literal["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"] = "gemini-2.5-flash", session_id: int | None = None) -> str:
+    '''session_id - continue the chat session of the user (see prepare_chat)'''
+    start = monotonic()
+    chat, content, _ = prepare_chat(messages, files, model, None, session_id)
+    try:
+        response = chat.send_message(content)
+    except BaseException:
+        end_turn(session_id, chat, None)
+        raise
+    end_turn(session_id, chat, response.text)
+    record_usage('google', model, response, latency=monotonic() - start)
+
+    logger.info(f"Query: {content}, Response: {response.text}")
+    return response.text
+
+
+async def async_genai_api(messages: list[dict] | str, files: list | str = [], model: Literal["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"] = "gemini-2.5-flash", session_id: int | None = None) -> str:
+    '''session_id - continue the chat session of the user (see prepare_chat)'''
+    start = monotonic()
+    chat, content, _ = await asyncio.to_thread(prepare_chat, messages, files, model, None, session_id)
+    try:
+        async with limit('gemini_llm', [(llm_limiter('google'), 1)]):
+            response = await chat.send_message_async(content)
+    except BaseException:
+        end_turn(session_id, chat, None)
+        raise
+    end_turn(session_id, chat, response.text)
+    record_usage('google', model, response, latency=monotonic() - start)
+
+    logger.info(f"Query: {content}, Response: {response.text}")
     return response.text
 
+
+async def async_genai_stream(messages: list[dict] | str, files: list | str = [], model: Literal["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"] = "gemini-2.5-flash", session_id: int | None = None):
+    '''Yields the answer in pieces as it is generated. session_id - continue the chat session of the user (see prepare_chat).
+    The concurrency slot is held until the stream is exhausted or closed (aclose)'''
+    start = monotonic()
+    chat, content, _ = await asyncio.to_thread(prepare_chat, messages, files, model, None, session_id)
+    answer = None
+    try:
+        async with limit('gemini_llm', [(llm_limiter('google'), 1)]):
+            response = await chat.send_message_async(content, stream=True)
+            async for chunk in response:
+                try:
+                    text = chunk.text
+                except ValueError:  # a chunk without text parts
+                    continue
+                if text:
+                    yield text
+        answer = response.text
+    finally:
+        end_turn(session_id, chat, answer)
+    record_usage('google', model, response, latency=monotonic() - start)
+
+    logger.info(f"Query: {content}, Response: {response.text}")
+
+
+def genai_api_tools(messages: list[dict] | str, tools: list[dict], files: list | str = [], model: Literal["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"] = "gemini-2.5-flash") -> tuple[str, list[dict]]:
+    '''One request that either answers or calls tools (native function calling). Returns (answer, [{'func_name': str, 'func_input': str}, ...])'''
+    start = monotonic()
+    chat, content, request_tools = prepare_chat(messages, files, model, function_declarations(tools))
+    response = chat.send_message(content, tools=request_tools)
+    record_usage('google', model, response, latency=monotonic() - start)
+    answer, tool_calls = parse_function_calls(response)
+
+    logger.info(f"Query: {content}, Response: {answer}, tool_calls: {tool_calls}")
+    return answer, tool_calls
+
+
+async def async_genai_api_tools(messages: list[dict] | str, tools: list[dict], files: list | str = [], model: Literal["gemini-2.5-flash", "gemini-2.5-pro", "gemini-2.5-flash-lite"] = "gemini-2.5-flash") -> tuple[str, list[dict]]:
+    start = monotonic()
+    chat, content, request_tools = await asyncio.to_thread(prepare_chat, messages, files, model, function_declarations(tools))
+    async with limit('gemini_llm', [(llm_limiter('google'), 1)]):
+        response = await chat.send_message_async(content, tools=request_tools)
+    record_usage('google', model, response, latency=monotonic() - start)
+    answer, tool_calls = parse_function_calls(response)
+
+    logger.info(f"Query: {content}, Response: {answer}, tool_calls: {tool_calls}")
+    return answer, tool_calls
@@ -1,52 +1,39 @@
 # https://groq.com/
-from groq import Groq
+import json
+import asyncio
+from time import monotonic
+from types import SimpleNamespace
+from contextlib import ExitStack, AsyncExitStack
 from typing import Literal
 from datetime import datetime
+from .usage import record_usage
+from ..accounting import record_call
+from .clients import get_groq_client, get_async_groq_client, llm_limiter
+from .keys import ordered_clients, key_call, update_from_headers, note_error
+from ..limits import limit
 from ..tools.file_utils import files_to_text
+from ..passages import select_passages, passage_budgets
 from ...config.logger import logger
 from ...config.config import load_config
 
 
 config = load_config()
-groq_api_keys = config.api.groq_key
-groq_client = [Groq(api_key=key, default_headers={"Groq-Model-Version": "latest"}) for key in groq_api_keys]  # Helps with rate limiting
 
 
-def groq_api(messages: list, files: list = None, model: Literal['openai/gpt-oss-120b', 'openai/gpt-oss-20b', 'groq/compound', 'groq/compound-mini'] = 'openai/gpt-oss-120b') -> str:
-    # https://console.groq.com/docs/models
+def prepare_messages(messages: list | str, files: list = None) -> list:
     if type(messages) == str:
         messages = [{"role": "user", "content": messages}]
 
     if files:
-        file_texts = files_to_text(files)
-        messages[-1]["content"] += file_texts
+        messages[-1]["content"] += select_passages(files_to_text(files), messages[-1]["content"], passage_budgets['document'])
 
-    for client in groq_client:
-        try:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model)
-            answer = str(response.choices[0].message.content)
-            break
-        except Exception as e:
-            logger.error(f'Error with {model} on {client.api_key}: {e}', exc_info=True)
-            answer = f'Error {e}'
-            continue
-
-    logger.info(f'groq_api answer: {answer}, query: {messages[-1]["content"]}, model: {model}')
-    return answer
+    return messages
 
 
-def groq_api_compound(messages: list, model: Literal['groq/compound', 'groq/compound-mini'] = 'groq/compound', files: list = None, only_answer: bool = True, browser_automation: bool = False) -> tuple[str, str, str] | str:
-    start_time = datetime.now()
-    if type(messages) == str:
-        messages = [{"role": "user", "content": messages}]
+def compound_settings(model: str, browser_automation: bool = False) -> tuple[str, dict]:
     if model not in ['groq/compound', 'groq/compound-mini']:
         logger.warning(f'Wrong model: {model}')
         model = 'groq/compound'
-    if files:
-        file_texts = files_to_text(files)
-        messages[-1]["content"] += file_texts
 
     compound_custom = {
                     "tools": {
@@ -54,36 +41,218 @@ def groq_api_compound(messages: list, model: Literal['groq/compound', 'groq/comp
                         "wolfram_settings": {"authorization": config.api.wolfram_full_key}
                     }
                 }
-    
+
     if browser_automation:
         compound_custom["tools"]["enabled_tools"].append('browser_automation')
 
-    for client in groq_client:
+    return model, compound_custom
+
+
+def parse_tool_calls(message) -> list[dict]:
+    '''Groq tool calls -> [{'func_name': str, 'func_input': str}, ...]'''
+    tool_calls = []
+    for tool_call in message.tool_calls or []:
+        arguments = json.loads(tool_call.function.arguments or '{}')
+        tool_calls.append({'func_name': tool_call.function.name, 'func_input': str(arguments.get('input', ''))})
+    return tool_calls
+
+
+def parse_executed_tools(message) -> list[dict]:
+    executed_tools = getattr(message, 'executed_tools', None)
+    return [{tool.type: tool.arguments} for tool in executed_tools] if executed_tools else []
+
+
+def format_time(start_time: datetime) -> str:
+    seconds = round((datetime.now()-start_time).total_seconds(), 2)
+    minutes = int(seconds // 60)
+    return f"{minutes} min {seconds} s" if minutes else f"{seconds} s"
+
+
+def groq_create(**kwargs):
+    '''chat.completions.create on the key with the most headroom, the next ones if it fails. Returns (response, error)'''
+    error = None
+    model = kwargs['model']
+    for client in ordered_clients('groq', model, get_groq_client()):
+        start = monotonic()
         try:
-            response = client.chat.completions.create(
-                messages=messages,
-                model=model,
-                compound_custom=compound_custom
-            )
-            answer = str(response.choices[0].message.content)
-            executed_tools = response.choices[0].message.executed_tools
-            break
+            with key_call('groq', model, client.api_key):
+                raw_response = client.chat.completions.with_raw_response.create(**kwargs)
+            update_from_headers('groq', model, client.api_key, raw_response.headers)
+            response = raw_response.parse()
+            record_usage('groq', model, response, client.api_key, monotonic() - start)
+            return response, None
         except Exception as e:
-            logger.error(f'Error with {model} on {client.api_key}: {e}', exc_info=True)
-            answer = f'Error {e}'
-            executed_tools = []
-            continue
-    
-    if executed_tools:
-        tools = [{tool.type: tool.arguments} for tool in executed_tools]
+            note_error('groq', model, client.api_key, e)
+            record_call('llm', 'groq', model, client.api_key, latency=monotonic() - start, ok=False)
+            logger.error(f'Error with {kwargs["model"]} on {client.api_key}: {e}', exc_info=True)
+            error = e
+    return None, error
+
+
+class HeldStream:
+    '''The sdk stream together with the concurrency slot and the in flight mark of the key, which are held until it is exhausted or closed'''
+
+    def __init__(self, stream, held: AsyncExitStack):
+        self.stream = stream
+        self.held = held
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except BaseException:  # the end of the stream, an error or cancellation
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self.held is None:
+            return
+        held, self.held = self.held, None
+        try:
+            if hasattr(self.stream, 'close'):  # the http response of the sdk stream
+                await self.stream.close()
+        finally:
+            await held.aclose()
+
+
+async def async_groq_create(**kwargs):
+    '''Async chat.completions.create on the first key that works, within the groq concurrency limit. Returns (response, error).
+    A stream holds the limit and the key until it is exhausted or closed (aclose)'''
+    error = None
+    model = kwargs['model']
+    async with AsyncExitStack() as stack:
+        await stack.enter_async_context(limit('groq_llm', [(llm_limiter('groq'), 1)]))
+        for client in ordered_clients('groq', model, get_async_groq_client()):
+            start = monotonic()
+            try:
+                with ExitStack() as call:
+                    call.enter_context(key_call('groq', model, client.api_key))
+                    raw_response = await client.chat.completions.with_raw_response.create(**kwargs)
+                    update_from_headers('groq', model, client.api_key, raw_response.headers)
+                    response = await raw_response.parse()
+                    if kwargs.get('stream'):  # streams report usage in the last chunk
+                        stack.push(call.pop_all())
+                        return HeldStream(response, stack.pop_all()), None
+                record_usage('groq', model, response, client.api_key, monotonic() - start)
+                return response, None
+            except Exception as e:
+                note_error('groq', model, client.api_key, e)
+                record_call('llm', 'groq', model, client.api_key, latency=monotonic() - start, ok=False)
+                logger.error(f'Error with {kwargs["model"]} on {client.api_key}: {e}', exc_info=True)
+                error = e
+    return None, error
+
+
+def groq_api(messages: list, files: list = None, model: Literal['openai/gpt-oss-120b', 'openai/gpt-oss-20b', 'groq/compound', 'groq/compound-mini'] = 'openai/gpt-oss-120b') -> str:
+    # https://console.groq.com/docs/models
+    messages = prepare_messages(messages, files)
+    response, error = groq_create(messages=messages, model=model)
+    answer = str(response.choices[0].message.content) if response else f'Error {error}'
+
+    logger.info(f'groq_api answer: {answer}, query: {messages[-1]["content"]}, model: {model}')
+    return answer
+
+
+async def async_groq_api(messages: list, files: list = None, model: Literal['openai/gpt-oss-120b', 'openai/gpt-oss-20b', 'groq/compound', 'groq/compound-mini'] = 'openai/gpt-oss-120b') -> str:
+    messages = await asyncio.to_thread(prepare_messages, messages, files)  # pdf/docx parsing and speech recognition block
+    response, error = await async_groq_create(messages=messages, model=model)
+    answer = str(response.choices[0].message.content) if response else f'Error {error}'
+
+    logger.info(f'async_groq_api answer: {answer}, query: {messages[-1]["content"]}, model: {model}')
+    return answer
+
+
+def groq_api_compound(messages: list, model: Literal['groq/compound', 'groq/compound-mini'] = 'groq/compound', files: list = None, only_answer: bool = True, browser_automation: bool = False) -> tuple[str, str, str] | str:
+    start_time = datetime.now()
+    messages = prepare_messages(messages, files)
+    model, compound_custom = compound_settings(model, browser_automation)
+
+    response, error = groq_create(messages=messages, model=model, compound_custom=compound_custom)
+    answer = str(response.choices[0].message.content) if response else f'Error {error}'
+    tools = parse_executed_tools(response.choices[0].message) if response else []
+
+    time = format_time(start_time)
+    logger.info(f'{model} answer: {answer}, query: {messages[-1]["content"]}, tools: {tools}, time: {time}, files: {files}, only_answer: {only_answer}, browser_automation: {browser_automation}')
+    if only_answer:
+        return answer
     else:
-        tools = []
-    seconds = round((datetime.now()-start_time).total_seconds(), 2)
-    minutes = int(seconds // 60) 
-    time = f"{minutes} min {seconds} s" if minutes else f"{seconds} s"
+        return answer, tools, time
+
+
+async def async_groq_api_compound(messages: list, model: Literal['groq/compound', 'groq/compound-mini'] = 'groq/compound', files: list = None, only_answer: bool = True, browser_automation: bool = False) -> tuple[str, str, str] | str:
+    start_time = datetime.now()
+    messages = await asyncio.to_thread(prepare_messages, messages, files)
+    model, compound_custom = compound_settings(model, browser_automation)
+
+    response, error = await async_groq_create(messages=messages, model=model, compound_custom=compound_custom)
+    answer = str(response.choices[0].message.content) if response else f'Error {error}'
+    tools = parse_executed_tools(response.choices[0].message) if response else []
+
+    time = format_time(start_time)
     logger.info(f'{model} answer: {answer}, query: {messages[-1]["content"]}, tools: {tools}, time: {time}, files: {files}, only_answer: {only_answer}, browser_automation: {browser_automation}')
     if only_answer:
         return answer
     else:
         return answer, tools, time
 
+
+async def async_groq_stream(messages: list, files: list = None, model: str = 'openai/gpt-oss-120b', compound_custom: dict | None = None, executed_tools: list | None = None):
+    '''Yields the answer in pieces as it is generated. Tools executed by compound models are added to executed_tools'''
+    messages = await asyncio.to_thread(prepare_messages, messages, files)
+    kwargs = {'compound_custom': compound_custom} if compound_custom else {}
+    start = monotonic()
+    stream, error = await async_groq_create(messages=messages, model=model, stream=True, **kwargs)
+    if stream is None:
+        yield f'Error {error}'
+        return
+
+    answer = ''
+    try:
+        async for chunk in stream:
+            usage = getattr(getattr(chunk, 'x_groq', None), 'usage', None)
+            if usage:
+                record_usage('groq', model, SimpleNamespace(usage=usage), latency=monotonic() - start)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if executed_tools is not None and getattr(delta, 'executed_tools', None):
+                executed_tools.extend({tool.type: tool.arguments} for tool in delta.executed_tools)
+            if delta.content:
+                answer += delta.content
+                yield delta.content
+    finally:
+        await stream.aclose()  # frees the limit and the key also when the reader stops early
+
+    logger.info(f'async_groq_stream answer: {answer}, query: {messages[-1]["content"]}, model: {model}')
+
+
+def async_groq_compound_stream(messages: list, model: Literal['groq/compound', 'groq/compound-mini'] = 'groq/compound', files: list = None, browser_automation: bool = False, executed_tools: list | None = None):
+    model, compound_custom = compound_settings(model, browser_automation)
+    return async_groq_stream(messages, files, model, compound_custom, executed_tools)
+
+
+def groq_api_tools(messages: list, tools: list[dict], model: Literal['openai/gpt-oss-120b', 'openai/gpt-oss-20b'] = 'openai/gpt-oss-120b') -> tuple[str, list[dict]]:
+    '''One request that either answers or calls tools (native function calling). Returns (answer, [{'func_name': str, 'func_input': str}, ...])'''
+    messages = prepare_messages(messages)
+    groq_tools = [{'type': 'function', 'function': tool} for tool in tools]
+
+    response, error = groq_create(messages=messages, model=model, tools=groq_tools, tool_choice='auto')
+    answer = str(response.choices[0].message.content or '') if response else f'Error {error}'
+    tool_calls = parse_tool_calls(response.choices[0].message) if response else []
+
+    logger.info(f'groq_api_tools answer: {answer}, tool_calls: {tool_calls}, query: {messages[-1]["content"]}, model: {model}')
+    return answer, tool_calls
+
+
+async def async_groq_api_tools(messages: list, tools: list[dict], model: Literal['openai/gpt-oss-120b', 'openai/gpt-oss-20b'] = 'openai/gpt-oss-120b') -> tuple[str, list[dict]]:
+    messages = prepare_messages(messages)
+    groq_tools = [{'type': 'function', 'function': tool} for tool in tools]
+
+    response, error = await async_groq_create(messages=messages, model=model, tools=groq_tools, tool_choice='auto')
+    answer = str(response.choices[0].message.content or '') if response else f'Error {error}'
+    tool_calls = parse_tool_calls(response.choices[0].message) if response else []
+
+    logger.info(f'async_groq_api_tools answer: {answer}, tool_calls: {tool_calls}, query: {messages[-1]["content"]}, model: {model}')
+    return answer, tool_calls
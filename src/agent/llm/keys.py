@@ -0,0 +1,147 @@
+'''API key scheduler: every request goes to the key with the most headroom (from the rate limit headers), rate-limited keys wait out their cooldown'''
+import re
+from time import monotonic
+from contextlib import contextmanager
+from ...config.logger import logger
+
+
+default_cooldown = 30  # seconds, when a 429 comes without Retry-After
+duration_pattern = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+duration_units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+class KeyState:
+    def __init__(self):
+        self.remaining_requests = None  # None - unknown (no response yet or the window was reset)
+        self.remaining_tokens = None
+        self.requests_reset = 0.0  # monotonic time
+        self.tokens_reset = 0.0
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def headroom(self, now: float) -> float:
+        '''Requests left in the window minus the ones in flight. Unknown = plenty'''
+        remaining = float('inf')
+        if self.remaining_requests is not None and now < self.requests_reset:
+            remaining = self.remaining_requests
+        if self.remaining_tokens is not None and now < self.tokens_reset and self.remaining_tokens <= 0:
+            remaining = 0
+        return remaining - self.in_flight
+
+
+key_states: dict[tuple[str, str, str], KeyState] = {}  # (provider, model, key) -> state. Limits are per model
+
+
+def get_state(provider: str, model: str, key: str) -> KeyState:
+    if (provider, model, key) not in key_states:
+        key_states[(provider, model, key)] = KeyState()
+    return key_states[(provider, model, key)]
+
+
+def parse_duration(value: str | None) -> float | None:
+    '''Groq reset/retry values: "2m59.56s", "7.66s", "420ms" or plain seconds'''
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = duration_pattern.findall(value)
+    return sum(float(number) * duration_units[unit] for number, unit in parts) if parts else None
+
+
+def header_int(headers, name: str) -> int | None:
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def ordered_keys(provider: str, model: str, keys: list[str]) -> list[str]:
+    '''Keys from the most headroom to the least. Keys on cooldown go last (the one that is free soonest first), so they are still tried if nothing else is left'''
+    now = monotonic()
+
+    def order(key: str):
+        state = get_state(provider, model, key)
+        if state.cooldown_until > now:
+            return (1, state.cooldown_until, 0, 0, 0)
+        return (0, 0, -state.headroom(now), state.in_flight, state.last_used)  # the least busy, then least recently used key wins a tie
+
+    return sorted(keys, key=order)
+
+
+def ordered_clients(provider: str, model: str, clients: list) -> list:
+    '''Same as ordered_keys for SDK clients with an api_key attribute'''
+    by_key = {client.api_key: client for client in clients}
+    return [by_key[key] for key in ordered_keys(provider, model, list(by_key))]
+
+
+def update_from_headers(provider: str, model: str, key: str, headers):
+    '''x-ratelimit-* headers of a response'''
+    state = get_state(provider, model, key)
+    now = monotonic()
+
+    remaining_requests = header_int(headers, 'x-ratelimit-remaining-requests')
+    if remaining_requests is not None:
+        state.remaining_requests = remaining_requests
+        state.requests_reset = now + (parse_duration(headers.get('x-ratelimit-reset-requests')) or 60)
+
+    remaining_tokens = header_int(headers, 'x-ratelimit-remaining-tokens')
+    if remaining_tokens is not None:
+        state.remaining_tokens = remaining_tokens
+        state.tokens_reset = now + (parse_duration(headers.get('x-ratelimit-reset-tokens')) or 60)
+
+    if remaining_requests == 0:
+        state.cooldown_until = max(state.cooldown_until, state.requests_reset)
+    if remaining_tokens is not None and remaining_tokens <= 0:
+        state.cooldown_until = max(state.cooldown_until, state.tokens_reset)
+
+
+def note_error(provider: str, model: str, key: str, error: Exception):
+    '''Counts the error. 429 puts the key on cooldown for Retry-After (or the reset time of the window)'''
+    state = get_state(provider, model, key)
+    state.errors += 1
+
+    response = getattr(error, 'response', None)
+    if getattr(error, 'status_code', None) != 429 and getattr(response, 'status_code', None) != 429:
+        return
+
+    headers = getattr(response, 'headers', {}) or {}
+    update_from_headers(provider, model, key, headers)
+    cooldown = parse_duration(headers.get('retry-after')) or default_cooldown
+    state.cooldown_until = max(state.cooldown_until, monotonic() + cooldown)
+    state.rate_limited += 1
+    logger.warning(f'{provider} key ...{key[-4:]} is rate limited on {model} for {cooldown} s')
+
+
+@contextmanager
+def key_call(provider: str, model: str, key: str):
+    '''Marks the request as in flight on the key'''
+    state = get_state(provider, model, key)
+    state.in_flight += 1
+    state.calls += 1
+    state.last_used = monotonic()
+    try:
+        yield state
+    finally:
+        state.in_flight -= 1
+
+
+def key_stats() -> dict[str, dict]:
+    '''Per key utilization (keys are masked)'''
+    now = monotonic()
+    return {
+        f'{provider} {model} ...{key[-4:]}': {
+            'calls': state.calls,
+            'errors': state.errors,
+            'rate_limited': state.rate_limited,
+            'in_flight': state.in_flight,
+            'remaining_requests': state.remaining_requests if now < state.requests_reset else None,
+            'remaining_tokens': state.remaining_tokens if now < state.tokens_reset else None,
+            'cooldown': round(max(state.cooldown_until - now, 0), 1)
+        } for (provider, model, key), state in key_states.items()
+    }
@@ -1,36 +1,478 @@
+import re
+import asyncio
+from hashlib import sha256
+from time import monotonic
 from typing import Literal
 from datetime import datetime
-from .groq import groq_api
-from .google import genai_api
+from collections import deque, Counter, defaultdict
+from .groq import groq_api, groq_api_tools, async_groq_api, async_groq_api_tools, async_groq_stream
+from .google import genai_api, genai_api_tools, async_genai_api, async_genai_api_tools, async_genai_stream
 from ..tools.file_utils import files_to_text
+from ..cache import cache_key, cache_get, cache_set
+from ..single_flight import single_flight
+from ..accounting import record_call
+from ..context import count_tokens, is_tool_output
+from ..passages import select_passages, passage_budgets
 from ...config.logger import logger
 
 
-def llm_api(messages: list[dict] | str, files: str | list = [], provider: Literal['groq', 'google'] = 'groq'):
+class CircuitBreaker:
+    '''Opens when the provider fails too often or gets too slow over the last calls. After the cooldown one probe call is let through:
+    success closes the breaker, failure opens it again'''
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, max_error_rate: float = 0.5, max_p95: float = 40, cooldown: float = 30):
+        self.name = name
+        self.calls = deque(maxlen=window)  # (ok, latency)
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self.max_p95 = max_p95
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if monotonic() - self.opened_at >= self.cooldown else 'open'
+
+    def allow(self) -> bool:
+        '''Closed, or half-open with no probe in flight. Only a check, the probe slot is taken by acquire()'''
+        state = self.state
+        return state == 'closed' or (state == 'half_open' and not self.probe_in_flight)
+
+    def acquire(self) -> bool:
+        '''Called right before the request is sent. Takes the probe slot if the breaker is half-open, True if this call is the probe'''
+        if self.state == 'half_open' and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def release(self):
+        '''The probe ended without a result (cancelled, stream closed before the first token)'''
+        self.probe_in_flight = False
+
+    def p95(self, min_samples: int = 10) -> float | None:
+        latencies = sorted(latency for ok, latency in self.calls if ok and latency is not None)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+    def record(self, ok: bool, latency: float | None):
+        '''latency None - the call is counted for the error rate only (e.g. streams)'''
+        self.calls.append((ok, latency))
+        if self.opened_at is not None:  # the probe call
+            self.probe_in_flight = False
+            if ok:
+                self.opened_at = None
+                self.calls.clear()
+                logger.info(f'{self.name} circuit breaker closed')
+            else:
+                self.opened_at = monotonic()
+            return
+
+        if len(self.calls) < self.min_calls:
+            return
+        error_rate = sum(not ok for ok, _ in self.calls) / len(self.calls)
+        p95 = self.p95(self.min_calls)
+        if error_rate >= self.max_error_rate or (p95 is not None and p95 > self.max_p95):
+            self.opened_at = monotonic()
+            llm_stats[f'{self.name}_breaker_opened'] += 1
+            logger.warning(f'{self.name} circuit breaker opened, error rate: {error_rate:.2f}, p95: {p95}')
+
+
+breakers = {'groq': CircuitBreaker('groq'), 'google': CircuitBreaker('google')}
+default_hedge_delay = {'groq': 8, 'google': 15}  # seconds, until there are enough calls to know the p95
+min_hedge_delay = 1.5
+llm_stats = Counter()  # hedged, hedge_wins, primary_wins, fallbacks, breaker skips
+
+# Complexity-based routing: the difficulty of the turn is estimated locally and picks the model of each provider
+routing = True
+llm_models = {'groq': 'openai/gpt-oss-120b', 'google': 'gemini-2.5-flash'}  # without routing
+model_tiers = {
+    'groq': {'easy': 'openai/gpt-oss-20b', 'medium': 'openai/gpt-oss-120b', 'hard': 'openai/gpt-oss-120b'},
+    'google': {'easy': 'gemini-2.5-flash-lite', 'medium': 'gemini-2.5-flash', 'hard': 'gemini-2.5-pro'}
+}
+tier_thresholds = [(4, 'hard'), (1, 'medium'), (0, 'easy')]  # (min score, tier)
+code_pattern = re.compile(r'```|^\s*(?:def|class|import|from|function|const|let|var|public|#include|SELECT)\b|[{};]\s*$|\w+\([^)]*\)\s*[{:]', re.MULTILINE)
+math_pattern = re.compile(r'\$[^$]+\$|\\(?:frac|int|sum|sqrt|lim)|\d\s*[\^*/=]\s*[\dx(]|\b(?:solve|prove|derive|integral|derivative|equation|theorem|probability|matrix)\b', re.IGNORECASE)
+reasoning_pattern = re.compile(r'\b(?:why|explain|step by step|compare|analy[sz]e|design|optimi[sz]e|debug|refactor|pros and cons|trade-?offs?|почему|объясни|сравни|докажи|реши)\b', re.IGNORECASE)
+route_stats = Counter()  # tier -> turns
+route_outcomes: defaultdict[str, Counter] = defaultdict(Counter)  # model -> calls, errors, latency (sum of seconds)
+
+# Response cache for prompts that are pure functions of their input (opt-in per call site with cache_ttl)
+response_cache_ttl = 30 * 24 * 3600
+response_cache_max_entries = 5000
+
+
+def llm_report() -> dict:
+    return {
+        **llm_stats,
+        **{f'{name}_breaker': breaker.state for name, breaker in breakers.items()},
+        **{f'{name}_p95': breaker.p95() for name, breaker in breakers.items()},
+        **{f'route_{tier}': turns for tier, turns in route_stats.items()},
+        **{f'{model}_avg_latency': round(outcome['latency'] / outcome['timed'], 2) for model, outcome in route_outcomes.items() if outcome['timed']},
+        **{f'{model}_error_rate': round(outcome['errors'] / outcome['calls'], 3) for model, outcome in route_outcomes.items() if outcome['calls']}
+    }
+
+
+def difficulty(messages: list[dict], files: list) -> tuple[int, list[str]]:
+    '''Local estimate of how hard the turn is: length, attachments, code/math markers, reasoning words, tool results. Returns (score, reasons)'''
+    reasons = []
+    tool_result = messages[-1]['content'] if is_tool_output(messages[-1]) else ''
+    question = next((message['content'] for message in reversed(messages) if message['role'] == 'user'), messages[-1]['content'])
+
+    tokens = count_tokens(question)
+    if tokens > 150:
+        reasons.append('long')
+    if tokens > 600:
+        reasons.append('very long')
+    if code_pattern.search(question):
+        reasons += ['code', 'code']
+    if math_pattern.search(question):
+        reasons += ['math', 'math']
+    if reasoning_pattern.search(question):
+        reasons.append('reasoning')
+    if files:
+        reasons.append('images')
+    if tool_result:
+        reasons.append('tool result')
+        if count_tokens(tool_result) > 1000:
+            reasons.append('long tool result')
+    return len(reasons), reasons
+
+
+def route(messages: list[dict], files: list, record: bool = True) -> dict[str, str]:
+    '''The model of each provider for this turn. record=False - only a look ahead (e.g. to build the context for the model), not counted'''
+    if not routing:
+        return dict(llm_models)
+    score, reasons = difficulty(messages, files)
+    tier = next(tier for min_score, tier in tier_thresholds if score >= min_score)
+    models = {provider: tiers[tier] for provider, tiers in model_tiers.items()}
+    if not record:
+        return models
+    route_stats[tier] += 1
+    logger.info(f'route: {tier} (score {score}: {", ".join(reasons) or "simple"}) -> {models}')
+    return models
+
+
+def note_outcome(model: str | None, ok: bool, latency: float | None):
+    '''Outcome of a routed call, to tune the thresholds against latency'''
+    if model is None:
+        return
+    outcome = route_outcomes[model]
+    outcome['calls'] += 1
+    outcome['errors'] += not ok
+    if latency is not None:
+        outcome['timed'] += 1
+        outcome['latency'] += latency
+
+
+def is_good(answer) -> bool:
+    '''groq functions return "Error ..." instead of raising'''
+    text = answer[0] if isinstance(answer, tuple) else answer
+    return not str(text).startswith('Error')
+
+
+def nominal_provider(provider: Literal['groq', 'google'], files: list) -> str:
+    '''The provider that answers when both are healthy. Images can only be answered by gemini'''
+    return 'google' if provider == 'google' or files else 'groq'
+
+
+def provider_order(provider: Literal['groq', 'google'], files: list) -> list[str]:
+    '''The requested provider first, unless its breaker is open'''
+    primary = nominal_provider(provider, files)
+    secondary = 'groq' if primary == 'google' else 'google'
+    if not breakers[primary].allow() and breakers[secondary].state == 'closed':
+        llm_stats[f'{primary}_breaker_skips'] += 1
+        return [secondary, primary]
+    return [primary, secondary]
+
+
+def hedge_delay(provider: str) -> float:
+    p95 = breakers[provider].p95()
+    return max(p95, min_hedge_delay) if p95 is not None else default_hedge_delay[provider]
+
+
+def prepare_input(messages: list[dict] | str, files: str | list = []) -> tuple[list[dict], list]:
+    '''Text files go into the last message, only images are left in files'''
     if type(messages) == str:
         messages = [{'role': 'user', 'content': messages}]
 
     if type(files) == str:
         files = [files]
 
-    messages[-1]["content"] += files_to_text([file for file in files if not file.endswith(('.png', '.jpg', '.jpeg', '.webp'))])
+    documents = [file for file in files if not file.endswith(('.png', '.jpg', '.jpeg', '.webp'))]
+    if documents:
+        messages[-1]["content"] += select_passages(files_to_text(documents), messages[-1]["content"], passage_budgets['document'])
     files = list(filter(lambda x: x.endswith(('.png', '.jpg', '.jpeg', '.webp')), files))
-    start_time = datetime.now()
+    return messages, files
 
-    
-    if provider == 'google' or files:
-        try:
-            answer = genai_api(messages, files)
-        except Exception as e:
-            logger.error(f'google error: {e}', exc_info=True)
-            answer = groq_api(messages)
-    
-    else:
+
+def files_hash(files: list[str]) -> list[str]:
+    '''Content hashes of the files (images), so the same picture under another name is the same request'''
+    hashes = []
+    for file in files:
         try:
-            answer = groq_api(messages)
-        except Exception as e:
-            logger.error(f'groq error: {e}', exc_info=True)
-            answer = genai_api(messages)
+            with open(file, 'rb') as f:
+                hashes.append(sha256(f.read()).hexdigest())
+        except OSError:
+            hashes.append(file)
+    return hashes
+
+
+def response_cache_key(messages: list[dict], files: list[str], model: str) -> str:
+    return cache_key(model, messages, files_hash(files))
+
+
+def cached_response(key: str | None, model: str):
+    if key is None:
+        return None
+    try:
+        found, answer, _ = cache_get('llm', key)
+    except Exception as e:
+        logger.error(f'llm cache error: {e}', exc_info=True)
+        return None
+    if found:
+        record_call('llm', 'cache', model, cache_hit=True)
+    return answer if found else None
+
+
+def cache_response(key: str | None, answer, ttl: int | None):
+    if key is None or not is_good(answer):
+        return
+    try:
+        cache_set('llm', key, answer, ttl, max_entries=response_cache_max_entries)
+    except Exception as e:
+        logger.error(f'llm cache error: {e}', exc_info=True)
+
+
+def call_with_breaker(provider: str, function, *args, model: str | None = None):
+    '''Sync call that is recorded in the breaker of the provider (and in the outcomes of the routed model)'''
+    probe = breakers[provider].acquire()
+    start = monotonic()
+    ok = None
+    try:
+        answer = function(*args)
+        ok = is_good(answer)
+        return answer
+    except Exception:
+        ok = False
+        raise
+    finally:
+        if ok is not None:
+            breakers[provider].record(ok, monotonic() - start)
+            note_outcome(model, ok, monotonic() - start)
+        elif probe:
+            breakers[provider].release()
+
+
+async def async_call_with_breaker(provider: str, coroutine, model: str | None = None):
+    '''Async call that is recorded in the breaker of the provider (a cancelled hedge loser is not recorded, but gives the probe slot back)'''
+    probe = breakers[provider].acquire()
+    start = monotonic()
+    ok = None
+    try:
+        answer = await coroutine
+        ok = is_good(answer)
+        return answer
+    except Exception:
+        ok = False
+        raise
+    finally:
+        if ok is not None:
+            breakers[provider].record(ok, monotonic() - start)
+            note_outcome(model, ok, monotonic() - start)
+        elif probe:
+            breakers[provider].release()
+
+
+async def hedged_request(order: list[str], request, hedge: bool = True, models: dict[str, str] | None = None):
+    '''Sends request(primary). If it is not done after its p95 latency, sends request(secondary) too and takes the first good answer,
+    the other call is cancelled. If the primary fails, the secondary is the fallback. models - the routed model of each provider'''
+    primary, secondary = order
+    models = models or {}
+
+    def start(name: str):
+        tasks[asyncio.create_task(async_call_with_breaker(name, request(name), models.get(name)))] = name
+
+    tasks = {}
+    start(primary)
+    hedged = fallback = False
+    failures = []
+    try:
+        hedge = hedge and breakers[secondary].state == 'closed'
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay(primary) if hedge else None)
+        if not done:
+            logger.info(f'{primary} is slower than {hedge_delay(primary):.1f} s, hedging with {secondary}')
+            llm_stats['hedged'] += 1
+            hedged = True
+            start(secondary)
+
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                name = tasks.pop(task)
+                if task.exception() is None and is_good(task.result()):
+                    llm_stats['primary_wins' if name == primary else 'hedge_wins' if hedged else 'fallback_wins'] += 1
+                    return task.result()
+                logger.error(f'{name} failed: {task.exception() or task.result()}')
+                failures.append(task.exception() or task.result())
+
+            if not tasks and not hedged and not fallback:  # the primary failed before the hedge
+                llm_stats['fallbacks'] += 1
+                fallback = True
+                start(secondary)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    answers = [failure for failure in failures if not isinstance(failure, Exception)]
+    if answers:
+        return answers[0]
+    raise failures[0]
+
+
+def llm_api(messages: list[dict] | str, files: str | list = [], provider: Literal['groq', 'google'] = 'groq', cache_ttl: int | None = None):
+    '''cache_ttl - the answer is saved in the response cache for cache_ttl seconds (only for prompts that are pure functions of their input)'''
+    messages, files = prepare_input(messages, files)
+    start_time = datetime.now()
+    models = route(messages, files)
+    model = models[nominal_provider(provider, files)]  # the cache key must not depend on the breakers
+    key = response_cache_key(messages, files, model) if cache_ttl else None
+    answer = cached_response(key, model)
+    if answer is not None:
+        logger.info(f'llm cache hit, messages: {messages[-1]["content"][:100]}')
+        return answer
+
+    primary, secondary = provider_order(provider, files)
+
+    def request(name: str):
+        return genai_api(messages, files, models[name]) if name == 'google' else groq_api(messages, model=models[name])
+
+    try:
+        answer = call_with_breaker(primary, request, primary, model=models[primary])
+    except Exception as e:
+        logger.error(f'{primary} error: {e}', exc_info=True)
+        answer = f'Error {e}'
+    if not is_good(answer):
+        llm_stats['fallbacks'] += 1
+        answer = call_with_breaker(secondary, request, secondary, model=models[secondary])
+    cache_response(key, answer, cache_ttl)
+
+    logger.info(f'answer: {answer}, messages: {messages[-1]["content"]}, files: {files}, provider: {provider}, time: {datetime.now()-start_time}')
+    return answer
+
+
+async def async_llm_api(messages: list[dict] | str, files: str | list = [], provider: Literal['groq', 'google'] = 'groq', cache_ttl: int | None = None):
+    '''Identical concurrent requests (same messages, files and provider) share one call. cache_ttl - see llm_api'''
+    key = 'llm:' + cache_key(messages, files, provider)
+    return await single_flight(key, async_llm_request, messages, files, provider, cache_ttl)
+
+
+async def async_llm_request(messages: list[dict] | str, files: str | list = [], provider: Literal['groq', 'google'] = 'groq', cache_ttl: int | None = None):
+    '''Hedged between groq and gemini. Requests with images are not hedged: only gemini sees the images'''
+    messages, files = await asyncio.to_thread(prepare_input, messages, files)  # pdf/docx parsing and speech recognition block
+    start_time = datetime.now()
+    models = route(messages, files)
+    model = models[nominal_provider(provider, files)]  # the cache key must not depend on the breakers
+    key = await asyncio.to_thread(response_cache_key, messages, files, model) if cache_ttl else None
+    answer = await asyncio.to_thread(cached_response, key, model)
+    if answer is not None:
+        logger.info(f'llm cache hit, messages: {messages[-1]["content"][:100]}')
+        return answer
+
+    order = provider_order(provider, files)
+
+    def request(name: str):
+        return async_genai_api(messages, files, models[name]) if name == 'google' else async_groq_api(messages, model=models[name])
+
+    answer = await hedged_request(order, request, hedge=not files, models=models)
+    await asyncio.to_thread(cache_response, key, answer, cache_ttl)
 
     logger.info(f'answer: {answer}, messages: {messages[-1]["content"]}, files: {files}, provider: {provider}, time: {datetime.now()-start_time}')
     return answer
+
+
+async def async_llm_stream(messages: list[dict] | str, files: str | list = [], provider: Literal['groq', 'google'] = 'groq'):
+    '''Yields the answer in pieces. Until the first piece arrives the other provider is the fallback, after that the stream is not switched'''
+    messages, files = await asyncio.to_thread(prepare_input, messages, files)
+    start_time = datetime.now()
+    order = provider_order(provider, files)
+    models = route(messages, files)
+
+    error = 'Error: no provider answered'
+    for name in order:
+        probe = breakers[name].acquire()
+        stream = async_genai_stream(messages, files, models[name]) if name == 'google' else async_groq_stream(messages, model=models[name])
+        started = False
+        try:
+            async for chunk in stream:
+                if not started and not is_good(chunk):  # groq yields the error as the answer
+                    error = chunk
+                    break
+                if not started:
+                    started = True
+                    breakers[name].record(True, None)
+                    note_outcome(models[name], True, (datetime.now() - start_time).total_seconds())  # time to the first token
+                    logger.info(f'{name} first token after {datetime.now() - start_time}')
+                yield chunk
+        except Exception as e:
+            logger.error(f'{name} stream error: {e}', exc_info=True)
+            if started:
+                yield f'\n\nError {e}'
+                return
+            error = f'Error {e}'
+        except BaseException:  # cancelled, or closed by the consumer
+            if probe and not started:
+                breakers[name].release()
+            raise
+        finally:
+            await stream.aclose()
+
+        if started:
+            return
+        breakers[name].record(False, None)
+        note_outcome(models[name], False, None)
+        llm_stats['fallbacks'] += 1
+
+    yield error
+
+
+def llm_api_tools(messages: list[dict] | str, tools: list[dict], files: str | list = [], provider: Literal['groq', 'google'] = 'groq') -> tuple[str, list[dict]]:
+    """Native function calling: one request returns either the answer or the tools to call. Returns (answer, [{'func_name': str, 'func_input': str}, ...])"""
+    messages, files = prepare_input(messages, files)
+    start_time = datetime.now()
+
+    primary, secondary = provider_order(provider, files)
+    models = route(messages, files)
+
+    def request(name: str):
+        return genai_api_tools(messages, tools, files, models[name]) if name == 'google' else groq_api_tools(messages, tools, models[name])
+
+    try:
+        answer, tool_calls = call_with_breaker(primary, request, primary, model=models[primary])
+    except Exception as e:
+        logger.error(f'{primary} error: {e}', exc_info=True)
+        answer, tool_calls = f'Error {e}', []
+    if not is_good(answer):
+        llm_stats['fallbacks'] += 1
+        answer, tool_calls = call_with_breaker(secondary, request, secondary, model=models[secondary])
+
+    logger.info(f'answer: {answer}, tool_calls: {tool_calls}, messages: {messages[-1]["content"]}, files: {files}, provider: {provider}, time: {datetime.now()-start_time}')
+    return answer, tool_calls
+
+
+async def async_llm_api_tools(messages: list[dict] | str, tools: list[dict], files: str | list = [], provider: Literal['groq', 'google'] = 'groq') -> tuple[str, list[dict]]:
+    messages, files = await asyncio.to_thread(prepare_input, messages, files)
+    start_time = datetime.now()
+
+    models = route(messages, files)
+
+    def request(name: str):
+        return async_genai_api_tools(messages, tools, files, models[name]) if name == 'google' else async_groq_api_tools(messages, tools, models[name])
+
+    answer, tool_calls = await hedged_request(provider_order(provider, files), request, hedge=not files, models=models)
+
+    logger.info(f'answer: {answer}, tool_calls: {tool_calls}, messages: {messages[-1]["content"]}, files: {files}, provider: {provider}, time: {datetime.now()-start_time}')
+    return answer, tool_calls
@@ -0,0 +1,43 @@
+'''Token usage of llm calls: prompt tokens and how many of them were served from the provider cache'''
+from collections import Counter, defaultdict
+from ..accounting import record_call
+from ...config.logger import logger
+
+
+prompt_cache_stats: defaultdict[str, Counter] = defaultdict(Counter)  # model -> calls, prompt_tokens, cached_tokens
+
+
+def groq_usage(response) -> tuple[int, int, int]:
+    '''(prompt tokens, cached prompt tokens, completion tokens)'''
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+    return usage.prompt_tokens or 0, cached_tokens, usage.completion_tokens or 0
+
+
+def gemini_usage(response) -> tuple[int, int, int]:
+    '''(prompt tokens, cached prompt tokens, completion tokens)'''
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return 0, 0, 0
+    return usage.prompt_token_count or 0, getattr(usage, 'cached_content_token_count', 0) or 0, usage.candidates_token_count or 0
+
+
+def record_usage(provider: str, model: str, response, key: str | None = None, latency: float | None = None):
+    '''Records prompt/cached tokens of the response, also in the per-user accounting'''
+    prompt_tokens, cached_tokens, completion_tokens = groq_usage(response) if provider == 'groq' else gemini_usage(response)
+    record_call('llm', provider, model, key, prompt_tokens, completion_tokens, cached_tokens, latency)
+    stats = prompt_cache_stats[model]
+    stats['calls'] += 1
+    stats['prompt_tokens'] += prompt_tokens
+    stats['cached_tokens'] += cached_tokens
+    logger.info(f'{provider} {model}: prompt tokens: {prompt_tokens}, cached: {cached_tokens}, completion: {completion_tokens}')
+
+
+def prompt_cache_report() -> dict[str, dict]:
+    return {
+        model: {**stats, 'cached_share': round(stats['cached_tokens'] / stats['prompt_tokens'], 3) if stats['prompt_tokens'] else 0}
+        for model, stats in prompt_cache_stats.items()
+    }
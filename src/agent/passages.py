@@ -0,0 +1,153 @@
+'''Relevance-ranked passage selection: a long text (web page, search results, transcript, document) is split into passages,
+the passages are ranked against the query with BM25 and only the best ones that fit the token budget go to the llm.
+The index is built in-process for every text, it takes milliseconds'''
+import re
+import math
+from collections import Counter
+from .context import count_tokens
+from ..config.logger import logger
+
+
+# Token budgets for the selected text of each kind of source
+passage_budgets = {
+    'page': 3000,  # one web page before it is summarized
+    'search': 1500,  # search results that go to the answer as they are
+    'transcript': 12000,  # youtube subtitles
+    'document': 12000  # uploaded pdf, docx and text files
+}
+passage_tokens = 200  # target size of one passage
+bm25_k1 = 1.5
+bm25_b = 0.75
+keep_first = True  # the beginning of a text (title, lead paragraph) is kept when there is room
+
+word_pattern = re.compile(r'\w+', re.UNICODE)
+sentence_pattern = re.compile(r'(?<=[.!?])\s+')
+stop_words = {
+    'a', 'an', 'the', 'and', 'or', 'of', 'to', 'in', 'on', 'for', 'with', 'by', 'at', 'from', 'as', 'is', 'are', 'was', 'were', 'be',
+    'it', 'its', 'this', 'that', 'these', 'those', 'what', 'which', 'who', 'how', 'why', 'when', 'where', 'do', 'does', 'did',
+    'i', 'you', 'me', 'my', 'your', 'we', 'can', 'about', 'please', 'tell', 'describe', 'summarize', 'answer', 'question', 'previous',
+    'и', 'в', 'на', 'с', 'по', 'о', 'что', 'как', 'это', 'не', 'для', 'из', 'к', 'а', 'но'
+}
+
+passage_stats = Counter()  # calls, trimmed, tokens_in, tokens_out
+
+
+def terms(text: str) -> list[str]:
+    return [word for word in word_pattern.findall(text.lower()) if word not in stop_words]
+
+
+def cut_by_length(piece: str, max_tokens: int) -> list[str]:
+    '''A sentence or line longer than max_tokens (a table, minified text) is cut into parts of about max_tokens, at spaces when there are any'''
+    parts = []
+    while count_tokens(piece) > max_tokens:
+        end = len(piece) * max_tokens // count_tokens(piece)
+        while end > 1 and count_tokens(piece[:end]) > max_tokens:  # the density of tokens is not even
+            end = min(end - 1, end * max_tokens // count_tokens(piece[:end]))
+        end = max(end, 1)
+        cut = piece.rfind(' ', end // 2, end)
+        if cut <= 0:
+            cut = end
+        parts.append(piece[:cut])
+        piece = piece[cut:].lstrip()
+    if piece:
+        parts.append(piece)
+    return parts
+
+
+def split_passages(text: str, max_tokens: int = passage_tokens) -> list[str]:
+    '''Consecutive lines are joined into passages of about max_tokens. Longer lines are split by sentences, longer sentences by length'''
+    pieces = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if count_tokens(line) <= max_tokens:
+            pieces.append(line)
+            continue
+        for sentence in sentence_pattern.split(line):
+            if count_tokens(sentence) <= max_tokens:
+                pieces.append(sentence)
+            else:
+                pieces.extend(cut_by_length(sentence, max_tokens))
+
+    passages, current, current_tokens = [], [], 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            passages.append('\n'.join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        passages.append('\n'.join(current))
+    return passages
+
+
+def bm25_scores(query: str, passages: list[str]):
+    '''BM25 score of every passage for the query (numpy array)'''
+    import numpy as np
+
+    query_terms = list(dict.fromkeys(terms(query)))
+    if not query_terms or not passages:
+        return np.zeros(len(passages))
+
+    column = {term: i for i, term in enumerate(query_terms)}
+    tf = np.zeros((len(passages), len(query_terms)), dtype=np.float32)  # only the query terms matter for the score
+    lengths = np.zeros(len(passages), dtype=np.float32)
+    for row, passage in enumerate(passages):
+        passage_terms = terms(passage)
+        lengths[row] = len(passage_terms)
+        for term, count in Counter(passage_terms).items():
+            if term in column:
+                tf[row, column[term]] = count
+
+    df = (tf > 0).sum(axis=0)
+    idf = np.log(1 + (len(passages) - df + 0.5) / (df + 0.5))
+    norm = bm25_k1 * (1 - bm25_b + bm25_b * lengths / max(lengths.mean(), 1))
+    return (idf * tf * (bm25_k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+
+def spread(count: int, k: int) -> list[int]:
+    '''k indexes evenly spread over range(count)'''
+    return sorted({math.floor(i * count / k) for i in range(k)})
+
+
+def select_passages(text: str, query: str | None, max_tokens: int, max_passage_tokens: int = passage_tokens) -> str:
+    '''The passages of the text most relevant to the query that fit into max_tokens, in their original order.
+    Without a query (or if nothing matches it) the passages are taken evenly from the whole text. A short text is returned as is'''
+    passage_stats['calls'] += 1
+    tokens_in = count_tokens(text)
+    if tokens_in <= max_tokens:
+        return text
+
+    passages = split_passages(text, max_passage_tokens)
+    sizes = [count_tokens(passage) for passage in passages]
+    scores = bm25_scores(query or '', passages)
+
+    if scores.any():
+        ranked = [int(i) for i in scores.argsort(kind='stable')[::-1] if scores[i] > 0]
+        neighbours = [j for i in ranked for j in (i - 1, i + 1) if 0 <= j < len(passages)]  # the context around the matches
+        order = list(dict.fromkeys(([0] if keep_first else []) + ranked + neighbours))
+    else:
+        order = spread(len(passages), max(1, min(len(passages), max_tokens * len(passages) // max(tokens_in, 1))))
+
+    chosen, used = set(), 0
+    for i in order:
+        if used + sizes[i] <= max_tokens:
+            chosen.add(i)
+            used += sizes[i]
+
+    result, previous = [], -1
+    for i in sorted(chosen):
+        if i != previous + 1:
+            result.append('[...]')
+        result.append(passages[i])
+        previous = i
+    if previous != len(passages) - 1:
+        result.append('[...]')
+
+    passage_stats['trimmed'] += 1
+    passage_stats['tokens_in'] += tokens_in
+    passage_stats['tokens_out'] += used
+    logger.info(f'{len(chosen)}/{len(passages)} passages, {used}/{tokens_in} tokens, query: {str(query)[:100]}')
+    return '\n'.join(result)
@@ -0,0 +1,108 @@
+'''Local fast-path router. Decides about tools without an llm call when the answer is obvious'''
+import os
+import re
+import json
+import math
+from collections import Counter, OrderedDict
+from .passages import stop_words
+from ..config.logger import logger
+
+
+youtube_pattern = re.compile(r'https?://(?:www\.|m\.)?(?:youtube\.com/(?:watch\?\S*v=|shorts/|live/)|youtu\.be/)[\w-]{11}\S*', re.IGNORECASE)
+latex_pattern = re.compile(r'^\s*(?:(?:please\s+)?(?:compile|render|draw|show)\s*(?:this|the)?\s*(?:expression|formula)?\s*:?\s*)?(\${1,2}[^$]+\${1,2})\s*[.!?]?\s*$', re.IGNORECASE)
+image_pattern = re.compile(r'^\s*(?:please\s+)?(?:find|show|search|get)(?:\s+me)?\s+(?:a\s+|an\s+|some\s+)?(?:picture|pictures|image|images|photo|photos|pic|pics)\s+(?:of|with)\s+(.+?)(?:\s*,?\s*(?:please|pls|thanks|thank you))?\s*[.!?]?\s*$', re.IGNORECASE)
+word_pattern = re.compile(r'\w+', re.UNICODE)
+
+classifier_path = os.path.join(os.path.dirname(__file__), 'router_examples.json')
+chat_threshold = 0.75     # probability of "chat" needed to answer without tools
+known_words_threshold = 0.75  # share of the message words the classifier has seen
+chat_max_length = 80      # longer messages always go to the llm router
+cache_size = 1024
+
+router_cache: OrderedDict[str, tuple[bool, list]] = OrderedDict()
+router_stats = Counter()  # hits (decided locally), misses (llm router), cache_hits
+
+
+def normalize_text(text: str) -> str:
+    return ' '.join(text.lower().split())
+
+
+def load_classifier(path: str = classifier_path) -> dict:
+    '''Multinomial naive Bayes over words, trained on the examples from router_examples.json.
+    tool_words - the words seen only in the tool examples (weather, time, price...)'''
+    with open(path, 'r', encoding='utf-8') as f:
+        examples = json.load(f)
+
+    classifier = {'labels': {}, 'vocabulary': set()}
+    total = sum(len(texts) for texts in examples.values())
+    for label, texts in examples.items():
+        counts = Counter(word for text in texts for word in word_pattern.findall(text.lower()))
+        classifier['labels'][label] = {'prior': math.log(len(texts) / total), 'counts': counts, 'total': sum(counts.values())}
+        classifier['vocabulary'].update(counts)
+    chat_words = classifier['labels'].get('chat', {}).get('counts', Counter())
+    classifier['tool_words'] = {word for word in classifier['vocabulary'] if word not in chat_words and word not in stop_words}
+    return classifier
+
+
+classifier = load_classifier()
+
+
+def classify(text: str) -> dict[str, float]:
+    '''Returns the probability of each label. Unknown words are ignored'''
+    words = [word for word in word_pattern.findall(text.lower()) if word in classifier['vocabulary']]
+    vocabulary_size = len(classifier['vocabulary'])
+
+    scores = {}
+    for label, data in classifier['labels'].items():
+        score = data['prior']
+        for word in words:
+            score += math.log((data['counts'][word] + 1) / (data['total'] + vocabulary_size))
+        scores[label] = score
+
+    max_score = max(scores.values())
+    exp_scores = {label: math.exp(score - max_score) for label, score in scores.items()}
+    total = sum(exp_scores.values())
+    return {label: score / total for label, score in exp_scores.items()}
+
+
+def rules_select_tool(text: str) -> tuple[bool, list]:
+    '''Returns (confident, tools). If not confident, the llm router must decide'''
+    youtube_links = youtube_pattern.findall(text)
+    if youtube_links and len(youtube_pattern.sub('', text).split()) <= 3:  # a bare link (maybe with "summarize")
+        return True, [{'func_name': 'youtube_sum', 'func_input': link} for link in youtube_links]
+
+    latex_match = latex_pattern.match(text)
+    if latex_match:
+        return True, [{'func_name': 'latex_expression_to_png', 'func_input': latex_match.group(1).strip('$').strip()}]
+
+    image_match = image_pattern.match(text)
+    if image_match:
+        return True, [{'func_name': 'google_image', 'func_input': image_match.group(1)}]
+
+    words = word_pattern.findall(text.lower())
+    known_words = [word for word in words if word in classifier['vocabulary']]
+    mentions_tool = any(word in classifier['tool_words'] for word in words)  # "what is the weather, thank you" is not a chat message
+    if words and len(text) <= chat_max_length and len(known_words) / len(words) >= known_words_threshold and not mentions_tool and not any(char.isdigit() for char in text):
+        probabilities = classify(text)
+        if probabilities.get('chat', 0) >= chat_threshold:
+            return True, []
+
+    return False, []
+
+
+def local_select_tool(text: str) -> tuple[bool, list]:
+    '''Fast path for tool selection with a cache by normalized message text. Returns (confident, tools)'''
+    key = normalize_text(text)
+    if key in router_cache:
+        router_cache.move_to_end(key)
+        router_stats['cache_hits'] += 1
+        confident, tools = router_cache[key]
+    else:
+        confident, tools = rules_select_tool(text)
+        router_cache[key] = (confident, tools)
+        if len(router_cache) > cache_size:
+            router_cache.popitem(last=False)
+
+    router_stats['hits' if confident else 'misses'] += 1
+    logger.info(f'confident: {confident}, tools: {tools}, stats: {dict(router_stats)}')
+    return confident, [dict(tool) for tool in tools]
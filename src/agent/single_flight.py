@@ -0,0 +1,39 @@
+'''Single-flight: concurrent identical calls share one in-flight future'''
+import asyncio
+from collections import Counter
+from ..config.logger import logger
+
+
+in_flight: dict[str, asyncio.Future] = {}
+in_flight_waiters = Counter()
+single_flight_stats = Counter()  # calls, saved (joined an in-flight call), batch_saved (duplicates in one llm_use_tool batch)
+
+
+def forget(key: str, future: asyncio.Future):
+    if in_flight.get(key) is future:
+        del in_flight[key]
+        del in_flight_waiters[key]
+
+
+async def single_flight(key: str, coroutine_function, *args, **kwargs):
+    '''Awaits coroutine_function(*args, **kwargs) or joins the identical call that is already running.
+    The call is cancelled only when all its waiters are cancelled'''
+    single_flight_stats['calls'] += 1
+    future = in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+        in_flight[key] = future
+        future.add_done_callback(lambda _: forget(key, future))
+    else:
+        single_flight_stats['saved'] += 1
+        logger.info(f'joined in-flight call {key}, stats: {dict(single_flight_stats)}')
+
+    in_flight_waiters[key] += 1
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if in_flight.get(key) is future:
+            in_flight_waiters[key] -= 1
+            if in_flight_waiters[key] <= 0 and not future.done():
+                future.cancel()
+        raise
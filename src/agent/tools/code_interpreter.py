@@ -1,9 +1,14 @@
 # https://e2b.dev/
 import base64
-from e2b_code_interpreter import Sandbox
 from ...config.logger import logger
 
 
+def Sandbox(*args, **kwargs):
+    '''e2b_code_interpreter is imported on first use'''
+    from e2b_code_interpreter import Sandbox
+    return Sandbox(*args, **kwargs)
+
+
 def code_interpreter(code: str) -> tuple[str, str | None]:
     '''Interprets and executes the given code in a sandboxed environment (https://e2b.dev/)'''
     with Sandbox() as sandbox:
@@ -1,48 +1,84 @@
-import docx
-import fitz
-import PyPDF2
 import asyncio
 import aiohttp
 import hashlib
+import threading
 import requests
-import PIL.Image
-from groq import Groq
+from io import BytesIO
+from collections import OrderedDict
+from time import monotonic
 from datetime import datetime
+from ..llm.clients import get_groq_client, get_async_groq_client, llm_limiter
+from ..llm.keys import ordered_clients, key_call, update_from_headers, note_error
+from ..limits import limit
+from ..accounting import record_call
 from ...config.logger import logger
-from ...config.config import load_config
-
-
-config = load_config()
-groq_api_keys = config.api.groq_key
-groq_client = [Groq(api_key=key) for key in groq_api_keys]
 
 
 def date_hash() -> str:
     return hashlib.md5(datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f").encode()).hexdigest()
 
 
+whisper_model = "whisper-large-v3"
+
+
 def speech_recognition(file_name: str) -> str:  # TODO: local_whisper
     with open(file_name, "rb") as file:
-        for client in groq_client:
+        content = file.read()
+
+    text = ''
+    for client in ordered_clients('groq', whisper_model, get_groq_client()):
+        start = monotonic()
+        try:
+            with key_call('groq', whisper_model, client.api_key):
+                raw_response = client.audio.transcriptions.with_raw_response.create(
+                    file=(file_name, content),
+                    model=whisper_model)
+            update_from_headers('groq', whisper_model, client.api_key, raw_response.headers)
+            text = raw_response.parse().text
+            record_call('speech', 'groq', whisper_model, client.api_key, latency=monotonic() - start)
+            logger.info(f'Success: {text}')
+            break
+        except Exception as e:
+            note_error('groq', whisper_model, client.api_key, e)
+            record_call('speech', 'groq', whisper_model, client.api_key, latency=monotonic() - start, ok=False)
+            logger.error(f'Error with speech recognition on {client.api_key}: {e}', exc_info=True)
+            text = f'Error with speech recognition: {e}'
+
+    return str(text).strip()
+
+
+async def async_speech_recognition(file_name: str) -> str:
+    '''speech_recognition on the shared async groq clients'''
+    with open(file_name, "rb") as file:
+        content = file.read()
+
+    text = ''
+    async with limit('whisper', [(llm_limiter('groq'), 1)]):
+        for client in ordered_clients('groq', whisper_model, get_async_groq_client()):
+            start = monotonic()
             try:
-                translation = client.audio.transcriptions.create(
-                    file=(file_name, file.read()),
-                    model="whisper-large-v3")
-                text = translation.text
+                with key_call('groq', whisper_model, client.api_key):
+                    raw_response = await client.audio.transcriptions.with_raw_response.create(
+                        file=(file_name, content),
+                        model=whisper_model)
+                update_from_headers('groq', whisper_model, client.api_key, raw_response.headers)
+                text = (await raw_response.parse()).text
+                record_call('speech', 'groq', whisper_model, client.api_key, latency=monotonic() - start)
                 logger.info(f'Success: {text}')
                 break
             except Exception as e:
+                note_error('groq', whisper_model, client.api_key, e)
+                record_call('speech', 'groq', whisper_model, client.api_key, latency=monotonic() - start, ok=False)
                 logger.error(f'Error with speech recognition on {client.api_key}: {e}', exc_info=True)
                 text = f'Error with speech recognition: {e}'
-                continue
-    
+
     return str(text).strip()
 
 
 # =========================< DOWNLOAD IMAGE >=========================
-def download_image(url: str) -> str:
+def download_image(url: str, timeout: float = 30) -> str:
     'Downloads the image from the link. Returns the name of the downloaded image'
-    response = requests.get(url)
+    response = requests.get(url, timeout=timeout)
     if response.status_code == 200:
         file_name = f'{hash(url)}.png'
         with open(file_name, 'wb') as file:
@@ -68,9 +104,9 @@ async def async_download_image(session, url, name):
         logger.error(f"Error downloading {url}: {e}", exc_info=True)
 
 
-async def download_images(image_urls):
+async def download_images(image_urls, timeout: float = 30):
     name = date_hash()
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
         tasks = []
         for i, url in enumerate(image_urls):
             try:
@@ -84,6 +120,7 @@ async def download_images(image_urls):
 
 # =========================< FILE TO TEXT >=========================
 def pdf_to_text(pdf_path: str) -> str:
+    import PyPDF2
     with open(pdf_path, 'rb') as pdf_file:
         pdf_reader = PyPDF2.PdfReader(pdf_file)
         extracted_text = ""
@@ -96,6 +133,7 @@ def pdf_to_text(pdf_path: str) -> str:
 
 
 def docx_to_text(docx_path: str) -> str:
+    import docx
     doc = docx.Document(docx_path)
     full_text = []
     for para in doc.paragraphs:
@@ -139,6 +177,7 @@ def files_to_text(files: list | str) -> str:
 
 # =========================< WORK WITH FILES >=========================
 def pdf_to_image(pdf_path: str, quality: int = 3, extension: str = 'png') -> list[str]:
+    import fitz
     file_name = pdf_path[:-4]
     doc = fitz.open(pdf_path)
     photos = []
@@ -157,6 +196,7 @@ def pdf_to_image(pdf_path: str, quality: int = 3, extension: str = 'png') -> lis
 
 
 def merges_pdf(files: list[str]) -> str:
+    import fitz
     merger = fitz.Document()
 
     for file in files:
@@ -171,9 +211,64 @@ def merges_pdf(files: list[str]) -> str:
     return merged_file
 
 
+# Images for the vision models: downscaled to the resolution the model actually uses and re-encoded as JPEG.
+# Gemini works on 768x768 tiles, so anything above two tiles per side only adds upload bytes and latency
+vision_max_side = 1536
+vision_jpeg_quality = 85
+vision_cache_max_entries = 64
+vision_cache: OrderedDict[str, dict] = OrderedDict()  # sha256 of the original file -> {'mime_type': ..., 'data': ...}
+vision_cache_lock = threading.Lock()  # prepare_image runs in worker threads (prepare_chat)
+
+
+def prepare_image(file_path: str) -> dict:
+    '''The image as an inline blob for the model ({'mime_type': ..., 'data': bytes}). The same picture (by content) is processed once'''
+    with open(file_path, 'rb') as f:
+        original = f.read()
+    key = hashlib.sha256(original).hexdigest()
+    with vision_cache_lock:
+        if key in vision_cache:
+            vision_cache.move_to_end(key)
+            return vision_cache[key]
+
+    import PIL.Image
+    import PIL.ImageOps
+
+    with PIL.Image.open(BytesIO(original)) as image:
+        original_format = image.format
+        image = PIL.ImageOps.exif_transpose(image)
+        resized = max(image.size) > vision_max_side
+        if resized:
+            image.thumbnail((vision_max_side, vision_max_side), PIL.Image.LANCZOS)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = PIL.Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        buffer = BytesIO()
+        image.save(buffer, format='JPEG', quality=vision_jpeg_quality, optimize=True)
+        image.close()
+
+    blob = {'mime_type': 'image/jpeg', 'data': buffer.getvalue()}
+    if not resized and original_format in ('JPEG', 'PNG', 'WEBP') and len(original) <= len(blob['data']):  # already compact
+        blob = {'mime_type': f'image/{original_format.lower()}', 'data': original}
+
+    with vision_cache_lock:
+        vision_cache[key] = blob
+        while len(vision_cache) > vision_cache_max_entries:
+            vision_cache.popitem(last=False)
+    logger.info(f'{file_path}: {len(original)} -> {len(blob["data"])} bytes')
+    return blob
+
+
 def merge_pngs_vertically(image_paths: list) -> str:
+    import PIL.Image
     output_path = date_hash() + '.png'
-    images = [PIL.Image.open(img_path) for img_path in image_paths]
+    images = []
+    for img_path in image_paths:
+        with PIL.Image.open(img_path) as img:
+            images.append(img.copy())
 
     total_width = max(img.width for img in images)
 
@@ -187,8 +282,10 @@ def merge_pngs_vertically(image_paths: list) -> str:
         x_offset = (total_width - img.width) // 2
         new_image.paste(img, (x_offset, current_height))
         current_height += img.height
+        img.close()
 
     new_image.save(output_path)
+    new_image.close()
     return output_path
 
 
@@ -1,16 +1,19 @@
 # https://www.imdb.com/
 import json
-from PyMovieDb import IMDB
+from functools import lru_cache
 from .file_utils import download_image
 from ...config.logger import logger
 
 
-imdb = IMDB()
+@lru_cache(maxsize=None)
+def get_imdb():
+    from PyMovieDb import IMDB
+    return IMDB()
 
     
 def imdb_search(title: str) -> list[dict]:
     '''Search for a movie by title. Returns [{'id': str, 'name': str, 'url': str, 'poster': str'}, ...]'''
-    responce_json = imdb.search(title)
+    responce_json = get_imdb().search(title)
     responce_dict = json.loads(responce_json)
     result = responce_dict['results']
     return result  
@@ -35,7 +38,7 @@ def imdb_get_film_by_id(imdb_id: str, download_image_or_not=True) -> tuple[str,
       'creator': [], 
       'ratingCount': 2741032}, 
      ['path_to_poster.png'])'''
-    responce_json = imdb.get_by_id(imdb_id)
+    responce_json = get_imdb().get_by_id(imdb_id)
     responce_dict = json.loads(responce_json)
 
     if responce_dict.get('status', False) == 404:
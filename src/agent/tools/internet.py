@@ -1,18 +1,36 @@
 # https://www.tavily.com/ and https://pypi.org/project/duckduckgo-search/
+import re
+import time
 import asyncio
 import hashlib
+import threading
 import aiohttp
+from time import monotonic
 from datetime import datetime
-from tavily import TavilyClient
-from duckduckgo_search import DDGS
-from ..llm.llm import llm_api
+from collections import Counter, OrderedDict, deque
+from functools import lru_cache
+from .web_page import new_http_session, extract_page, extract_pages, page_to_text
+from ..llm.llm import llm_api, async_llm_api, is_good
+from ..cache import cache_key, cache_get, cache_set
+from ..passages import select_passages, passage_budgets, terms
 from ...config.logger import logger
 from ...config.config import load_config
 
 
 
 config = load_config()
-tavily_client = TavilyClient(api_key=config.api.tavily_key)
+
+
+@lru_cache(maxsize=None)
+def get_tavily_client():
+    from tavily import TavilyClient
+    return TavilyClient(api_key=config.api.tavily_key)
+
+
+def DDGS(*args, **kwargs):
+    '''duckduckgo_search is imported on first use'''
+    from duckduckgo_search import DDGS
+    return DDGS(*args, **kwargs)
 
 
 def date_hash() -> str:
@@ -33,9 +51,9 @@ async def async_download_image(session, url, name):
         logger.error(f"Error downloading {url}: {e}", exc_info=True)
 
 
-async def download_images(image_urls):
+async def download_images(image_urls, timeout: float = 30):
     name = date_hash()
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
         tasks = []
         for i, url in enumerate(image_urls):
             try:
@@ -47,64 +65,128 @@ async def download_images(image_urls):
 
     
 def parsing(links: str | list) -> str:
-    '''Parse the content of the given links''' # using Tavily API
-    start_time = datetime.now() 
-    try:
-        responce = tavily_client.extract(urls=links)
-        return [r['raw_content'] for r in responce['results']]
-    
-    except Exception as e:
-        if type(links) == str:
-            links = [links]
-        result = ''
-        for link in links:
-            try:
-                responce = tavily_client.extract(link)
-                result += f'{link}: {responce["result"][0]["raw_content"]}\n'
-            except:
-                result += f'{link}: Error when extracting text ({e})\n'
+    '''Parse the content of the given links'''  # locally, Tavily API only for the pages that can't be read locally
+    start_time = datetime.now()
+    if type(links) == str:
+        links = [links]
+
+    async def extract():
+        async with new_http_session() as session:  # a sync call has its own event loop, so it can't use the shared pool
+            return await extract_pages(links, session)
 
-    logger.info(f'{links}, {result}, {datetime.now() - start_time}')
+    pages = asyncio.run(extract())
+    result = ''
+    for page in pages:
+        result += f'{page["url"]}: {page_to_text(page) or "Error when extracting text"}\n'
+
+    logger.info(f'{links}, {[page["source"] for page in pages]}, {datetime.now() - start_time}')
     return result
-    
 
 
-def DDGS_answer(text: str) -> str:
+
+def DDGS_answer(text: str, timeout: float = 10) -> str:
     'A short answer like Google. Sometimes nothing comes up. But mostly the answer comes from wikipedia.'
     try:
-        response = DDGS().answers(text)[:3]
+        response = DDGS(timeout=timeout).answers(text)[:3]
         return '\n'.join([r["text"] for r in response])
     except:
         return ''
 
 
-def DDGS_images(text: str, max_results: int = 9) -> list[str]:
+# Search cache: the same query (after normalization) is answered from memory or from the persistent cache until the ttl of the provider expires
+search_cache_ttl = {
+    'ddgs_text': 6 * 3600,
+    'ddgs_images': 7 * 24 * 3600,
+    'tavily_search': 6 * 3600,
+    'tavily_content': 6 * 3600,
+    'tavily_context': 24 * 3600,
+    'tavily_context_news': 30 * 60  # news get old quickly
+}
+search_cache_max_entries = 5000  # persistent, the oldest entries are evicted
+search_memory_max_entries = 512  # in-process LRU in front of the persistent cache
+search_memory: OrderedDict[str, tuple[float, object]] = OrderedDict()  # key -> (expires, result)
+search_memory_lock = threading.Lock()
+search_cache_stats = Counter()  # memory_hits, disk_hits, misses
+query_word_pattern = re.compile(r'\w+(?:[.+#]+\w+)*[+#]*', re.UNICODE)  # "c++", "c#" and "3.5" are words of their own
+# Only articles and fillers: question words, negations and "to be" change what is searched for
+search_stop_words = {'a', 'an', 'the', 'please', 'pls', 'пожалуйста'}
+
+
+def normalize_query(query: str) -> str:
+    '''Case, punctuation, whitespace, articles and fillers don't change the search results'''
+    words = query_word_pattern.findall(query.lower())
+    return ' '.join([word for word in words if word not in search_stop_words] or words)
+
+
+def cached_search(provider: str, query: str, params: tuple, search):
+    '''search() result for the query, cached for search_cache_ttl[provider]. params - the other arguments that change the result. Empty results are not cached'''
+    key = cache_key(provider, normalize_query(query), params)
+    with search_memory_lock:
+        if key in search_memory and search_memory[key][0] > time.time():
+            search_memory.move_to_end(key)
+            search_cache_stats['memory_hits'] += 1
+            return search_memory[key][1]
+
+    try:
+        found, result, _ = cache_get('search', key)
+    except Exception as e:
+        logger.error(f'search cache error: {e}', exc_info=True)
+        found, result = False, None
+    if found:
+        search_cache_stats['disk_hits'] += 1
+    else:
+        search_cache_stats['misses'] += 1
+        result = search()
+        if not result:
+            return result
+        try:
+            cache_set('search', key, result, search_cache_ttl[provider], max_entries=search_cache_max_entries)
+        except Exception as e:
+            logger.error(f'search cache error: {e}', exc_info=True)
+
+    with search_memory_lock:
+        search_memory[key] = (time.time() + search_cache_ttl[provider], result)  # a disk hit lives in memory a bit longer than on disk, at most one ttl
+        search_memory.move_to_end(key)
+        while len(search_memory) > search_memory_max_entries:
+            search_memory.popitem(last=False)
+    return result
+
+
+def DDGS_images(text: str, max_results: int = 9, timeout: float = 10) -> list[str]:
     '''Fetch images related to the given text using DuckDuckGo Search'''
-    images = [i['image'] for i in DDGS().images(text, max_results=max_results)]
-    return images
+    return cached_search('ddgs_images', text, (max_results, ),
+                         lambda: [i['image'] for i in DDGS(timeout=timeout).images(text, max_results=max_results)])
 
 
 def tavily_search(query: str, max_results: int = 7):
-    response = tavily_client.search(query=query, max_results=max_results)
-    result = ''
-    for i in response['results']:
-        result += f'{i["url"]}({i["title"]}): {i["content"]}\n'
-    return result
+    def search():
+        response = get_tavily_client().search(query=query, max_results=max_results)
+        result = ''
+        for i in response['results']:
+            result += f'{i["url"]}({i["title"]}): {i["content"]}\n'
+        return result
+
+    return select_passages(cached_search('tavily_search', query, (max_results, ), search), query, passage_budgets['search'])
 
 
 def tavily_get_context(query: str, topic = 'news') -> str:
-    return tavily_client.get_search_context(query=query, topic=topic).replace('\\', '')
+    return cached_search('tavily_context_news' if topic == 'news' else 'tavily_context', query, (topic, ),
+                         lambda: get_tavily_client().get_search_context(query=query, topic=topic).replace('\\', ''))
 
 
 def tavily_content(text: str, max_results: int = 4):
-    response = tavily_client.search(query=text, search_depth='basic', max_results=max_results)['results']
-    results = ''
-    for r in response:
-        results += f'{r["url"]}: {r["content"]}\n'
+    def search():
+        response = get_tavily_client().search(query=text, search_depth='basic', max_results=max_results)['results']
+        results = ''
+        for r in response:
+            results += f'{r["url"]}: {r["content"]}\n'
+        return results
 
-    return results
+    return cached_search('tavily_content', text, (max_results, ), search)
 
 
+sum_page_cache_ttl = 24 * 3600  # the page text is part of the key, so a changed page is a new entry anyway
+
 prompt_for_sum = f"""You are a precise summarization expert. Your task is to create a clear and relevant summary based on the provided text and query.
 
 Context: I will provide you with:
@@ -115,11 +197,16 @@ Ignore unnecessary information and answer the query well.
 """
 
 
+async def page_text(link: str) -> str:
+    '''Title and text of the page, '' if it could not be extracted'''
+    return page_to_text(await extract_page(link))
+
+
 def sum_page(link: str, query: str) -> str:
-    prompt = prompt_for_sum + f'\n\nQuery:\n{query}\n\nSource text:\n{parsing(link)}'  # TODO: IMPROVE
+    prompt = prompt_for_sum + f'\n\nQuery:\n{query}\n\nSource text:\n{select_passages(parsing(link), query, passage_budgets["page"])}'
     messages = [{"role": "user", "content": prompt}]
     try:
-        llm_answer = llm_api(messages=messages)
+        llm_answer = llm_api(messages=messages, cache_ttl=sum_page_cache_ttl)
         logger.info(llm_answer)
     except Exception as e:
         l = len(str(messages))
@@ -131,7 +218,7 @@ def sum_page(link: str, query: str) -> str:
 
 def google_links(text: str, max_results: int = 5) -> list[str]:
     try:
-        links = [i['href'] for i in DDGS().text(text, max_results=max_results)]
+        links = cached_search('ddgs_text', text, (max_results, ), lambda: [i['href'] for i in DDGS().text(text, max_results=max_results)])
         logger.info(str(links))
         return links
     except Exception as e:
@@ -139,34 +226,184 @@ def google_links(text: str, max_results: int = 5) -> list[str]:
         return []
 
 
-def google_short_answer(text: str) -> str:
-    resp = DDGS_answer(text)
-    final_answer = resp if resp else tavily_search(text)
-    logger.info(final_answer)
-    return final_answer
-    
+# google_short_answer races DuckDuckGo answers (free, often empty) against Tavily search (paid, almost always has something).
+# Tavily starts after a head start of DuckDuckGo (its median latency) or right away if DuckDuckGo has nothing,
+# so most answers don't cost a Tavily call. race_head_start = 0 starts both at once
+race_head_start = None  # seconds, None - the median DuckDuckGo latency
+default_head_start = 1.0  # until there are enough calls to know the median
+max_head_start = 3.0
+min_answer_chars = 20
+race_stats = Counter()  # duckduckgo_wins, tavily_wins, tavily_skipped, tavily_wasted, no_answer
+race_latencies = {'duckduckgo': deque(maxlen=200), 'tavily': deque(maxlen=200)}  # seconds of the sufficient answers
 
-def google_full_answer(text: str, max_results: int = 5):  # TODO: async, for lyrics
 
-    start_time = datetime.now()
-    links = google_links(text=text, max_results=max_results)
+def is_sufficient(answer: str, query: str) -> bool:
+    '''Not empty, not an error and about the query'''
+    answer = str(answer or '').strip()
+    if len(answer) < min_answer_chars or answer.startswith('Error'):
+        return False
+    query_terms = set(terms(query))
+    return not query_terms or bool(query_terms & set(terms(answer)))
 
-    sum_answers = ''
-    for link in links:
-        sum_answers += sum_page(link=link, query=text)  # TODO: max_result excluding parsing error
 
-    prompt = prompt_for_sum + f"""Summarize the text above in a concise and relevant way. Ensure that the summary is well-organized and captures the main points of the text. The summary should be based on the query and the provided text. If the text is not relevant to the query, please provide a summary that is not relevant to the query. Source text will be composed of several responses. Write the final text"""
-    prompt +=  f'\n\nQuery:\n{text}\n\nSource text:\n{sum_answers}'
-    
-    final_messages = [{"role": "user", "content": prompt}]
-    final_answer = llm_api(messages=final_messages)
+def latency_percentile(provider: str, share: float) -> float | None:
+    latencies = sorted(race_latencies[provider])
+    if len(latencies) < 10:
+        return None
+    return latencies[min(int(len(latencies) * share), len(latencies) - 1)]
+
+
+def head_start() -> float:
+    if race_head_start is not None:
+        return race_head_start
+    median = latency_percentile('duckduckgo', 0.5)
+    return min(median, max_head_start) if median is not None else default_head_start
+
+
+def race_report() -> dict:
+    return {
+        **race_stats,
+        'head_start': round(head_start(), 2),
+        **{f'{provider}_p50': round(latency, 2) for provider in race_latencies if (latency := latency_percentile(provider, 0.5)) is not None},
+        **{f'{provider}_p95': round(latency, 2) for provider in race_latencies if (latency := latency_percentile(provider, 0.95)) is not None}
+    }
+
+
+async def timed_search(provider: str, function, *args) -> tuple[str, str, float]:
+    '''(provider, answer, seconds). Errors become empty answers'''
+    start = monotonic()
+    try:
+        answer = await asyncio.to_thread(function, *args)
+    except Exception as e:
+        logger.error(f'{provider}: {e}', exc_info=True)
+        answer = ''
+    return provider, answer, monotonic() - start
+
+
+async def google_short_answer(text: str, timeout: float = 30) -> str:
+    '''The first sufficient answer of DuckDuckGo or Tavily'''
+    tasks = {asyncio.create_task(timed_search('duckduckgo', DDGS_answer, text, min(timeout, 10)))}
+    tavily_started = False
+
+    def start_tavily():
+        nonlocal tavily_started
+        tavily_started = True
+        tasks.add(asyncio.create_task(timed_search('tavily', tavily_search, text)))
+
+    fallback = ''
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=head_start())
+        if not done:
+            start_tavily()
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tasks.discard(task)
+                provider, answer, seconds = task.result()
+                if is_sufficient(answer, text):
+                    race_latencies[provider].append(seconds)
+                    race_stats[f'{provider}_wins'] += 1
+                    if provider == 'duckduckgo':
+                        race_stats['tavily_wasted' if tavily_started else 'tavily_skipped'] += 1
+                    logger.info(f'{provider} won after {seconds:.2f} s: {answer}')
+                    return answer
+                logger.info(f'{provider} answer is not sufficient: {answer[:100]}')
+                fallback = fallback or answer
+            if not tavily_started:  # duckduckgo has nothing
+                start_tavily()
+    finally:
+        for task in tasks:
+            task.cancel()  # the thread of the loser is not stopped, its answer is ignored
+
+    race_stats['no_answer'] += 1
+    return fallback
+
+
+# google_full_answer: map (fetch + summarize every page, bounded) -> reduce (one answer from the summaries that arrived first)
+full_answer_pages = 3  # relevant summaries that are enough for the answer, the rest of the pages are cancelled
+full_answer_spare_links = 3  # extra links in case some pages fail or are not relevant
+fetch_concurrency = 4
+summary_concurrency = 3
+min_page_chars = 200  # shorter pages are captchas, cookie walls and errors
+map_share = 0.7  # share of the timeout for the map stage, the rest is left for the reduce
+irrelevant_mark = 'IRRELEVANT'
+
+prompt_for_page_sum = prompt_for_sum + f"""If the source text has nothing that helps to answer the query, answer only {irrelevant_mark}.
+"""
+
+prompt_for_reduce = prompt_for_sum + """Summarize the text above in a concise and relevant way. Ensure that the summary is well-organized and captures the main points of the text. The summary should be based on the query and the provided text. If the text is not relevant to the query, please provide a summary that is not relevant to the query. Source text will be composed of several responses. Write the final text"""
+
+
+async def async_sum_page(link: str, query: str, fetch_slots: asyncio.Semaphore, summary_slots: asyncio.Semaphore) -> str | None:
+    '''Summary of the page for the query, None if the page could not be read or is not relevant'''
+    async with fetch_slots:
+        text = await page_text(link)
+    if len(text.strip()) < min_page_chars:
+        logger.info(f'{link}: no text ({len(text)} chars)')
+        return None
+
+    text = await asyncio.to_thread(select_passages, text, query, passage_budgets['page'])  # only the parts of the page about the query
+    messages = [{'role': 'user', 'content': prompt_for_page_sum + f'\n\nQuery:\n{query}\n\nSource text:\n{text}'}]
+    async with summary_slots:
+        summary = await async_llm_api(messages=messages, cache_ttl=sum_page_cache_ttl)
+    if not is_good(summary) or summary.strip().upper().startswith(irrelevant_mark):
+        logger.info(f'{link}: {summary[:100]}')
+        return None
+    return summary
+
+
+async def page_summaries(links: list[str], query: str):
+    '''Yields (link, summary) of the relevant pages as soon as each is ready. Closing the generator cancels the pages in flight'''
+    fetch_slots, summary_slots = asyncio.Semaphore(fetch_concurrency), asyncio.Semaphore(summary_concurrency)
+    tasks = {asyncio.create_task(async_sum_page(link, query, fetch_slots, summary_slots)): link for link in links}
+    try:
+        for task in asyncio.as_completed(tasks):
+            try:
+                summary = await task
+            except Exception as e:
+                logger.error(f'sum page error: {e}', exc_info=True)
+                continue
+            if summary is not None:
+                yield summary
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def google_full_answer(text: str, max_results: int = full_answer_pages, timeout: float = 60) -> str:
+    '''Reads the first pages of the search concurrently and writes one answer from the first max_results relevant summaries'''
+    start_time = datetime.now()
+    loop = asyncio.get_running_loop()
+    map_deadline = loop.time() + timeout * map_share
+    links = await asyncio.to_thread(google_links, text, max_results + full_answer_spare_links)
+
+    sum_answers = []
+    summaries = page_summaries(links, text)
+    try:
+        while len(sum_answers) < max_results:
+            sum_answers.append(await asyncio.wait_for(anext(summaries), timeout=max(map_deadline - loop.time(), 0)))
+    except (StopAsyncIteration, asyncio.TimeoutError):
+        pass
+    finally:
+        await summaries.aclose()
+    logger.info(f'{len(sum_answers)}/{len(links)} pages summarized in {datetime.now() - start_time}')
+
+    if not sum_answers:
+        return f'Error: no relevant pages were found for "{text}"'
+    if len(sum_answers) == 1:
+        return sum_answers[0]
+
+    source_text = '\n\n\n'.join(sum_answers)
+    final_messages = [{"role": "user", "content": prompt_for_reduce + f'\n\nQuery:\n{text}\n\nSource text:\n{source_text}'}]
+    final_answer = await async_llm_api(messages=final_messages)
 
     logger.info(f'{final_answer}, {datetime.now() - start_time}')
     return final_answer
 
 
 def google_news(text: str):
-    news_content = tavily_get_context(text)
+    news_content = select_passages(tavily_get_context(text), text, passage_budgets['page'])
     
     prompt = prompt_for_sum + f"""Turn all these texts into one\n\nQuery:\n{text}\n\nSource text:\n{news_content}"""
 
@@ -178,8 +415,8 @@ def google_news(text: str):
 
 
 
-async def google_image(text, max_results=9, download_images_or_not=True):
-    urls = DDGS_images(text, max_results=max_results)
+async def google_image(text, max_results=9, download_images_or_not=True, timeout: float = 30):
+    urls = await asyncio.to_thread(DDGS_images, text, max_results=max_results, timeout=min(timeout, 10))
     start_time = datetime.now()
     
 
@@ -188,7 +425,7 @@ async def google_image(text, max_results=9, download_images_or_not=True):
         return f'google_image: The {len(urls)} of images on the {text} query will be prefixed to your response', urls
 
     
-    file_paths = await download_images(urls)
+    file_paths = await download_images(urls, timeout=timeout)
     
     logger.info(f'{file_paths}, {datetime.now()-start_time}')
     return f'The {len(file_paths)} of the {text} query images will be appended to the response. Answer other user questions, tell information about the query, or say something like images found. DON\'T write anything like [Image of ...] or you\'ll be shut down.', file_paths
@@ -3,16 +3,16 @@ import hashlib
 import requests
 from urllib.parse import quote
 from .file_utils import download_images
-from ..llm.llm import llm_api
+from ..llm.llm import llm_api, response_cache_ttl
 from ...config.logger import logger
 
 
-def latex_expression_to_png(expression: str, size: int = 400):
+def latex_expression_to_png(expression: str, size: int = 400, timeout: float = 30):
     '''Converts a LaTeX expression to a PNG image with https://latex.codecogs.com/'''
     try:
         expression = expression.strip('$')
         link = 'https://latex.codecogs.com/png.image?\\dpi{' + str(size) + '}' + expression.replace(' ', '%20')
-        response = requests.get(link)
+        response = requests.get(link, timeout=timeout)
         file_name = hashlib.md5(expression.encode()).hexdigest() + '.png'
         if response.status_code == 200:
             with open(file_name, 'wb') as f:
@@ -74,7 +74,7 @@ def latex_to_pdf(content: str, recursion_turn: int = 1) -> str | None:
         prompt = 'You are a LaTeX expert. You have to fix the LaTeX Document so that the error does not occur (if the error is very unclear, you can remove the part of the text with the error). '\
                  'Your whole reply will go in the reply, so you can write your thoughts in the comments (after %), nobody will see them. '\
                 f'Error: {response.text}\n\nText:{content}'
-        answer = llm_api(prompt)
+        answer = llm_api(prompt, cache_ttl=response_cache_ttl)
         if answer.startswith('```latex'):
             answer = answer[8:-4]
         elif answer.startswith('```'):
@@ -91,7 +91,7 @@ def text_to_pdf_document(text: str):
             f"Text:\n{text}"
     
     
-    answer = llm_api(prompt).strip()
+    answer = llm_api(prompt, cache_ttl=response_cache_ttl).strip()
     
     if answer.startswith('```latex'):
         answer = answer[8:-4]
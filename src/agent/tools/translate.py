@@ -1,4 +1,3 @@
-from deep_translator import GoogleTranslator, single_detection
 from ...config.config import load_config
 
 config = load_config()
@@ -6,6 +5,7 @@ detect_language_api_key = config.api.detect_language_key
 
 
 def detect_language(text: str) -> str:
+    from deep_translator import single_detection
     try:
         return single_detection(text=text, api_key=detect_language_api_key, detailed=False)
     except:
@@ -13,5 +13,6 @@ def detect_language(text: str) -> str:
     
 
 def translate(text: str, target_language: str = 'en', source_language: str = 'auto') -> str:   # TODO: ggcs translator
+    from deep_translator import GoogleTranslator
     translated_text = GoogleTranslator(source=source_language, target=target_language).translate(text)
     return translated_text
\ No newline at end of file
@@ -0,0 +1,192 @@
+'''Local web page extraction: pages are downloaded through one shared aiohttp pool (with size and time caps),
+the boilerplate (menus, footers, ads, scripts) is removed with lxml and the main content is returned as text with the title.
+Tavily extract is the fallback for pages that can't be read locally (javascript apps, blocked bots, pdf)'''
+import re
+import asyncio
+import weakref
+import aiohttp
+from collections import Counter
+from ...config.logger import logger
+
+
+fetch_limits = {'limit': 32, 'limit_per_host': 4, 'ttl_dns_cache': 300}
+fetch_timeout = {'total': 15, 'connect': 5, 'sock_read': 10}
+fetch_max_bytes = 3 * 1024 * 1024  # the rest of a bigger page is not downloaded
+fetch_headers = {
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,text/plain;q=0.9,*/*;q=0.5',
+    'Accept-Language': 'en-US,en;q=0.8'
+}
+min_text_chars = 300  # less text than this means the local extraction failed (javascript app, captcha, paywall)
+
+boilerplate_tags = ['nav', 'header', 'footer', 'aside', 'form', 'button', 'noscript', 'svg', 'iframe', 'select', 'dialog']
+# Whole class/id words only ("site-nav", "footer_links"), so "canvas", "shared-content" or "headerless" are kept
+boilerplate_pattern = re.compile(r'(^|[\s_-])(nav|navbar|navigation|menu|footer|header|sidebar|cookies?|consent|banner|advert|ads?|promo|sponsored|share|sharing|social'
+                                 r'|comments?|related|recommended|breadcrumbs?|subscribe|newsletter|popup|modal|signup|login)($|[\s_-])', re.IGNORECASE)
+block_tags = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'pre', 'blockquote', 'td', 'th', 'dd', 'dt', 'figcaption'}
+max_link_density = 0.5  # blocks that are mostly links are menus and lists of other articles
+
+extract_stats = Counter()  # local, local_failed, tavily, tavily_failed, too_big
+
+# Connections belong to the event loop they were opened in, so the pool is per loop (the bot has one)
+http_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def new_http_session() -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(**fetch_limits), timeout=aiohttp.ClientTimeout(**fetch_timeout), headers=fetch_headers)
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    '''Shared keep-alive pool of the running event loop'''
+    loop = asyncio.get_running_loop()
+    if loop not in http_sessions or http_sessions[loop].closed:
+        http_sessions[loop] = new_http_session()
+    return http_sessions[loop]
+
+
+async def close_http_session():
+    session = http_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def fetch(url: str, session: aiohttp.ClientSession | None = None) -> tuple[bytes, str] | None:
+    '''(body, content type) of an html or text page, None for other content and errors. At most fetch_max_bytes are read'''
+    session = session or get_http_session()
+    try:
+        async with session.get(url, allow_redirects=True, max_redirects=5) as response:
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if response.status != 200 or content_type not in ('text/html', 'application/xhtml+xml', 'text/plain', ''):
+                logger.info(f'{url}: HTTP {response.status}, {content_type}')
+                return None
+
+            body = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                body += chunk
+                if len(body) >= fetch_max_bytes:
+                    extract_stats['too_big'] += 1
+                    break
+            return bytes(body[:fetch_max_bytes]), content_type
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.info(f'{url}: {type(e).__name__} {e}')
+        return None
+
+
+def normalize_space(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def page_title(document) -> str:
+    for xpath in ['//meta[@property="og:title"]/@content', '//title/text()', '//h1//text()']:
+        found = [normalize_space(value) for value in document.xpath(xpath) if normalize_space(value)]
+        if found:
+            return found[0]
+    return ''
+
+
+def link_density(element) -> float:
+    text_length = len(normalize_space(element.text_content())) or 1
+    return sum(len(normalize_space(link.text_content())) for link in element.iter('a')) / text_length
+
+
+def main_element(document):
+    '''<article>/<main> if the page has one with enough text, otherwise the element whose paragraphs have the most text'''
+    for xpath in ['//article', '//main', '//*[@role="main"]']:
+        candidates = [element for element in document.xpath(xpath) if len(normalize_space(element.text_content())) >= min_text_chars]
+        if candidates:
+            return max(candidates, key=lambda element: len(element.text_content()))
+
+    scores = Counter()
+    for paragraph in document.iter('p', 'pre', 'blockquote'):
+        length = len(normalize_space(paragraph.text_content()))
+        if length < 25:
+            continue
+        parent = paragraph.getparent()
+        if parent is not None:
+            scores[parent] += length
+            if parent.getparent() is not None:
+                scores[parent.getparent()] += length / 2
+    if not scores:
+        return document.body if document.body is not None else document
+    return max(scores, key=lambda element: scores[element] * (1 - link_density(element)))
+
+
+def html_to_text(html: bytes) -> tuple[str, str]:
+    '''(title, main content text) of the html page'''
+    import lxml.html
+    from lxml_html_clean import Cleaner
+
+    document = lxml.html.document_fromstring(html)
+    title = page_title(document)
+
+    cleaner = Cleaner(scripts=True, javascript=True, comments=True, style=True, inline_style=True, links=True, meta=True,
+                      page_structure=False, processing_instructions=True, embedded=True, frames=True, forms=True,
+                      annoying_tags=True, remove_unknown_tags=False, safe_attrs_only=False, kill_tags=boilerplate_tags)
+    document = cleaner.clean_html(document)
+    keep = set()  # the <article>/<main> candidates and their ancestors are never dropped
+    for candidate in document.xpath('//article | //main | //*[@role="main"]'):
+        keep.add(candidate)
+        keep.update(candidate.iterancestors())
+    for element in list(document.iter()):
+        if not isinstance(element.tag, str) or element.getparent() is None or element in keep:
+            continue
+        attributes = f'{element.get("class", "")} {element.get("id", "")} {element.get("role", "")}'
+        if element.tag != 'body' and boilerplate_pattern.search(attributes):
+            element.drop_tree()
+
+    lines, seen = [], set()
+    for element in main_element(document).iter(*block_tags):
+        if any(ancestor.tag in block_tags for ancestor in element.iterancestors()):
+            continue  # the text is already in the outer block
+        text = normalize_space(element.text_content())
+        if not text or text in seen or (element.tag not in ('h1', 'h2', 'h3', 'pre') and len(text) < 20):
+            continue
+        if len(text) < 200 and link_density(element) > max_link_density:
+            continue
+        seen.add(text)
+        lines.append(('#' * int(element.tag[1]) + ' ' + text) if element.tag in ('h1', 'h2', 'h3') else text)
+    return title, '\n'.join(lines)
+
+
+def body_to_text(body: bytes, content_type: str) -> tuple[str, str]:
+    if content_type == 'text/plain':
+        return '', body.decode('utf-8', errors='replace')
+    return html_to_text(body)
+
+
+def tavily_extract(url: str) -> tuple[str, str]:
+    from .internet import get_tavily_client
+    results = get_tavily_client().extract(urls=[url])['results']
+    return ('', results[0]['raw_content']) if results else ('', '')
+
+
+async def extract_page(url: str, session: aiohttp.ClientSession | None = None) -> dict:
+    '''{'url', 'title', 'text', 'source': 'local' | 'tavily' | ''}. Text is '' if neither the local extraction nor Tavily could read the page'''
+    page = await fetch(url, session)
+    if page is not None:
+        try:
+            title, text = await asyncio.to_thread(body_to_text, *page)  # parsing a big page takes tens of milliseconds
+            if len(text) >= min_text_chars:
+                extract_stats['local'] += 1
+                return {'url': url, 'title': title, 'text': text, 'source': 'local'}
+        except Exception as e:
+            logger.error(f'{url}: {e}', exc_info=True)
+    extract_stats['local_failed'] += 1
+
+    try:
+        title, text = await asyncio.to_thread(tavily_extract, url)
+        if text:
+            extract_stats['tavily'] += 1
+            return {'url': url, 'title': title, 'text': text, 'source': 'tavily'}
+    except Exception as e:
+        logger.error(f'{url}: tavily {e}', exc_info=True)
+    extract_stats['tavily_failed'] += 1
+    return {'url': url, 'title': '', 'text': '', 'source': ''}
+
+
+async def extract_pages(urls: list[str], session: aiohttp.ClientSession | None = None) -> list[dict]:
+    return await asyncio.gather(*[extract_page(url, session) for url in urls])
+
+
+def page_to_text(page: dict) -> str:
+    return f'{page["title"]}\n\n{page["text"]}' if page['title'] else page['text']
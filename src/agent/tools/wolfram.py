@@ -24,20 +24,20 @@ def calculator(expression: str) -> str:
         return f"Calculator error: {e}"
 
 
-def wolfram_short_answer_api(text: str) -> str:
+def wolfram_short_answer_api(text: str, timeout: float = 30) -> str:
     'https://products.wolframalpha.com/short-answers-api/documentation - Short answer from WolframAlpha'
     query = quote(text)
     url = f'https://api.wolframalpha.com/v1/result?appid={WOLFRAM_SIMPLE_API}&i={query}'
-    answer = requests.get(url).text
+    answer = requests.get(url, timeout=timeout).text
     logger.info(answer)
     return answer
 
 
-def wolfram_llm_api(text: str) -> tuple[str, list]:
+def wolfram_llm_api(text: str, timeout: float = 60) -> tuple[str, list]:
     'https://products.wolframalpha.com/llm-api/documentation - text version of the WolframAlpha page answer. Returns the text and a list of links to images'
     query = quote(text)
     url = f'https://www.wolframalpha.com/api/v1/llm-api?input={query}&appid={WOLFRAM_SHOW_STEPS_RESULT}'
-    answer = requests.get(url).text
+    answer = requests.get(url, timeout=timeout).text
     # TODO: improve (add async) and add llm
     answer = answer[:answer.find('Wolfram|Alpha website result for "')]
     links = re.findall(r'https?://\S+', answer)
@@ -56,14 +56,14 @@ def wolfram_simple_api(text: str) -> str:
 
 
 # These two functions are for use by llm
-def wolfram_short_answer(query: str) -> str:
+def wolfram_short_answer(query: str, timeout: float = 30) -> str:
     'Short answer from WolframAlpha'
-    return wolfram_short_answer_api(query)
+    return wolfram_short_answer_api(query, timeout=timeout)
 
 
-def wolfram_full_answer(text: str):  # TODO: async + and [wolfram_simple_api(text)] + full_answer_images 
+def wolfram_full_answer(text: str, timeout: float = 60):  # TODO: async + and [wolfram_simple_api(text)] + full_answer_images 
     'returns the text version of the answer sheet, the image links and the answer sheet as a picture'
-    full_answer, full_answer_images = wolfram_llm_api(text)
+    full_answer, full_answer_images = wolfram_llm_api(text, timeout=timeout)
     images = full_answer_images
     logger.info(f'{full_answer}, {images}')
     return full_answer, images
\ No newline at end of file
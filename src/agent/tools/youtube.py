@@ -1,11 +1,10 @@
 # !!! DIDNT WORK !!!
 import re
 import requests
-from bs4 import BeautifulSoup
-from youtube_transcript_api import YouTubeTranscriptApi
 from .translate import detect_language
 from ...config.logger import logger
 from ...agent.llm.llm import llm_api
+from ..passages import select_passages, passage_budgets
 
 
 def transcript2text(transcript: list[dict], sep='\n') -> str:
@@ -24,7 +23,9 @@ def transcript2text(transcript: list[dict], sep='\n') -> str:
 
 
 
-def get_youtube_transcripts(link: str, language: str = 'en'):
+def get_youtube_transcripts(link: str, language: str = 'en', timeout: float = 30):
+    from bs4 import BeautifulSoup
+    from youtube_transcript_api import YouTubeTranscriptApi
 
     if 'youtube.com' in link:
         pattern_for_youtube_video = r"(?:v=|\/)([a-zA-Z0-9_-]{11})"  # https://www.youtube.com/watch?v=xxxxxxxxxxx -> xxxxxxxxxxx
@@ -38,7 +39,7 @@ def get_youtube_transcripts(link: str, language: str = 'en'):
 
     
     # get title
-    response = requests.get(link)
+    response = requests.get(link, timeout=timeout)
     soup = BeautifulSoup(response.text, 'html.parser')
     title_tag = soup.find("title")
     if title_tag:
@@ -77,9 +78,10 @@ def get_youtube_transcripts(link: str, language: str = 'en'):
     return transcript2text(transcript), title
 
 
-def youtube_sum(link: str, question: str | None = None, language: str = 'en') -> str: 
+def youtube_sum(link: str, question: str | None = None, language: str = 'en', timeout: float = 30) -> str: 
     # make it possible to ask questions.
-    text, title = get_youtube_transcripts(link, language)
+    text, title = get_youtube_transcripts(link, language, timeout=timeout)
+    text = select_passages(text, question, passage_budgets['transcript'])  # without a question the passages are taken from the whole video
 
     if question:
         content = f'Answer the question "{question}" based on this YouTube video "{title}": {text}'
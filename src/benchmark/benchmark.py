@@ -0,0 +1,249 @@
+'''Offline end-to-end latency benchmark: select_tools -> llm_use_tool -> answer -> markdown_to_html/split_html -> Telegram,
+with local stubs instead of the external services. Run from the ai_agent folder: python -m src.benchmark.benchmark'''
+import os
+import json
+import math
+import asyncio
+import logging
+import argparse
+import tempfile
+from time import perf_counter
+from collections import defaultdict
+from .stubs import use_temporary_storage, default_profiles, stub_stats, install_stubs
+use_temporary_storage()  # before the agent modules below open their databases
+from ..agent.llm.keys import key_stats
+from ..config.logger import logger
+
+
+corpus_path = os.path.join(os.path.dirname(__file__), 'corpus.json')
+stages = ['select', 'tools', 'answer', 'format', 'telegram', 'stream', 'first_visible', 'code_interpreter', 'total']
+
+
+def percentile(samples: list[float], p: float) -> float:
+    '''Nearest-rank percentile'''
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    index = max(math.ceil(p / 100 * len(samples)) - 1, 0)
+    return samples[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    async def timed(self, stage: str, coroutine):
+        start = perf_counter()
+        try:
+            return await coroutine
+        except Exception as e:
+            self.errors[stage] += 1
+            logger.warning(f'benchmark {stage} error: {e}')
+            return None
+        finally:
+            self.samples[stage].append(perf_counter() - start)
+
+    def timed_sync(self, stage: str, function, *args):
+        start = perf_counter()
+        try:
+            return function(*args)
+        except Exception as e:
+            self.errors[stage] += 1
+            logger.warning(f'benchmark {stage} error: {e}')
+            return None
+        finally:
+            self.samples[stage].append(perf_counter() - start)
+
+
+class VisibleBot:
+    '''Records when the first message of the turn was sent or edited ("first_visible")'''
+
+    def __init__(self, bot, recorder: 'Recorder', start: float):
+        self.bot, self.recorder, self.start, self.visible = bot, recorder, start, False
+
+    def mark(self):
+        if not self.visible:
+            self.visible = True
+            self.recorder.samples['first_visible'].append(perf_counter() - self.start)
+
+    async def send_message(self, *args, **kwargs):
+        result = await self.bot.send_message(*args, **kwargs)
+        self.mark()
+        return result
+
+    async def edit_message_text(self, *args, **kwargs):
+        result = await self.bot.edit_message_text(*args, **kwargs)
+        self.mark()
+        return result
+
+
+async def run_turn(conversation: dict, recorder: Recorder, bot, chat_id: int, provider: str, stream: bool = False):
+    '''One turn the way the default message handler does it'''
+    from ..agent.agent import system_prompt, turn_budget, select_tools, llm_use_tool, provider_limiter, answer as agent_answer, answer_stream
+    from ..bot.streaming import stream_to_telegram, text_chunks
+    from ..agent.limits import limit
+    from ..agent.context import build_context
+    from ..agent.tools.code_interpreter import code_interpreter
+    from ..bot.formatter import markdown_to_html, split_html
+
+    start = perf_counter()
+    bot = VisibleBot(bot, recorder, start)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + turn_budget
+    messages = build_context([{'role': 'system', 'content': system_prompt}] + conversation['messages'], 'gemini-2.5-flash')
+
+    result = await recorder.timed('select', select_tools(messages, [], provider))
+    text, tools = result if result else ('', [])
+    chunks = text_chunks(text or 'empty answer')
+    if tools:
+        tool_result = await recorder.timed('tools', llm_use_tool(tools, deadline))
+        tool_text = tool_result[0] if tool_result else ''
+        if stream:
+            chunks = answer_stream(messages, [], provider, tool_result=tool_text)
+        else:
+            text = await recorder.timed('answer', agent_answer(messages, [], provider, tool_result=tool_text))
+
+    if stream:  # the answer is generated, rendered and sent/edited at the same time
+        result = await recorder.timed('stream', stream_to_telegram(bot, chat_id, chunks))
+        text = result[0] if result else ''
+    else:
+        parts = recorder.timed_sync('format', lambda: split_html(markdown_to_html(text or 'empty answer')))
+        for part in parts or []:
+            await recorder.timed('telegram', bot.send_message(chat_id, part, parse_mode='HTML'))
+
+    if conversation.get('run_code') and text and '```python' in text:
+        code = text.split('```python')[1].split('```')[0]
+
+        async def run_code():
+            async with limit('code_interpreter', [(provider_limiter('e2b'), 1)]):
+                return await asyncio.to_thread(code_interpreter, code)
+
+        await recorder.timed('code_interpreter', run_code())
+
+    recorder.samples['total'].append(perf_counter() - start)
+
+
+async def run_benchmark(corpus: list[dict], turns: int, concurrency: int, provider: str, bot, stream: bool = False) -> tuple[Recorder, float]:
+    '''Runs the corpus in a loop until "turns" turns are done, "concurrency" users at a time. Returns (recorder, wall time)'''
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def user_turn(i: int):
+        async with semaphore:
+            await run_turn(corpus[i % len(corpus)], recorder, bot, chat_id=i % concurrency, provider=provider, stream=stream)
+
+    start = perf_counter()
+    await asyncio.gather(*[user_turn(i) for i in range(turns)])
+    return recorder, perf_counter() - start
+
+
+def make_report(recorder: Recorder, wall_time: float) -> dict:
+    from ..agent.llm.llm import llm_report
+    from ..agent.tools.internet import race_report
+
+    report = {'wall_time': round(wall_time, 3), 'throughput': round(len(recorder.samples['total']) / wall_time, 3) if wall_time else 0, 'stages': {}}
+    for stage in stages:
+        samples = recorder.samples.get(stage, [])
+        if not samples:
+            continue
+        report['stages'][stage] = {
+            'count': len(samples),
+            'errors': recorder.errors.get(stage, 0),
+            'p50': round(percentile(samples, 50), 4),
+            'p95': round(percentile(samples, 95), 4),
+            'p99': round(percentile(samples, 99), 4),
+            'throughput': round(len(samples) / wall_time, 3) if wall_time else 0
+        }
+    report['stubs'] = dict(stub_stats)
+    report['keys'] = {key: stats['calls'] for key, stats in key_stats().items()}
+    report['llm'] = llm_report()
+    report['search_race'] = race_report()
+    return report
+
+
+def print_report(report: dict):
+    print(f"wall time: {report['wall_time']} s, throughput: {report['throughput']} turns/s")
+    print(f"{'stage':<18}{'count':>7}{'errors':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'per s':>9}")
+    for stage, stats in report['stages'].items():
+        print(f"{stage:<18}{stats['count']:>7}{stats['errors']:>8}{stats['p50']:>10.3f}{stats['p95']:>10.3f}{stats['p99']:>10.3f}{stats['throughput']:>9.2f}")
+    print(f"stubs: {report['stubs']}")
+    print(f"key calls: {report['keys']}")
+    print(f"llm: {report['llm']}")
+    print(f"search race: {report['search_race']}")
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    '''Stages whose p95 is more than "tolerance" (0.2 = 20%) slower than in the baseline'''
+    regressions = []
+    for stage, stats in report['stages'].items():
+        old = baseline.get('stages', {}).get(stage)
+        if old and old['p95'] and stats['p95'] > old['p95'] * (1 + tolerance):
+            regressions.append(f"{stage}: p95 {old['p95']} -> {stats['p95']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline latency benchmark of the agent pipeline with stub providers')
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10, help='users at the same time')
+    parser.add_argument('--provider', choices=['groq', 'google'], default='groq')
+    parser.add_argument('--corpus', default=corpus_path)
+    parser.add_argument('--profiles', help='json file with {"service": {"latency": s, "jitter": sigma, "error_rate": p}} overrides')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplies all stub latencies (0 = pure cpu overhead)')
+    parser.add_argument('--error-rate', type=float, help='the same error rate for all services')
+    parser.add_argument('--answer-chars', type=int, default=1500, help='length of stub llm answers')
+    parser.add_argument('--stream', action='store_true', help='stream the final answer into one edited message')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--baseline', help='report of a previous run; exit code 1 if some p95 got worse than --tolerance')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--verbose', action='store_true', help='keep the agent logs')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.CRITICAL)
+
+    profiles = {name: dict(profile) for name, profile in default_profiles.items()}
+    if args.profiles:
+        with open(args.profiles, 'r', encoding='utf-8') as f:
+            for name, profile in json.load(f).items():
+                profiles.setdefault(name, {'latency': 0.1, 'jitter': 0.3, 'error_rate': 0}).update(profile)
+    for profile in profiles.values():
+        profile['latency'] *= args.latency_scale
+        if args.error_rate is not None:
+            profile['error_rate'] = args.error_rate
+
+    with open(args.corpus, 'r', encoding='utf-8') as f:
+        corpus = json.load(f)
+    plans = {conversation['messages'][-1]['content']: conversation['tools'] for conversation in corpus}
+
+    for key in ['GEMINI_API_KEY', 'GROQ_API_KEY', 'TAVILY_API_KEY']:  # some clients refuse to be created without a key
+        os.environ.setdefault(key, 'stub')
+    bot = install_stubs(profiles, plans, answer_chars=args.answer_chars, seed=args.seed)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:  # tools write their files to the working directory
+        os.chdir(work_dir)
+        try:
+            recorder, wall_time = asyncio.run(run_benchmark(corpus, args.turns, args.concurrency, args.provider, bot, args.stream))
+        finally:
+            os.chdir(cwd)
+
+    report = make_report(recorder, wall_time)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions))
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''Startup budget: how long importing the bot takes before polling can start, and which heavy SDKs got imported at startup
+(they must be loaded on first use). Run from the ai_agent folder: python -m src.benchmark.import_time'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+target_module = 'src.bot.bot'
+# Imported on first use, never at startup
+lazy_modules = ['google.generativeai', 'google.genai', 'groq', 'fitz', 'PyPDF2', 'docx', 'tavily', 'duckduckgo_search',
+                'e2b_code_interpreter', 'PyMovieDb', 'youtube_transcript_api', 'deep_translator', 'lxml_html_clean', 'numpy', 'PIL.Image',
+                'bs4', 'pylatexenc']
+
+measure_code = '''
+import sys, json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def measure(module: str = target_module, importtime: bool = False) -> tuple[dict, str]:
+    '''Imports the module in a fresh interpreter. Returns ({'seconds': ..., 'modules': [...]}, -X importtime output)'''
+    env = dict(os.environ)
+    env.setdefault('BOT_TOKEN', '123456:stub')  # aiogram checks the token format when the bot is created
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', measure_code.format(module=module)]
+    result = subprocess.run(command, capture_output=True, text=True, env=env, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_output: str, top: int) -> list[tuple[str, float]]:
+    '''Top-level packages and own modules by cumulative import time (seconds)'''
+    packages = {}
+    for line in importtime_output.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if '.' not in name or name.startswith('src.'):
+            packages[name] = max(packages.get(name, 0), int(parts[1]) / 1e6)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time of the bot and heavy modules loaded at startup')
+    parser.add_argument('--module', default=target_module)
+    parser.add_argument('--runs', type=int, default=3, help='the best run is reported')
+    parser.add_argument('--budget', type=float, default=2.5, help='seconds; exit code 1 if the import is slower')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [measure(args.module)[0] for _ in range(args.runs)]
+    best = min(runs, key=lambda run: run['seconds'])
+    _, importtime_output = measure(args.module, importtime=True)
+
+    print(f'import {args.module}: {best["seconds"]:.3f} s (budget {args.budget} s)')
+    for name, seconds in slowest_imports(importtime_output, args.top):
+        print(f'{name:40} {seconds:8.3f} s')
+
+    eager = [module for module in lazy_modules if module in best['modules']]
+    if eager:
+        print(f'imported at startup, should be lazy: {", ".join(eager)}')
+    if eager or best['seconds'] > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
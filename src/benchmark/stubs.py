@@ -0,0 +1,399 @@
+'''Local stand-ins for the external services (Groq, Gemini, Tavily, DuckDuckGo, web pages, WolframAlpha, codecogs, e2b, Telegram Bot API).
+Every stub sleeps for a random latency and fails with the configured probability, nothing goes to the network'''
+import os
+import json
+import time
+import atexit
+import random
+import shutil
+import asyncio
+import tempfile
+from types import SimpleNamespace
+from collections import Counter
+
+
+# latency: median in seconds, jitter: sigma of the lognormal distribution, error_rate: probability of an exception
+default_profiles = {
+    'groq': {'latency': 0.35, 'jitter': 0.3, 'error_rate': 0.01},
+    'google': {'latency': 0.9, 'jitter': 0.35, 'error_rate': 0.01},
+    'tavily': {'latency': 0.8, 'jitter': 0.4, 'error_rate': 0.02},
+    'duckduckgo': {'latency': 0.5, 'jitter': 0.5, 'error_rate': 0.05},
+    'web': {'latency': 0.6, 'jitter': 0.6, 'error_rate': 0.1},  # web pages, errors go to the Tavily fallback
+    'wolfram': {'latency': 1.2, 'jitter': 0.4, 'error_rate': 0.02},
+    'codecogs': {'latency': 0.3, 'jitter': 0.3, 'error_rate': 0.01},
+    'image_download': {'latency': 0.4, 'jitter': 0.4, 'error_rate': 0.02},
+    'e2b': {'latency': 2.0, 'jitter': 0.3, 'error_rate': 0.02},
+    'telegram': {'latency': 0.12, 'jitter': 0.3, 'error_rate': 0.005}
+}
+
+first_token_share = 0.25  # streams: part of the latency before the first piece
+stub_stats = Counter()  # "<service>_calls", "<service>_errors"
+
+answer_template = '''## Answer
+
+Here is what I found about **{query}**:
+
+- the first point with `inline code`
+- the second point with a [link](https://example.com)
+
+$$E = mc^2$$
+
+| name | value |
+|------|-------|
+| a    | 1     |
+| b    | 2     |
+
+```python
+print(sum(range(10)))
+```
+
+'''
+
+
+class StubError(Exception):
+    pass
+
+
+class Service:
+    '''Latency and errors of one service'''
+
+    def __init__(self, name: str, profile: dict, rng: random.Random):
+        self.name = name
+        self.profile = profile
+        self.rng = rng
+
+    def delay(self) -> float:
+        return self.profile['latency'] * self.rng.lognormvariate(0, self.profile['jitter'])
+
+    def check(self):
+        stub_stats[f'{self.name}_calls'] += 1
+        if self.rng.random() < self.profile['error_rate']:
+            stub_stats[f'{self.name}_errors'] += 1
+            raise StubError(f'{self.name} stub error')
+
+    def call(self):
+        time.sleep(self.delay())
+        self.check()
+
+    async def async_call(self):
+        await asyncio.sleep(self.delay())
+        self.check()
+
+    async def async_stream(self, text: str, piece_chars: int = 20):
+        '''The first piece after a quarter of the latency, the rest spread over the remaining time'''
+        delay = self.delay()
+        await asyncio.sleep(delay * first_token_share)
+        self.check()
+        pieces = [text[i:i + piece_chars] for i in range(0, len(text), piece_chars)]
+        for piece in pieces:
+            yield piece
+            await asyncio.sleep(delay * (1 - first_token_share) / len(pieces))
+
+
+def make_answer(query: str, answer_chars: int) -> str:
+    text = answer_template.format(query=query[:100])
+    while len(text) < answer_chars:
+        text += f'More details about {query[:50]}. ' * 10 + '\n\n'
+    return text
+
+
+def last_user_message(messages: list[dict]) -> str:
+    for message in reversed(messages):
+        if message['role'] == 'user':
+            return message['content']
+    return messages[-1]['content']
+
+
+# ---------------------------------------------< GROQ >---------------------------------------------
+def groq_response(kwargs: dict, plans: dict, answer_chars: int):
+    query = last_user_message(kwargs['messages'])
+    tool_calls = []
+    content = make_answer(query, answer_chars)
+    if kwargs.get('tools') and plans.get(query):
+        content = ''
+        tool_calls = [
+            SimpleNamespace(function=SimpleNamespace(name=tool['func_name'], arguments=json.dumps({'input': tool['func_input']})))
+            for tool in plans[query]
+        ]
+
+    prompt_tokens = sum(len(str(message['content'])) for message in kwargs['messages']) // 4
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=tool_calls, executed_tools=None))],
+        usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4, prompt_tokens_details=None)
+    )
+
+
+def rate_limit_headers(calls: int) -> dict:
+    return {'x-ratelimit-remaining-requests': str(max(1000 - calls, 0)), 'x-ratelimit-reset-requests': '1m',
+            'x-ratelimit-remaining-tokens': '100000', 'x-ratelimit-reset-tokens': '1m'}
+
+
+class StubGroq:
+    def __init__(self, service: Service, plans: dict, answer_chars: int, api_key: str):
+        self.api_key = api_key
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create, with_raw_response=SimpleNamespace(create=self.create_raw)))
+        self.service, self.plans, self.answer_chars = service, plans, answer_chars
+
+    def create(self, **kwargs):
+        self.service.call()
+        return groq_response(kwargs, self.plans, self.answer_chars)
+
+    def create_raw(self, **kwargs):
+        self.calls += 1
+        response = self.create(**kwargs)
+        return SimpleNamespace(headers=rate_limit_headers(self.calls), parse=lambda: response)
+
+
+class StubAsyncGroq(StubGroq):
+    async def create(self, **kwargs):
+        if kwargs.get('stream'):
+            return self.stream(groq_response(kwargs, self.plans, self.answer_chars).choices[0].message.content)
+        await self.service.async_call()
+        return groq_response(kwargs, self.plans, self.answer_chars)
+
+    async def stream(self, text: str):
+        async for piece in self.service.async_stream(text):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece, executed_tools=None))], x_groq=None)
+
+    async def create_raw(self, **kwargs):
+        self.calls += 1
+        response = await self.create(**kwargs)
+
+        async def parse():
+            return response
+
+        return SimpleNamespace(headers=rate_limit_headers(self.calls), parse=parse)
+
+
+# ---------------------------------------------< GEMINI >---------------------------------------------
+def gemini_response(content, tools, plans: dict, answer_chars: int):
+    query = content[0] if isinstance(content, list) else content
+    parts = [SimpleNamespace(function_call=SimpleNamespace(name='', args={}), text=make_answer(query, answer_chars))]
+    if tools and plans.get(query):
+        parts = [
+            SimpleNamespace(function_call=SimpleNamespace(name=tool['func_name'], args={'input': tool['func_input']}), text='')
+            for tool in plans[query]
+        ]
+
+    return SimpleNamespace(
+        candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))],
+        text=''.join(part.text for part in parts),
+        usage_metadata=SimpleNamespace(prompt_token_count=len(query) // 4, cached_content_token_count=0, candidates_token_count=answer_chars // 4)
+    )
+
+
+class StubChat:
+    def __init__(self, model: 'StubGenerativeModel'):
+        self.model = model
+
+    def send_message(self, content, tools=None):
+        self.model.service.call()
+        return gemini_response(content, tools, self.model.plans, self.model.answer_chars)
+
+    async def send_message_async(self, content, tools=None, stream=False):
+        if stream:
+            return StubGeminiStream(self.model.service, gemini_response(content, tools, self.model.plans, self.model.answer_chars))
+        await self.model.service.async_call()
+        return gemini_response(content, tools, self.model.plans, self.model.answer_chars)
+
+
+class StubGeminiStream:
+    def __init__(self, service: Service, response):
+        self.service = service
+        self.text = response.text
+        self.usage_metadata = response.usage_metadata
+
+    async def __aiter__(self):
+        async for piece in self.service.async_stream(self.text):
+            yield SimpleNamespace(text=piece)
+
+
+class StubGenerativeModel:
+    def __init__(self, service: Service, plans: dict, answer_chars: int):
+        self.service, self.plans, self.answer_chars = service, plans, answer_chars
+
+    def start_chat(self, history=None):
+        return StubChat(self)
+
+
+# ---------------------------------------------< SEARCH >---------------------------------------------
+class StubTavily:
+    def __init__(self, service: Service):
+        self.service = service
+
+    def search(self, query: str, max_results: int = 5, **kwargs):
+        self.service.call()
+        return {'results': [
+            {'url': f'https://example.com/{i}', 'title': f'{query} {i}', 'content': f'Some text about {query}. ' * 20}
+            for i in range(max_results)
+        ]}
+
+    def extract(self, urls: list[str] | str, **kwargs):
+        self.service.call()
+        urls = [urls] if isinstance(urls, str) else urls
+        return {'results': [{'url': url, 'raw_content': f'Page {url}. ' * 200} for url in urls], 'failed_results': []}
+
+    def get_search_context(self, query: str, **kwargs):
+        self.service.call()
+        return f'News about {query}. ' * 50
+
+
+def stub_ddgs(service: Service):
+    '''DDGS class replacement bound to the service'''
+    class StubDDGS:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def answers(self, text: str):
+            service.call()
+            return [{'text': f'{text} is described on wikipedia'}]
+
+        def images(self, text: str, max_results: int = 9):
+            service.call()
+            return [{'image': f'https://example.com/{i}.png'} for i in range(max_results)]
+
+        def text(self, text: str, max_results: int = 5):
+            service.call()
+            return [{'href': f'https://example.com/{i}'} for i in range(max_results)]
+
+    return StubDDGS
+
+
+def stub_download_images(service: Service):
+    async def download_images(image_urls, timeout: float = 30):
+        async def download(url):
+            await service.async_call()
+            return url.split('/')[-1]
+
+        results = await asyncio.gather(*[download(url) for url in image_urls], return_exceptions=True)
+        return [result for result in results if isinstance(result, str)]
+
+    return download_images
+
+
+page_template = '''<html><head><title>{url}</title><script>var tracking = 1;</script></head><body>
+<nav><a href="/">Home</a> <a href="/news">News</a></nav>
+<article><h1>{url}</h1>{paragraphs}</article>
+<div class="cookie-banner">We use cookies</div><footer>Copyright</footer>
+</body></html>'''
+
+
+def stub_fetch(service: Service):
+    '''web_page.fetch replacement: an article page with boilerplate around it'''
+    async def fetch(url: str, session=None):
+        try:
+            await service.async_call()
+        except StubError:
+            return None
+        paragraphs = ''.join(f'<p>Paragraph {i} of the page {url} with some text about the topic.</p>' for i in range(30))
+        return page_template.format(url=url, paragraphs=paragraphs).encode(), 'text/html'
+
+    return fetch
+
+
+# ---------------------------------------------< WOLFRAM / CODECOGS >---------------------------------------------
+class StubRequests:
+    '''requests module replacement: WolframAlpha and codecogs urls'''
+
+    def __init__(self, services: dict[str, Service]):
+        self.services = services
+
+    def get(self, url: str, timeout: float | None = None, **kwargs):
+        if 'codecogs' in url:
+            self.services['codecogs'].call()
+            return SimpleNamespace(status_code=200, content=b'\x89PNG stub', text='')
+
+        self.services['wolfram'].call()
+        text = 'Result: 42\nImage: https://example.com/wolfram.png\n' if 'llm-api' in url else '42'
+        return SimpleNamespace(status_code=200, content=text.encode(), text=text)
+
+
+# ---------------------------------------------< E2B >---------------------------------------------
+def stub_sandbox(service: Service):
+    class StubSandbox:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def run_code(self, code: str):
+            service.call()
+            return SimpleNamespace(logs=SimpleNamespace(stdout=['45\n'], stderr=[]), results=[])
+
+    return StubSandbox
+
+
+# ---------------------------------------------< TELEGRAM >---------------------------------------------
+class StubBot:
+    def __init__(self, service: Service):
+        self.service = service
+        self.sent_messages = 0
+
+    async def send_message(self, chat_id: int, text: str, parse_mode: str | None = None, **kwargs):
+        await self.service.async_call()
+        if len(text) > 4096:
+            raise StubError(f'Bad Request: message is too long ({len(text)})')
+        self.sent_messages += 1
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=self.sent_messages, text=text)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, parse_mode: str | None = None, **kwargs):
+        await self.service.async_call()
+        if len(text) > 4096:
+            raise StubError(f'Bad Request: message is too long ({len(text)})')
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=message_id, text=text)
+
+
+def use_temporary_storage() -> str:
+    '''Points the databases, the file cache and the logs to a temporary directory that is removed at exit, so the llm response cache
+    and the usage accounting of a run don't write stub rows into src/agent/cache.db and src/bot/database.db.
+    Must be called before the agent modules are imported (they create their tables on import). Returns the directory'''
+    from ..config.config import load_config
+
+    config = load_config()
+    storage_dir = tempfile.mkdtemp(prefix='benchmark_')
+    atexit.register(shutil.rmtree, storage_dir, True)  # registered first, so it runs after the last usage flush
+    config.database.path = os.path.join(storage_dir, 'database.db')
+    config.database.cache_path = os.path.join(storage_dir, 'cache.db')
+    config.database.cache_files_dir = os.path.join(storage_dir, 'cache_files')
+    config.logs.log_path = os.path.join(storage_dir, 'logs', 'agent.log')
+    config.logs.errors_log_path = os.path.join(storage_dir, 'logs', 'agent_errors.log')
+    return storage_dir
+
+
+def install_stubs(profiles: dict[str, dict], plans: dict[str, list], answer_chars: int = 1500, seed: int = 0) -> StubBot:
+    '''Replaces the network clients in the agent modules with the stubs. Returns the Telegram bot stub'''
+    from ..agent import agent
+    from ..agent.llm import groq, google
+    from ..agent.tools import internet, web_page, wolfram, latex, code_interpreter
+
+    rng = random.Random(seed)
+    services = {name: Service(name, profile, rng) for name, profile in profiles.items()}
+
+    groq_client = [StubGroq(services['groq'], plans, answer_chars, f'stub-key-{i}') for i in range(2)]
+    async_groq_client = [StubAsyncGroq(services['groq'], plans, answer_chars, f'stub-key-{i}') for i in range(2)]
+    groq.get_groq_client = lambda: groq_client
+    groq.get_async_groq_client = lambda: async_groq_client
+
+    model = StubGenerativeModel(services['google'], plans, answer_chars)
+    google.get_model = lambda *args, **kwargs: model
+    google.cached_model = lambda model_name, system_instruction, tools, history: (None, history)
+
+    tavily_client = StubTavily(services['tavily'])
+    internet.get_tavily_client = lambda: tavily_client
+    internet.DDGS = stub_ddgs(services['duckduckgo'])
+    internet.download_images = stub_download_images(services['image_download'])
+    web_page.fetch = stub_fetch(services['web'])
+
+    wolfram.requests = StubRequests(services)
+    latex.requests = StubRequests(services)
+    code_interpreter.Sandbox = stub_sandbox(services['e2b'])
+
+    # The persistent tool and search caches would turn every run after the first one into cache hits
+    agent.cache_get = lambda namespace, key: (False, None, [])
+    agent.cache_set = lambda *args, **kwargs: None
+    internet.cache_get = agent.cache_get
+    internet.cache_set = agent.cache_set
+
+    return StubBot(services['telegram'])
@@ -6,20 +6,31 @@ from datetime import datetime
 from collections import Counter
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command, StateFilter
-from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.types import Message, CallbackQuery, FSInputFile, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup, PhotoSize
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import default_state, State, StatesGroup
 
-from .formatter import markdown_to_html, split_html
-from ..agent.agent import system_prompt, llm_select_tool, llm_use_tool
-from ..agent.llm.llm import llm_api
-from ..agent.llm.google import genai_api
-from ..agent.llm.groq import groq_api, groq_api_compound
+from .streaming import stream_to_telegram, text_chunks
+from ..agent.agent import system_prompt, turn_budget, select_tools, llm_use_tool, provider_limiter, answer_stream
+from ..agent.cache import cache_stats
+from ..agent.router import router_stats
+from ..agent.single_flight import single_flight_stats
+from ..agent.limits import limit, limits_stats
+from ..agent.llm.usage import prompt_cache_report
+from ..agent.llm.keys import key_stats
+from ..agent.tools.web_page import extract_stats, close_http_session
+from ..agent.tools.internet import race_report, search_cache_stats
+from ..agent.accounting import set_usage_context, quota_exceeded, user_daily_usage, usage_report
+from ..agent.context import build_context
+from ..agent.passages import select_passages, passage_budgets, passage_stats
+from ..agent.llm.llm import async_llm_api, llm_report, response_cache_ttl, route
+from ..agent.llm.google import async_genai_stream, session_report
+from ..agent.llm.groq import async_groq_stream, async_groq_compound_stream, format_time
 from ..agent.tools.wolfram import wolfram_simple_api
 from ..agent.tools.code_interpreter import code_interpreter
 from ..agent.tools.translate import detect_language, translate
 from ..agent.tools.latex import latex_to_pdf, async_expressions_to_png
-from ..agent.tools.file_utils import files_to_text, speech_recognition, merge_pngs_vertically
+from ..agent.tools.file_utils import files_to_text, async_speech_recognition, merge_pngs_vertically
 from .database import (
     utc_time,
     text_to_hash,
@@ -33,6 +44,7 @@ from .database import (
     sql_set_user_state,
     sql_get_user_state,
     sql_clear_user_state,
+    sql_get_user_quotas,
 )
 from ..config.logger import logger
 from ..config.config import load_config, Config
@@ -40,6 +52,8 @@ from ..config.config import load_config, Config
 
 config: Config = load_config()
 bot_token = config.tg_bot.token
+history_limit = 50  # messages taken from the database, build_context then fits them into the token budget
+expensive_callbacks = ('fix_formatting', 'translate_message', 'translate_help_message', 'render_latex', 'run_python_code')  # buttons that call the llm or a paid tool
 
 
 class FSM(StatesGroup):
@@ -54,19 +68,47 @@ bot = Bot(token=str(bot_token))
 dp = Dispatcher()
 
 
+def user_quota_exceeded(user_id: int) -> str | None:
+    '''quota_exceeded with the quotas of the user (sqlite, run it in a thread)'''
+    return quota_exceeded(user_id, **sql_get_user_quotas(user_id))
+
+
 @dp.message.middleware()
 async def state_restore_middleware(handler, event: Message, data):
-    '''Middleware to restore user state from database'''
+    '''Middleware to restore user state from database. Also sets the user and the mode for the usage accounting
+    and stops messages of users that used up their daily quota (commands still work)'''
     state = data['state']
     current_state = await state.get_state()
     
     # Only restore if no current state (fresh start)
     if current_state is None:
         await restore_user_state(event.from_user.id, state)
+        current_state = await state.get_state()
+
+    set_usage_context(event.from_user.id, (current_state or 'default').split(':')[-1])
+    if not (event.text or '').startswith('/') and event.from_user.id not in ADMIN_IDS:
+        exceeded = await asyncio.to_thread(user_quota_exceeded, event.from_user.id)
+        if exceeded:
+            logger.warning(f'{event.from_user.full_name}({event.from_user.id}) reached the daily quota: {exceeded}')
+            await event.answer(f'You have reached the daily limit of {exceeded}. It resets at 00:00 UTC.')
+            return
     
     return await handler(event, data)
 
 
+@dp.callback_query.middleware()
+async def usage_context_middleware(handler, event: CallbackQuery, data):
+    '''Calls made by the buttons are accounted to the user too. The buttons that call the llm or a paid tool check the quota first'''
+    set_usage_context(event.from_user.id, 'callback')
+    if (event.data or '').startswith(expensive_callbacks) and event.from_user.id not in ADMIN_IDS:
+        exceeded = await asyncio.to_thread(user_quota_exceeded, event.from_user.id)
+        if exceeded:
+            logger.warning(f'{event.from_user.full_name}({event.from_user.id}) reached the daily quota: {exceeded}')
+            await event.answer(f'You have reached the daily limit of {exceeded}. It resets at 00:00 UTC.', show_alert=True)
+            return
+    return await handler(event, data)
+
+
 async def restore_user_state(user_id: int, state: FSMContext):
     '''Restore user state from database'''
     saved_state = sql_get_user_state(user_id)
@@ -87,6 +129,19 @@ async def save_user_state(user_id: int, state_name: str):
     sql_set_user_state(user_id, state_name)
 
 
+# The long side (px) a photo needs for the task. Telegram keeps several sizes of every photo (90, 320, 800, 1280, 2560),
+# the smallest one that is big enough is downloaded
+photo_min_side = {'describe': 800, 'question': 1280}
+
+
+def pick_photo(photos: list[PhotoSize], task: str = 'question') -> PhotoSize:
+    '''The smallest size of the photo with the long side of at least photo_min_side[task] (the largest if none is big enough)'''
+    for photo in sorted(photos, key=lambda photo: photo.width * photo.height):
+        if max(photo.width, photo.height) >= photo_min_side[task]:
+            return photo
+    return photos[-1]
+
+
 async def download_file_for_id(file_id, extension):
 
     file = await bot.get_file(file_id)
@@ -150,6 +205,61 @@ async def log_command_handler(message: Message) -> None:
         await message.reply('You are not an admin')
 
 
+@dp.message(Command('usage'))
+async def usage_command_handler(message: Message) -> None:
+    '''Today's usage of the user and the quotas'''
+    usage = await asyncio.to_thread(user_daily_usage, message.from_user.id)
+    quotas = sql_get_user_quotas(message.from_user.id)
+    limits = {name: quotas[f'daily_{name}'] or '∞' for name in ['tokens', 'requests']}
+    await message.answer(f'Today (UTC): {usage["requests"]}/{limits["requests"]} requests, {usage["tokens"]}/{limits["tokens"]} tokens')
+    logger.info(f'{message.from_user.full_name}({message.from_user.username}) - usage command')
+
+
+@dp.message(Command('quota'))
+async def quota_command_handler(message: Message) -> None:
+    '''/quota <user_id> <daily tokens> [daily requests]: per-user quotas, 0 = no limit'''
+    if message.from_user.id not in ADMIN_IDS:
+        logger.warning(f'{message.from_user.full_name}({message.from_user.id}) try use /quota command')
+        await message.reply('You are not an admin')
+        return
+    try:
+        user_id, daily_tokens, *daily_requests = map(int, message.text.split()[1:])
+    except ValueError:
+        await message.reply('Usage: /quota <user_id> <daily tokens> [daily requests]')
+        return
+    sql_change_setting(user_id, 'daily_token_quota', daily_tokens)
+    if daily_requests:
+        sql_change_setting(user_id, 'daily_request_quota', daily_requests[0])
+    await message.reply(f'Quotas of {user_id}: {sql_get_user_quotas(user_id)}')
+    logger.info(f'Admin set quotas of {user_id}: {daily_tokens} tokens, {daily_requests} requests')
+
+
+@dp.message(Command('stats'))
+async def stats_command_handler(message: Message) -> None:
+    if message.from_user.id in ADMIN_IDS:
+        stats = {
+            'cache': cache_stats(),
+            'router': dict(router_stats),
+            'single_flight': dict(single_flight_stats),
+            'queues': limits_stats(),
+            'prompt_cache': prompt_cache_report(),
+            'keys': key_stats(),
+            'web_pages': dict(extract_stats),
+            'search_race': race_report(),
+            'search_cache': dict(search_cache_stats),
+            'passages': dict(passage_stats),
+            'gemini_sessions': session_report(),
+            'usage_today': await asyncio.to_thread(usage_report),
+            'llm': llm_report()
+        }
+        text = '\n'.join(f'{name}: {value}' for name, value in stats.items())
+        await message.answer(f'```stats\n{text}\n```', parse_mode='Markdown')
+        logger.info('Admin used /stats command')
+    else:
+        logger.warning(f'{message.from_user.full_name}({message.from_user.id}) try use /stats command')
+        await message.reply('You are not an admin')
+
+
 @dp.message(StateFilter(FSM.processing))
 async def processing_message_handler(message: Message, state: FSMContext) -> None:
     inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f'Cancel generation', callback_data=f'clear_state')]])
@@ -348,7 +458,7 @@ async def wolfram_message_handler(message: Message, state: FSMContext) -> None:
     await state.set_state(FSM.processing)
     if message.photo:
         await message.answer("Processing your WolframAlpha query... Image recognition will take time.")
-        file = await bot.get_file(message.photo[-1].file_id)
+        file = await bot.get_file(pick_photo(message.photo, 'question').file_id)
         file_path = file.file_path
         file_name = file.file_path.split('/')[-1]
         await bot.download_file(file_path, file_name)
@@ -356,18 +466,18 @@ async def wolfram_message_handler(message: Message, state: FSMContext) -> None:
         input_files = [file_name]
         system_prompt = "You are a helpful assistant who can turn images into a query for Wolfram Alpha. In your answer, provide ONLY the text of the expression, without any additional comments. If the image contains a mathematical expression, write it down exactly as it appears. If there are several expressions in the picture, write only the first one."
         prompt = f"Give a query for Wolfram Alpha from this image"
-        query = llm_api(messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}], files=input_files)
+        query = await async_llm_api(messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}], files=input_files)
     else:
         await message.answer("Processing your WolframAlpha query... ")
         query = message.text
-    response = wolfram_simple_api(query)
+    response = await asyncio.to_thread(wolfram_simple_api, query)
     temp_message_id = message.message_id + 1
     if response is None:
         await bot.edit_message_text(chat_id=message.chat.id, message_id=temp_message_id, text="WolframAlpha couldn't process your query directly. Fixing...")
         prompt = f"Fix this query for Wolfram Alpha: {query}."
         system_prompt = "You are a helpful assistant that corrects queries for Wolfram Alpha. In your response, provide the corrected query ONLY"
-        new_query = llm_api(messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}], files=[])
-        response = wolfram_simple_api(new_query)
+        new_query = await async_llm_api(messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt}], files=[], cache_ttl=response_cache_ttl)
+        response = await asyncio.to_thread(wolfram_simple_api, new_query)
 
     await bot.delete_message(chat_id=message.chat.id, message_id=temp_message_id)
     if isinstance(response, str) and (response.endswith('.png') or response.endswith('.jpg') or response.endswith('.jpeg') or response.endswith('.webp')):
@@ -406,7 +516,7 @@ async def groq_and_gpt_oss_message_handler(message: Message, state: FSMContext)
     elif message.voice:
         await message.answer('Recognizing audio...')
         file_name = await download_file_for_id(file_id=message.voice.file_id, extension='mp3')
-        text = speech_recognition(file_name=file_name).strip()
+        text = (await async_speech_recognition(file_name)).strip()
         os.remove(file_name)
         await bot.edit_message_text(chat_id=message.chat.id, message_id=message_to_delete, text=f'Recognized as "{text}"')
         message_to_delete += 1
@@ -415,30 +525,24 @@ async def groq_and_gpt_oss_message_handler(message: Message, state: FSMContext)
         text = str(message.text)
     await message.answer('⏳')
 
-    messages = sql_select_history(id=message.from_user.id)
+    messages = sql_select_history(id=message.from_user.id, n=history_limit, with_tokens=True)
     messages.append({'role': 'user', 'content': text})
     sql_check_user(user_id=message.from_user.id, telegram_name=message.from_user.full_name, telegram_username=message.from_user.username)
     sql_insert_message(user_id=message.from_user.id, role='user', content=text)
     logger.info(f'New message by {message.from_user.full_name}. messages: {text}, files: {input_files}, state: {previous_state}')
     
+    start_time = datetime.now()
+    tools = []
     if previous_state == FSM.groq:
         settings = sql_get_settings(user_id=message.from_user.id, settings=['hide_execution_info', 'compound_model','browser_automation_enabled'])
-        answer, tools, time = groq_api_compound(messages=messages, model=settings['compound_model'], files=input_files, only_answer=False, browser_automation=settings['browser_automation_enabled'])
+        chunks = async_groq_compound_stream(messages=build_context(messages, settings['compound_model']), model=settings['compound_model'], files=input_files, browser_automation=settings['browser_automation_enabled'], executed_tools=tools)
     else: # elif previous_state == FSM.gpt_oss
         model = sql_get_settings(user_id=message.from_user.id, settings='gpt_oss_model')['gpt_oss_model']
-        answer = groq_api(messages=messages, files=input_files, model=model)
-        tools = []
-        
-    await bot.delete_message(chat_id=message.chat.id, message_id=message_to_delete)
+        chunks = async_groq_stream(messages=build_context(messages, model), files=input_files, model=model)
 
-    
-    for part in split_html(markdown_to_html(answer)):
-        try:
-            await message.answer(part, parse_mode='HTML')
-        except Exception as e:
-            logger.warning(f'Error with parse_mode: {e}. Part {part}')
-            inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Fix formatting', callback_data=f'fix_formatting')]])
-            await message.answer(part, reply_markup=inline_keyboard)
+    # the "⏳" message becomes the answer and is edited as the text comes
+    answer, _ = await stream_to_telegram(bot, message.chat.id, chunks, placeholder_id=message_to_delete)
+    time = format_time(start_time)
 
 
     logger.info(f'Mode: {previous_state}. Answer to {message.from_user.full_name}({text}): {answer}')
@@ -465,6 +569,7 @@ async def groq_and_gpt_oss_message_handler(message: Message, state: FSMContext)
             InlineKeyboardButton(text=hide_text, callback_data='hide_execution_info'),
             InlineKeyboardButton(text='Change model', callback_data='change_compound_model')],[
             InlineKeyboardButton(text=browser_text, callback_data='change_browser_automation_enabled')]])
+        from .formatter import markdown_to_html
         await message.answer(markdown_to_html(f"{model}\n{tools}\n{time}"), parse_mode='HTML', reply_markup=inline_keyboard_2)
 
     await state.set_state(previous_state)
@@ -487,7 +592,7 @@ async def gemini_message_handler(message: Message, state: FSMContext) -> None:
         await message.answer('The document has been read ✅. Every time you ask for a document, you will need to send it.')
         message_to_delete += 1
     elif message.photo:
-        file_id = message.photo[-1].file_id
+        file_id = pick_photo(message.photo, 'question' if message.caption else 'describe').file_id
         file = await bot.get_file(file_id)
         file_path = file.file_path
         file_name = file.file_path.split('/')[-1]
@@ -499,7 +604,7 @@ async def gemini_message_handler(message: Message, state: FSMContext) -> None:
     elif message.voice:
         await message.answer('Recognizing audio...')
         file_name = await download_file_for_id(file_id=message.voice.file_id, extension='mp3')
-        text = speech_recognition(file_name=file_name).strip()
+        text = (await async_speech_recognition(file_name)).strip()
         os.remove(file_name)
         await bot.edit_message_text(chat_id=message.chat.id, message_id=message_to_delete, text=f'Recognized as "{text}"')
         message_to_delete += 1
@@ -508,24 +613,15 @@ async def gemini_message_handler(message: Message, state: FSMContext) -> None:
         text = str(message.text)
     await message.answer('⏳')
 
-    messages = sql_select_history(id=message.from_user.id)
+    messages = sql_select_history(id=message.from_user.id, n=history_limit, with_tokens=True)
     messages.append({'role': 'user', 'content': text})
     sql_check_user(user_id=message.from_user.id, telegram_name=message.from_user.full_name, telegram_username=message.from_user.username)
     sql_insert_message(user_id=message.from_user.id, role='user', content=text)
     logger.info(f'New message by {message.from_user.full_name}. messages: {text}, files: {input_files}, state: gemini')
     
     model = sql_get_settings(user_id=message.from_user.id, settings='gemini_model')['gemini_model']
-    answer = genai_api(messages=messages, files=input_files, model=model)
-        
-    await bot.delete_message(chat_id=message.chat.id, message_id=message_to_delete)
-
-    for part in split_html(markdown_to_html(answer)):
-        try:
-            await message.answer(part, parse_mode='HTML')
-        except Exception as e:
-            logger.warning(f'Error with parse_mode: {e}. Part {part}')
-            inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Fix formatting', callback_data=f'fix_formatting')]])
-            await message.answer(part, reply_markup=inline_keyboard)
+    chunks = async_genai_stream(messages=build_context(messages, model), files=input_files, model=model, session_id=message.from_user.id)
+    answer, _ = await stream_to_telegram(bot, message.chat.id, chunks, placeholder_id=message_to_delete)
 
     logger.info(f'Mode: gemini. Answer to {message.from_user.full_name}({text}): {answer}')
     sql_insert_message(user_id=message.from_user.id, role='assistant', content=answer)
@@ -536,6 +632,15 @@ async def gemini_message_handler(message: Message, state: FSMContext) -> None:
 @dp.message(StateFilter(default_state))
 async def message_handler(message: Message, state: FSMContext) -> None:
     await state.set_state(FSM.processing)  # mark processing
+    try:
+        await default_message_handler(message, state)
+    finally:  # errors and late tools must never leave the user in the processing state
+        if await state.get_state() == FSM.processing.state:
+            await state.clear()
+
+
+async def default_message_handler(message: Message, state: FSMContext) -> None:
+    deadline = asyncio.get_running_loop().time() + turn_budget
 
     chat_id = message.chat.id
     user = message.from_user.full_name
@@ -558,7 +663,7 @@ async def message_handler(message: Message, state: FSMContext) -> None:
         await message.reply('Recognizing audio...')
         file_name = await download_file_for_id(file_id=message.voice.file_id, extension='mp3')
         
-        text = speech_recognition(file_name=file_name).strip()
+        text = (await async_speech_recognition(file_name)).strip()
         os.remove(file_name)
         
         temp_message_text[0] = temp_message_text[0][:-2] + '✅'
@@ -568,7 +673,7 @@ async def message_handler(message: Message, state: FSMContext) -> None:
     
     elif message.photo:
         await message.reply('Every time you ask a new image question, you will have to submit the image again.')
-        file_id = message.photo[-1].file_id
+        file_id = pick_photo(message.photo, 'question' if message.caption else 'describe').file_id
         file = await bot.get_file(file_id)
         file_path = file.file_path
         file_name = file.file_path.split('/')[-1]
@@ -602,49 +707,44 @@ async def message_handler(message: Message, state: FSMContext) -> None:
     
     await message.reply('\n'.join(temp_message_text))
     # ======================= take history and files =======================
-    messages = sql_select_history(id=user_id)
+    messages = sql_select_history(id=user_id, n=history_limit, with_tokens=True)
     messages.insert(0, {'role': 'system', 'content': system_prompt})
     messages.append({'role': 'user', 'content': text})
     sql_insert_message(user_id=user_id, role='user', content=text)
      
     for file in input_files:  # If the file is not a picture, convert the file to text and add it to the user message
         if not(file.endswith('.png') or file.endswith('.jpg') or file.endswith('.jpeg') or file.endswith('.webp')):
-            messages[-1]['content'] += f'\n\n{file}:\n{files_to_text(file)}'
+            document = await asyncio.to_thread(select_passages, await asyncio.to_thread(files_to_text, file), text, passage_budgets['document'])
+            messages[-1]['content'] += f'\n\n{file}:\n{document}'
             input_files.remove(file)
 
+    # the history is cut to the token budget of the model the turn is routed to (a tool result can only route it to a bigger one)
+    messages = build_context(messages, route(messages, input_files, record=False)['google'])
     logger.info(f'new message by {user}. messages: {text}, files: {input_files}')
 
 
     # ======================= select tool, use tool and get answer =======================
-    loop = asyncio.get_running_loop()
-    
-
-    select_task = loop.run_in_executor(None, llm_select_tool, messages, input_files, 'google')
-    api_task = loop.run_in_executor(None, llm_api, messages, input_files, 'google')
-
-    tools = await select_task
+    # one request: the model either answers directly or calls tools
+    answer, tools = await select_tools(messages=messages, files=input_files, provider='google')
     
     if tools == []:
-        
-        temp_message_text[0] = temp_message_text[0][:-2] + '✅'
-        temp_message_text[1] = temp_message_text[1][:-2] + '✅'
-        await bot.edit_message_text(chat_id=chat_id, message_id=temp_message_id, text='\n'.join(temp_message_text))
-        answer = await api_task
         output_files = []
+        chunks = text_chunks(answer)
     else:
         temp_message_text[0] = temp_message_text[0][:-2] + '(' +','.join(set([i['func_name'] for i in tools])) + ')✅'
         await bot.edit_message_text(chat_id=chat_id, message_id=temp_message_id, text='\n'.join(temp_message_text))
 
-        tool_result, output_files = await llm_use_tool(tools=tools)
+        tool_result, output_files = await llm_use_tool(tools=tools, deadline=deadline)
         temp_message_text[1] = temp_message_text[1][:-2] + '✅'
         await bot.edit_message_text(chat_id=chat_id, message_id=temp_message_id, text='\n'.join(temp_message_text))
 
-        messages.append({'role': 'system', 'content': 'tool result:\n' + tool_result})
         sql_insert_message(user_id=user_id, role='system', content='tool result:\n' + tool_result)
-        
-        answer = llm_api(messages=messages, files=input_files, provider='google')
 
-    await bot.delete_message(chat_id=chat_id, message_id=temp_message_id)
+        chunks = answer_stream(messages=messages, files=input_files, provider='google', tool_result=tool_result)
+
+    # ======================= send answer =======================
+    # the progress message becomes the answer and is edited as the text comes
+    answer, answer_message_id = await stream_to_telegram(bot, chat_id, chunks, placeholder_id=temp_message_id)
     logger.info(f'answer to {user}({text}): {answer}')
     sql_insert_message(user_id=user_id, role='assistant', content=answer)
 
@@ -682,8 +782,7 @@ async def message_handler(message: Message, state: FSMContext) -> None:
     
     latex_expressions = re.findall(r'\$\$(.*?)\$\$|\$(.*?)\$', answer, re.DOTALL) 
 
-    user_text_language = detect_language(text)
-    answer_text_language = detect_language(answer)
+    user_text_language, answer_text_language = await asyncio.gather(asyncio.to_thread(detect_language, text), asyncio.to_thread(detect_language, answer))
     if answer_text_language != user_text_language:
         inline_keyboard.append(InlineKeyboardButton(text=f'Translate to {user_text_language} 📖', callback_data=f'translate_message-{message_hash}-{user_text_language}'))
 
@@ -691,20 +790,11 @@ async def message_handler(message: Message, state: FSMContext) -> None:
     if user_language_code != user_text_language:
         inline_keyboard.append(InlineKeyboardButton(text=f'Translate to {user_language_code} 📖', callback_data=f'translate_message-{message_hash}-{message.from_user.language_code}'))
 
-    if inline_keyboard == []:
-        inline_keyboard = None
-    else:
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[inline_keyboard])
- 
-
-    # ======================= send answer =======================
-    while answer:
+    if inline_keyboard and answer_message_id:
         try:
-            await message.answer(markdown_to_html(answer[:4000]), parse_mode='HTML', reply_markup=inline_keyboard)
-            inline_keyboard = None
+            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=answer_message_id, reply_markup=InlineKeyboardMarkup(inline_keyboard=[inline_keyboard]))
         except Exception as e:
-            await message.answer(answer[:4000])
-        answer = answer[4000:]
+            logger.warning(f'Error with buttons: {e}')
 
     # ======================= latex expressions in message to png =======================
     expressions = await async_expressions_to_png(latex_expressions)
@@ -772,7 +862,7 @@ RESPONSE FORMAT:
 [Only corrected HTML, nothing else]
 
 Text to fix:\n''' + message
-    new_message = llm_api(promt)
+    new_message = await async_llm_api(promt, cache_ttl=response_cache_ttl)
     try:
         await callback.message.edit_text(new_message, parse_mode='HTML')
         await callback.answer()
@@ -790,10 +880,11 @@ async def callback_translate_message(callback: CallbackQuery):
     user_text_language = callback.data.split('-')[2]
 
     text = sql_get_message_by_hash(message_hash)
-    translated = translate(text, user_text_language)
+    translated = await asyncio.to_thread(translate, text, user_text_language)
 
     
     logger.info(f'translate_message - User: {callback.from_user.full_name}, message: {text}, translated: {translated}, message_hash: {message_hash}')
+    from .formatter import markdown_to_html
     while translated:
         try:
             await callback.message.answer(markdown_to_html(translated[:4000]), parse_mode='HTML')
@@ -960,7 +1051,8 @@ async def callback_run_code_in_message(callback: CallbackQuery):
         await callback.answer()
         return
     
-    str_result, image = code_interpreter(code)
+    async with limit('code_interpreter', [(provider_limiter('e2b'), 1)]):
+        str_result, image = await asyncio.to_thread(code_interpreter, code)
 
     if str_result.replace('\n', '') == '':
         str_result = 'no text output'
@@ -989,7 +1081,7 @@ async def callback_render_latex(callback: CallbackQuery):
     
     latex = re.findall(r'```latex\n(.*?)\n```', text, re.DOTALL)[0]
     
-    file_name = latex_to_pdf(latex)
+    file_name = await asyncio.to_thread(latex_to_pdf, latex)
     if file_name:
         await callback.message.answer_document(document=FSInputFile(file_name))
         os.remove(file_name)
@@ -1004,7 +1096,7 @@ async def callback_render_latex(callback: CallbackQuery):
 @dp.callback_query(F.data[:22] == 'translate_help_message')
 async def callback_render_latex(callback: CallbackQuery):
     language = callback.data.split('-')[1]
-    translated = translate(text=help_message, target_language=language, source_language='en')
+    translated = await asyncio.to_thread(translate, text=help_message, target_language=language, source_language='en')
 
     logger.info(f'User: {callback.from_user.full_name}, language: {language}')
 
@@ -1019,4 +1111,5 @@ async def callback_render_latex(callback: CallbackQuery):
 
 if __name__ == '__main__':
     logger.info('Bot is launched')
+    dp.shutdown.register(close_http_session)
     dp.run_polling(bot)
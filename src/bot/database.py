@@ -4,6 +4,7 @@ import sqlite3
 from typing import Literal
 from hashlib import sha256
 from datetime import datetime, timezone
+from ..agent.context import count_tokens
 from ..config.logger import logger
 from ..config.config import load_config
 
@@ -31,7 +32,8 @@ def sql_launch():
         role TEXT,
         content TEXT,
         time TEXT,
-        message_hash TEXT
+        message_hash TEXT,
+        tokens INT
         )
         ''')
 
@@ -46,6 +48,8 @@ def sql_launch():
         browser_automation_enabled INTEGER DEFAULT 0,
         gpt_oss_model TEXT DEFAULT 'openai/gpt-oss-120b',
         gemini_model TEXT DEFAULT 'gemini-2.5-flash',
+        daily_token_quota INT,
+        daily_request_quota INT,
         number_of_messages INT,
         first_message TEXT,
         last_message TEXT
@@ -56,13 +60,20 @@ def sql_launch():
     columns_to_add = [
         ('current_state', 'TEXT DEFAULT "default"'),
         ('gpt_oss_model', 'TEXT DEFAULT "openai/gpt-oss-120b"'),
-        ('gemini_model', 'TEXT DEFAULT "gemini-2.5-flash"')
+        ('gemini_model', 'TEXT DEFAULT "gemini-2.5-flash"'),
+        ('daily_token_quota', 'INT'),
+        ('daily_request_quota', 'INT')
     ]
     for column_name, column_def in columns_to_add:
         try:
             cursor.execute(f'ALTER TABLE Users ADD COLUMN {column_name} {column_def}')
         except sqlite3.OperationalError:
             pass 
+
+    try:
+        cursor.execute('ALTER TABLE Messages ADD COLUMN tokens INT')
+    except sqlite3.OperationalError:
+        pass
     
     connection.commit()
     connection.close()
@@ -87,15 +98,28 @@ def sql_check_user(telegram_name: str, telegram_username: str, user_id: int):
     connection.close()
 
 
-def sql_select_history(id: int, n: int | str = 10):
-    '''Returns the last n messages from the database by id. Format [{'role' : ..., 'content': ...}, ...]'''
+def sql_select_history(id: int, n: int | str = 10, with_tokens: bool = False):
+    '''Returns the last n messages from the database by id. Format [{'role' : ..., 'content': ...}, ...]. 
+    with_tokens adds the cached token count: [{'role' : ..., 'content': ..., 'tokens': ...}, ...]'''
     connection = sqlite3.connect(config.database.path) 
     cursor = connection.cursor()
 
-    role_content = cursor.execute('SELECT role, content FROM Messages WHERE user_id = ? ORDER BY time DESC LIMIT ?', (id, n)).fetchall()[::-1]   
+    role_content = cursor.execute('SELECT role, content, tokens, rowid FROM Messages WHERE user_id = ? ORDER BY time DESC LIMIT ?', (id, n)).fetchall()[::-1]   
+
+    if not with_tokens:
+        connection.close()
+        return [{'role': i[0], 'content': i[1]} for i in role_content]
+
+    history = []
+    for role, content, tokens, rowid in role_content:
+        if tokens is None:  # messages saved before the tokens column
+            tokens = count_tokens(content)
+            cursor.execute('UPDATE Messages SET tokens = ? WHERE rowid = ?', (tokens, rowid))
+        history.append({'role': role, 'content': content, 'tokens': tokens})
+
+    connection.commit()
     connection.close()
-    
-    return [{'role': i[0], 'content': i[1]} for i in role_content]
+    return history
 
 
 def sql_insert_message(user_id: int, role: Literal['user', 'assistant', 'system'], content: str):
@@ -106,7 +130,7 @@ def sql_insert_message(user_id: int, role: Literal['user', 'assistant', 'system'
     user_name = cursor.execute('SELECT telegram_name FROM Users WHERE user_id = ?', (user_id,)).fetchone()[0]
 
     hash = text_to_hash(content)
-    cursor.execute('INSERT INTO Messages (user_name, user_id, role, content, time, message_hash) VALUES (?, ?, ?, ?, ?, ?)', (user_name, user_id, role, content, utc_time(), hash))
+    cursor.execute('INSERT INTO Messages (user_name, user_id, role, content, time, message_hash, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)', (user_name, user_id, role, content, utc_time(), hash, count_tokens(content)))
 
     connection.commit()
     connection.close()
@@ -185,6 +209,18 @@ def sql_change_setting(user_id: int, setting_name: str, setting_value: str | int
     return True
 
 
+def sql_get_user_quotas(user_id: int) -> dict:
+    '''Daily quotas of the user: {'daily_tokens': ..., 'daily_requests': ..., 'daily_cost': ...}. NULL columns (and unknown users) get the defaults from the config'''
+    connection = sqlite3.connect(config.database.path)
+    row = connection.execute('SELECT daily_token_quota, daily_request_quota FROM Users WHERE user_id = ?', (user_id, )).fetchone() or (None, None)
+    connection.close()
+    return {
+        'daily_tokens': config.quotas.daily_tokens if row[0] is None else row[0],
+        'daily_requests': config.quotas.daily_requests if row[1] is None else row[1],
+        'daily_cost': config.quotas.daily_cost
+    }
+
+
 def sql_set_user_state(user_id: int, state: str) -> bool:
     '''Set user state in database'''
     return sql_change_setting(user_id=user_id, setting_name='current_state', setting_value=state)
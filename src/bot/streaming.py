@@ -0,0 +1,88 @@
+'''Streaming answers into Telegram: the text goes into one message that is edited at a throttled cadence,
+a new message is started when the current one gets close to the 4096 characters limit'''
+import asyncio
+from time import monotonic
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from ..config.logger import logger
+
+
+edit_interval = 1.0  # seconds between edits of one message (Telegram flood limits)
+max_message_chars = 3500  # markdown per message, its html must still fit into 4096
+first_message_chars = 20  # the first message is sent when there are a few words
+cursor = ' ▌'
+
+fix_formatting_keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text='Fix formatting', callback_data='fix_formatting')]])
+
+
+async def text_chunks(text: str):
+    '''An already generated answer as a stream'''
+    yield text
+
+
+def split_point(text: str, max_chars: int) -> int:
+    '''The last paragraph, line or word break before max_chars'''
+    for separator in ['\n\n', '\n', ' ']:
+        index = text.rfind(separator, max_chars // 2, max_chars)
+        if index != -1:
+            return index + len(separator)
+    return max_chars
+
+
+async def render(bot: Bot, chat_id: int, message_id: int | None, text: str, reply_markup: InlineKeyboardMarkup | None = None, final: bool = False) -> int | None:
+    '''Sends (message_id is None) or edits the message. Unfinished markdown in the middle of the stream can give broken html,
+    then the text is shown as is; the final version gets the "Fix formatting" button. Returns the message id'''
+    from .formatter import markdown_to_html  # bs4 and pylatexenc are loaded with the first answer, not at startup
+
+    html = markdown_to_html(text)
+    attempts = [(html, 'HTML', reply_markup)] if len(html) <= 4096 else []
+    if final:
+        attempts.append((html if len(html) <= 4096 else text, None, reply_markup or fix_formatting_keyboard))
+    else:
+        attempts.append((text, None, reply_markup))
+
+    for body, parse_mode, markup in attempts:
+        for _ in range(2):  # one retry after the flood wait for the final version
+            try:
+                if message_id is None:
+                    sent = await bot.send_message(chat_id=chat_id, text=body, parse_mode=parse_mode, reply_markup=markup)
+                    return sent.message_id
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=body, parse_mode=parse_mode, reply_markup=markup)
+                return message_id
+            except TelegramRetryAfter as e:
+                if not final:
+                    return message_id  # skip this edit, the next one will show the text
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if 'message is not modified' in str(e):
+                    return message_id
+                logger.warning(f'Streaming {parse_mode} error: {e}')
+                break
+    return message_id
+
+
+async def stream_to_telegram(bot: Bot, chat_id: int, chunks, placeholder_id: int | None = None, reply_markup: InlineKeyboardMarkup | None = None) -> tuple[str, int | None]:
+    '''Shows the stream of text pieces in Telegram. placeholder_id - a message (e.g. "⏳") that becomes the first message of the answer.
+    reply_markup goes to the last message. Returns (full text, id of the last message)'''
+    text = ''
+    offset = 0  # the current message shows text[offset:]
+    message_id = placeholder_id
+    last_edit = 0.0
+
+    try:
+        async for chunk in chunks:
+            text += chunk
+            while len(text) - offset > max_message_chars:  # rollover
+                split = offset + split_point(text[offset:], max_message_chars)
+                await render(bot, chat_id, message_id, text[offset:split], final=True)
+                offset, message_id, last_edit = split, None, 0.0
+
+            if monotonic() - last_edit >= edit_interval and (message_id is not None or len(text) - offset >= first_message_chars):
+                message_id = await render(bot, chat_id, message_id, text[offset:] + cursor)
+                last_edit = monotonic()
+    finally:
+        await chunks.aclose()  # the llm stream holds a concurrency slot until it is closed
+
+    message_id = await render(bot, chat_id, message_id, text[offset:] or '...', reply_markup, final=True)
+    return text, message_id
@@ -1,6 +1,7 @@
 import os
 import json
 from environs import Env
+from functools import lru_cache
 from dataclasses import dataclass
 from colorama import Fore, Style, init
 
@@ -24,6 +25,8 @@ class TgBot:
 @dataclass
 class Database:
     path: str
+    cache_path: str
+    cache_files_dir: str
 
 
 @dataclass
@@ -45,16 +48,27 @@ class API:
     e2b_key: str
 
 
+@dataclass
+class Quotas:
+    '''Default daily limits of a user (0 = no limit). Users.daily_*_quota overrides them for one user'''
+    daily_tokens: int
+    daily_requests: int
+    daily_cost: float
+
+
 @dataclass
 class Config:
     tg_bot: TgBot
     database: Database
     logs: Logs
     api: API 
+    quotas: Quotas
     base_dir: str
 
 
+@lru_cache(maxsize=None)
 def load_config(path: str | None = None) -> Config:
+    '''Reads .env and messages.json once per process, every module gets the same Config'''
 
     env = Env()
     env.read_env(path)
@@ -78,7 +92,9 @@ def load_config(path: str | None = None) -> Config:
             messages=messages
         ),
         database=Database(
-            path=os.path.join(BASE_DIR, "src", "bot", "database.db")
+            path=os.path.join(BASE_DIR, "src", "bot", "database.db"),
+            cache_path=os.path.join(BASE_DIR, "src", "agent", "cache.db"),
+            cache_files_dir=os.path.join(BASE_DIR, "src", "agent", "cache_files")
         ),
         logs=Logs(
             log_path=os.path.join(BASE_DIR, "src", "logs", "agent.log"),
@@ -95,6 +111,11 @@ def load_config(path: str | None = None) -> Config:
             detect_language_key=env.str("DETECT_LANGUAGE_API_KEY", default=""),
             e2b_key=env.str("E2B_API_KEY", default="")
         ),
+        quotas=Quotas(
+            daily_tokens=env.int("DAILY_TOKEN_QUOTA", default=0),
+            daily_requests=env.int("DAILY_REQUEST_QUOTA", default=0),
+            daily_cost=env.float("DAILY_COST_QUOTA", default=0)
+        ),
         base_dir=BASE_DIR
     )
 